@@ -1 +1,3 @@
 VERSION = (0, 3, 2)
+
+default_app_config = 'relationships.apps.RelationshipsConfig'
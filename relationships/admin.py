@@ -1,25 +1,211 @@
+from django.conf import settings
+import django
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
 from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connections
+from django.forms.models import BaseInlineFormSet
+from django.utils.functional import curry
+from django.utils.html import escape
+from django.utils.text import Truncator
 
 from .forms import RelationshipStatusAdminForm
-from .models import Relationship, RelationshipStatus
+from .models import GenericRelationship, Relationship, RelationshipStatus
+
+
+# below this many rows the admin counts exactly, above it an unfiltered
+# changelist uses the planner's estimate of the table size
+ESTIMATE_THRESHOLD = getattr(settings, 'RELATIONSHIPS_ADMIN_ESTIMATE_THRESHOLD', 100000)
+
+# relationships shown per page by the inline on the user admin
+INLINE_PER_PAGE = getattr(settings, 'RELATIONSHIPS_ADMIN_INLINE_PER_PAGE', 50)
+INLINE_PAGE_VAR = 'relationships_page'
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator which, for an unfiltered queryset on PostgreSQL, takes the
+    number of rows from ``pg_class`` rather than running a ``COUNT(*)`` over
+    the whole table.  Filtered querysets, small tables and other databases
+    are counted exactly.
+    """
+    def _estimate_count(self):
+        qs = self.object_list
+        query = getattr(qs, 'query', None)
+        if query is None or query.where.children or query.extra:
+            return None
+
+        connection = connections[qs.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                       [qs.model._meta.db_table])
+        row = cursor.fetchone()
+        if row is None or row[0] < ESTIMATE_THRESHOLD:
+            return None
+        return int(row[0])
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = self._estimate_count()
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
+
+class RelationshipChangeList(ChangeList):
+    """
+    A changelist which, filtered or searched, doesn't count the whole table
+    for the "(N total)" link beside the result count, as
+    ``show_full_result_count = False`` does from Django 1.8 on.
+    """
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        result_count = paginator.count
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.queryset._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        # equal to the filtered count the templates leave the total out,
+        # while still showing the actions for a non-empty result
+        self.full_result_count = result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+def _raw_id_label(obj, widget_label, value):
+    # the related object is already loaded with the row, only look it up
+    # again when the submitted value points somewhere else
+    if obj is not None and unicode(value) == unicode(obj.pk):
+        return '&nbsp;<strong>%s</strong>' % escape(Truncator(obj).words(14, truncate='...'))
+    return widget_label(value)
+
+
+class RelationshipInlineFormSet(BaseInlineFormSet):
+    """
+    Shows one page of a user's relationships, newest first, with the related
+    rows joined in and the status and site choices built once per formset
+    rather than once per form.
+    """
+    per_page = INLINE_PER_PAGE
+    page = 1
+    page_var = INLINE_PAGE_VAR
+
+    def _ordered_queryset(self):
+        qs = super(RelationshipInlineFormSet, self).get_queryset()
+        return qs.select_related('from_user', 'to_user', 'status', 'site').order_by('-pk')
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            offset = (self.page - 1) * self.per_page
+            self._queryset = self._ordered_queryset()[offset:offset + self.per_page]
+        return self._queryset
+
+    @property
+    def has_previous(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        # only asked by the template, and answered without counting the rows
+        if not hasattr(self, '_has_next'):
+            offset = self.page * self.per_page
+            self._has_next = self._ordered_queryset()[offset:offset + 1].exists()
+        return self._has_next
+
+    def previous_page_number(self):
+        return self.page - 1
+
+    def next_page_number(self):
+        return self.page + 1
+
+    def _cached_choices(self):
+        if not hasattr(self, '_choices'):
+            self._choices = {}
+            for name in ('status', 'site'):
+                field = self.form.base_fields.get(name)
+                if field is not None and hasattr(field, 'queryset'):
+                    # iter() so list() doesn't also size the queryset
+                    self._choices[name] = list(iter(field.choices))
+        return self._choices
+
+    def _construct_form(self, i, **kwargs):
+        form = super(RelationshipInlineFormSet, self)._construct_form(i, **kwargs)
+        for name, choices in self._cached_choices().items():
+            form.fields[name].choices = choices
+        for name in ('from_user', 'to_user'):
+            field = form.fields.get(name)
+            if field is not None and isinstance(field.widget, ForeignKeyRawIdWidget):
+                obj = getattr(form.instance, name) if form.instance.pk else None
+                field.widget.label_for_value = curry(
+                    _raw_id_label, obj, field.widget.label_for_value)
+        return form
 
 
 class RelationshipInline(admin.TabularInline):
     model = Relationship
+    formset = RelationshipInlineFormSet
+    template = 'relationships/admin/paged_tabular.html'
     raw_id_fields = ('from_user', 'to_user')
     extra = 1
     fk_name = 'from_user'
 
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super(RelationshipInline, self).get_formset(request, obj, **kwargs)
+        try:
+            page = max(int(request.GET.get(INLINE_PAGE_VAR, 1)), 1)
+        except ValueError:
+            page = 1
+        return type(formset.__name__, (formset,), {'page': page})
+
 
 class UserRelationshipAdmin(UserAdmin):
     inlines = (RelationshipInline,)
 
 
+class RelationshipAdmin(admin.ModelAdmin):
+    list_display = ('from_user', 'to_user', 'status', 'site', 'created', 'weight', 'expires_at')
+    list_select_related = ('from_user', 'to_user', 'status', 'site')
+    list_filter = ('status', 'site')
+    raw_id_fields = ('from_user', 'to_user')
+    ordering = ('-pk',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        if django.VERSION < (1, 8):
+            return RelationshipChangeList
+        return super(RelationshipAdmin, self).get_changelist(request, **kwargs)
+
+
+class GenericRelationshipAdmin(admin.ModelAdmin):
+    list_display = ('from_user', 'content_type', 'object_id', 'status', 'site', 'created')
+    list_select_related = ('from_user', 'content_type', 'status', 'site')
+    list_filter = ('content_type', 'status', 'site')
+    raw_id_fields = ('from_user',)
+    ordering = ('-pk',)
+
+
 class RelationshipStatusAdmin(admin.ModelAdmin):
     form = RelationshipStatusAdminForm
 
 # admin.site.unregister(User)
 # admin.site.register(User, UserRelationshipAdmin)
+admin.site.register(Relationship, RelationshipAdmin)
+admin.site.register(GenericRelationship, GenericRelationshipAdmin)
 admin.site.register(RelationshipStatus, RelationshipStatusAdmin)
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.utils.translation import ugettext_lazy as _
+
+
+class RelationshipsConfig(AppConfig):
+    name = 'relationships'
+    verbose_name = _('Relationships')
+
+    def ready(self):
+        from .models import install
+        from .privacy import get_profile_model
+
+        install(get_profile_model())
@@ -0,0 +1,159 @@
+"""
+Versioned cache keys for relationship data.
+
+Every user has a "relationship version" which is bumped whenever a
+relationship involving them is added or removed.  Anything rendered from a
+user's relationships can be cached under a key embedding the versions of the
+users involved, so it stays valid until the graph actually changes.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import Min, Q
+from django.utils import timezone, translation
+from django.utils.encoding import force_unicode
+
+
+# how long a cached fragment may live, the version does the invalidating so
+# this only bounds how long unused entries occupy the cache
+CACHE_TIMEOUT = getattr(settings, 'RELATIONSHIPS_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+
+VERSION_KEY = 'relationships:version:%s:%s'
+FRAGMENT_KEY = 'relationships:fragment:%s:%s'
+
+
+def _user_id(user):
+    if isinstance(user, User):
+        return user.pk
+    return user
+
+
+def _version_key(user_id):
+    return VERSION_KEY % (settings.SITE_ID, user_id)
+
+
+def _new_version():
+    # versions are seeded from the clock so that a counter lost to eviction
+    # never comes back with a value that was handed out before
+    return int(time.time() * 1000)
+
+
+def get_relationship_versions(users):
+    """
+    Returns a dictionary mapping user id -> relationship version for the
+    given users (or user ids), fetching them with a single cache round trip.
+    """
+    keys = dict((_version_key(_user_id(user)), _user_id(user)) for user in users)
+    cached = cache.get_many(keys.keys())
+
+    versions = {}
+    for key, user_id in keys.items():
+        version = cached.get(key)
+        if version is None:
+            version = _new_version()
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+        versions[user_id] = version
+    return versions
+
+
+def get_relationship_version(user):
+    return get_relationship_versions([user])[_user_id(user)]
+
+
+def bump_relationship_version(*users):
+    """
+    Invalidate everything cached from the relationships of the given users
+    (or user ids).
+    """
+    for user in users:
+        key = _version_key(_user_id(user))
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), None)
+
+
+def versioned_cache_key(name, users, *vary_on):
+    """
+    Build a cache key for ``name`` that changes whenever the relationships of
+    any of ``users`` change.  Anonymous users (and ``None``) are allowed and
+    simply contribute no version.
+    """
+    user_ids = [_user_id(user) for user in users]
+    versions = get_relationship_versions([pk for pk in user_ids if pk is not None])
+
+    bits = ['%s.%s' % (pk, versions.get(pk, 0)) for pk in user_ids]
+    bits.extend(force_unicode(value) for value in vary_on)
+    bits.append(translation.get_language() or '')
+
+    digest = hashlib.md5(u':'.join(bits).encode('utf-8')).hexdigest()
+    return FRAGMENT_KEY % (name, digest)
+
+
+def timeout_until(nearest, now):
+    """
+    ``CACHE_TIMEOUT``, or the seconds from ``now`` until ``nearest`` if that
+    comes sooner.  Expiring relationships bump no versions, so anything
+    cached from them must not outlive them.
+    """
+    if nearest is None:
+        return CACHE_TIMEOUT
+    delta = nearest - now
+    seconds = delta.days * 86400 + delta.seconds + (1 if delta.microseconds else 0)
+    return min(CACHE_TIMEOUT, max(seconds, 1))
+
+
+def expiry_timeout(users):
+    """
+    The timeout for something cached from the relationships of ``users``
+    (users, user ids or ``None``): ``CACHE_TIMEOUT``, capped at the first
+    temporary relationship from or to any of them that expires.
+    """
+    from .models import Relationship
+
+    user_ids = [pk for pk in (_user_id(user) for user in users) if pk is not None]
+    if not user_ids:
+        return CACHE_TIMEOUT
+    now = timezone.now()
+    nearest = Relationship.objects.filter(
+        Q(from_user__in=user_ids) | Q(to_user__in=user_ids),
+        site__pk=settings.SITE_ID,
+        expires_at__gt=now,
+    ).aggregate(nearest=Min('expires_at'))['nearest']
+    return timeout_until(nearest, now)
+
+
+def target_version_id(content_type_id, object_id):
+    """
+    The id whose relationship version covers the followers of an object:
+    the user id for users, ``"<content type>.<object id>"`` for anything
+    else followed through :class:`~relationships.models.GenericRelationship`.
+    """
+    if int(content_type_id) == ContentType.objects.get_for_model(User).pk:
+        return int(object_id)
+    return '%s.%s' % (content_type_id, object_id)
+
+
+def relationship_changed(sender, instance, **kwargs):
+    """
+    Signal receiver bumping the versions of both ends of a relationship that
+    was saved or deleted.
+    """
+    bump_relationship_version(instance.from_user_id, instance.to_user_id)
+
+
+def relationships_bulk_changed(sender, from_user_id, added, removed, **kwargs):
+    """
+    Signal receiver for :data:`relationships.signals.bulk_relationships_changed`.
+    """
+    bump_relationship_version(from_user_id, *(list(added) + list(removed)))
+
+
+def generic_relationship_changed(sender, instance, **kwargs):
+    bump_relationship_version(instance.from_user_id, target_version_id(
+        instance.content_type_id, instance.object_id))
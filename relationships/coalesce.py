@@ -0,0 +1,123 @@
+"""
+Coalescing of rapid follow/unfollow toggles.
+
+When ``RELATIONSHIPS_COALESCE_WINDOW`` is set to a number of seconds, the add
+and remove views only record the state the user asked for.  The first request
+for a given (user, target, status) schedules a flush ``WINDOW`` seconds later,
+and that flush compares the last requested state with the database and
+applies the net change, if any, along with its activity stream side effects.
+
+The requested state is kept nowhere but the cache, so coalescing needs a
+cache the celery workers share with the web processes.  With a per-process
+backend such as ``LocMemCache`` changes are applied immediately instead.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+
+from actstream import actions
+from actstream.models import Action
+
+from .models import RelationshipStatus
+
+
+WINDOW = getattr(settings, 'RELATIONSHIPS_COALESCE_WINDOW', 0)
+
+INTENT_KEY = 'relationships:intent:%s:%s:%s:%s'
+PENDING_KEY = 'relationships:intent-pending:%s:%s:%s:%s'
+LOCK_KEY = 'relationships:intent-lock:%s:%s:%s:%s'
+
+# cache backends whose entries no other process can read
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+def apply_relationship_change(from_user, to_user, status, add, symmetrical=False):
+    """
+    Add or remove a relationship and record it in the activity stream.
+    """
+    if add:
+        from_user.relationships.add(to_user, status, symmetrical)
+        actions.follow(from_user, to_user, actor_only=False)
+    else:
+        from_user.relationships.remove(to_user, status, symmetrical)
+        actions.unfollow(from_user, to_user)
+        ctype = ContentType.objects.get_for_model(from_user)
+        target_content_type = ContentType.objects.get_for_model(to_user)
+        Action.objects.all().filter(actor_content_type=ctype, actor_object_id=from_user.id, verb=u'started following', target_content_type=target_content_type, target_object_id=to_user.id).delete()
+
+
+def _keys(from_user_id, to_user_id, status_id):
+    bits = (settings.SITE_ID, from_user_id, to_user_id, status_id)
+    return INTENT_KEY % bits, PENDING_KEY % bits, LOCK_KEY % bits
+
+
+def _shared_cache():
+    # eager tasks run in this process and see its cache whatever the backend
+    if getattr(settings, 'CELERY_ALWAYS_EAGER', False):
+        return True
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    return backend not in LOCAL_CACHE_BACKENDS
+
+
+def _schedule_flush(from_user_id, to_user_id, status_id):
+    from .tasks import flush_relationship_change
+    flush_relationship_change.apply_async(
+        args=(from_user_id, to_user_id, status_id), countdown=WINDOW)
+
+
+def submit_relationship_change(from_user, to_user, status, add, symmetrical=False):
+    """
+    Request that a relationship be added or removed.  Without a coalescing
+    window, or a cache shared with the workers to keep the request in, the
+    change is applied immediately, otherwise only the requested state is
+    recorded and a flush is scheduled unless one already is.
+    """
+    if not WINDOW or not _shared_cache():
+        apply_relationship_change(from_user, to_user, status, add, symmetrical)
+        return
+
+    intent_key, pending_key, _ = _keys(from_user.pk, to_user.pk, status.pk)
+    cache.set(intent_key, (add, symmetrical), WINDOW * 10)
+    if cache.add(pending_key, True, WINDOW * 10):
+        _schedule_flush(from_user.pk, to_user.pk, status.pk)
+
+
+def flush_relationship_change(from_user_id, to_user_id, status_id):
+    """
+    Apply the last state requested for a (user, target, status) if it differs
+    from what is in the database.  Returns True if anything was written.
+    """
+    intent_key, pending_key, lock_key = _keys(from_user_id, to_user_id, status_id)
+
+    if not cache.add(lock_key, True, WINDOW * 10 or 60):
+        # another flush is writing this pair, try again once it is done
+        _schedule_flush(from_user_id, to_user_id, status_id)
+        return False
+
+    try:
+        # requests arriving from here on schedule a flush of their own
+        cache.delete(pending_key)
+        intent = cache.get(intent_key)
+        if intent is None:
+            return False
+        add, symmetrical = intent
+
+        from_user = User.objects.get(pk=from_user_id)
+        to_user = User.objects.get(pk=to_user_id)
+        status = RelationshipStatus.objects.get(pk=status_id)
+
+        if add:
+            changed = not from_user.relationships.exists(to_user, status, symmetrical)
+        else:
+            changed = from_user.relationships.exists(to_user, status) or \
+                (symmetrical and to_user.relationships.exists(from_user, status))
+
+        if changed:
+            apply_relationship_change(from_user, to_user, status, add, symmetrical)
+        return changed
+    finally:
+        cache.delete(lock_key)
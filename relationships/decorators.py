@@ -1,5 +1,11 @@
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.functional import wraps
+
+from .cache import expiry_timeout, target_version_id, versioned_cache_key
+from .privacy import privacy_version
 
 
 def require_user(view):
@@ -7,3 +13,36 @@ def require_user(view):
         user = get_object_or_404(User, username=username)
         return view(request, user, *args, **kwargs)
     return inner
+
+
+def cache_follow_list(view):
+    """
+    Cache the rendered output of a follower/following list view until the
+    relationships of either the list owner or the viewer change, a user
+    changes the privacy of their profile, or one of their temporary
+    relationships expires.
+    """
+    def inner(request, content_type_id, object_id, *args, **kwargs):
+        if request.method != 'GET':
+            return view(request, content_type_id, object_id, *args, **kwargs)
+
+        users = [request.user.pk, target_version_id(content_type_id, object_id)]
+        key = versioned_cache_key(
+            view.__name__,
+            users,
+            request.get_full_path(),
+            request.is_ajax(),
+            privacy_version(),
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+        response = view(request, content_type_id, object_id, *args, **kwargs)
+        if response.status_code == 200:
+            # objects other than users have no expiring relationships
+            timeout = expiry_timeout([pk for pk in users if not isinstance(pk, basestring)])
+            cache.set(key, (response.content, response['Content-Type']), timeout)
+        return response
+    return wraps(view)(inner)
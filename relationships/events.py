@@ -0,0 +1,95 @@
+"""
+Reading the :class:`~relationships.models.RelationshipEvent` change log.
+
+Every relationship added or removed, one at a time or in bulk, appends an
+event in the same transaction.  Downstream systems read the log in id order
+through a named :class:`EventConsumer`, which remembers how far it got in a
+:class:`~relationships.models.RelationshipEventCheckpoint`::
+
+    consumer = EventConsumer('search-index')
+    consumer.consume(lambda events: index_users(e.to_user_id for e in events))
+
+Ids are handed out when a transaction inserts an event, not when it commits,
+so a slow transaction can commit an event with a lower id than one already
+read.  Consumers therefore only read events older than ``lag`` seconds,
+``RELATIONSHIPS_EVENT_LAG`` by default.
+"""
+import datetime
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import RelationshipEvent, RelationshipEventCheckpoint
+
+
+BATCH_SIZE = getattr(settings, 'RELATIONSHIPS_EVENT_BATCH_SIZE', 5000)
+LAG = getattr(settings, 'RELATIONSHIPS_EVENT_LAG', 5)
+
+EVENT_FIELDS = ('id', 'action', 'from_user_id', 'to_user_id', 'status_id',
+                'site_id', 'created')
+
+Event = namedtuple('Event', EVENT_FIELDS)
+
+
+def read_events(after=0, limit=BATCH_SIZE, lag=LAG):
+    """
+    Returns a list of at most ``limit`` events with an id greater than
+    ``after``, oldest first, as ``Event`` tuples.
+    """
+    qs = RelationshipEvent.objects.filter(id__gt=after)
+    if lag:
+        qs = qs.filter(created__lte=timezone.now() - datetime.timedelta(seconds=lag))
+    return [Event(*row) for row in qs.order_by('id').values_list(*EVENT_FIELDS)[:limit]]
+
+
+class EventConsumer(object):
+    """
+    Reads the change log from where the consumer called ``name`` last left
+    off.  Only one process should consume under a given name at a time.
+    """
+    def __init__(self, name, batch_size=BATCH_SIZE, lag=LAG):
+        self.name = name
+        self.batch_size = batch_size
+        self.lag = lag
+
+    def _checkpoint(self):
+        return RelationshipEventCheckpoint.objects.get_or_create(name=self.name)[0]
+
+    @property
+    def position(self):
+        return self._checkpoint().position
+
+    def commit(self, position):
+        RelationshipEventCheckpoint.objects.filter(name=self.name).update(
+            position=position, updated=timezone.now())
+
+    def batches(self):
+        """
+        Yields lists of events.  The checkpoint moves past a batch when the
+        next one is requested, so a batch whose processing fails is read
+        again by the next run.
+        """
+        position = self.position
+        while True:
+            events = read_events(position, self.batch_size, self.lag)
+            if not events:
+                return
+            yield events
+            position = events[-1].id
+            self.commit(position)
+
+    def consume(self, handler):
+        """
+        Call ``handler`` with every batch of events past the checkpoint.
+        Returns the number of events handled.
+        """
+        handled = 0
+        for events in self.batches():
+            handler(events)
+            handled += len(events)
+        return handled
+
+    def reset(self, position=0):
+        self._checkpoint()
+        self.commit(position)
@@ -0,0 +1,43 @@
+"""
+Removal of temporary relationships, e.g. a mute for a day or a block for a
+week, added with ``user.relationships.add(other, status, expires=...)``.
+
+Expired relationships are hidden from the read paths as soon as they expire:
+queries skip them, the graph engine drops them at their expiry and cached
+relationship lists time out when the first relationship in them expires.
+They are deleted later by :func:`sweep_expired`, run from cron with the
+``sweep_expired_relationships`` command, which keeps the table and its
+indexes small.
+"""
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Relationship
+
+
+def sweep_expired(batch_size=500, max_batches=None, pause=0):
+    """
+    Delete relationships which expired before the sweep started.  The
+    ``expires_at`` index finds at most ``batch_size`` of them at a time,
+    each batch is deleted in a transaction of its own and ``pause`` seconds
+    are slept between batches, so the table is never locked for long.
+    Deleting sends ``post_delete`` for every relationship as ``remove()``
+    does.  Returns the number of relationships deleted.
+    """
+    now = timezone.now()
+    expired = Relationship.objects.filter(expires_at__lte=now)
+    deleted = batches = 0
+    while max_batches is None or batches < max_batches:
+        pks = list(expired.order_by('expires_at').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        with transaction.atomic():
+            # checked again, the relationship may have been renewed meanwhile
+            expired.filter(pk__in=pks).delete()
+        deleted += len(pks)
+        batches += 1
+        if pause and len(pks) == batch_size:
+            time.sleep(pause)
+    return deleted
@@ -1,5 +1,4 @@
 from django import forms
-from django.db.models import Q
 from .models import RelationshipStatus
 
 
@@ -8,18 +7,17 @@ class RelationshipStatusAdminForm(forms.ModelForm):
         model = RelationshipStatus
 
     def duplicate_slug_check(self, status_slug):
-        status_qs = RelationshipStatus.objects.filter(
-            Q(from_slug=status_slug) |
-            Q(to_slug=status_slug) |
-            Q(symmetrical_slug=status_slug)
-        )
-
-        if self.instance.pk:
-            status_qs = status_qs.exclude(pk=self.instance.pk)
-
-        if status_qs.exists():
+        try:
+            status, direction = RelationshipStatus.objects.resolve_slug(status_slug)
+        except RelationshipStatus.DoesNotExist:
+            return
+        except RelationshipStatus.MultipleObjectsReturned:
+            # an unregistered slug shared by statuses saved long ago
+            raise forms.ValidationError('"%s" slug already in use' % status_slug)
+
+        if status.pk != self.instance.pk:
             raise forms.ValidationError('"%s" slug already in use on %s' % \
-                (status_slug, unicode(status_qs[0])))
+                (status_slug, unicode(status)))
 
     def clean_from_slug(self):
         self.duplicate_slug_check(self.cleaned_data['from_slug'])
@@ -0,0 +1,433 @@
+"""
+An optional in-process copy of the relationship graph for hot read paths.
+
+With ``RELATIONSHIPS_GRAPH_ENGINE = True``, each (status, site) graph that
+has been loaded with :meth:`GraphEngine.warm` is kept in memory as sorted
+``array('i')`` adjacency lists, one pair per user, and ``user.relationships``
+answers ``exists()`` and the id and count lookups from it without touching
+the database.  Graphs that are not loaded are answered by SQL as before.
+Temporary relationships are dropped from the graph when they expire.
+
+Changes made by this process are applied from the relationship signals once
+their transaction commits.  On Django versions without
+``transaction.on_commit`` the ``user.relationships`` methods apply them when
+their own transaction commits.  Changes made elsewhere, and those made inside
+an enclosing transaction on such versions, are read from the
+:class:`~relationships.models.RelationshipEvent` log at most every
+``RELATIONSHIPS_GRAPH_REFRESH`` seconds.  Setting
+``RELATIONSHIPS_GRAPH_MAX_AGE`` to a number of seconds also reloads each graph
+from the table once it is that old, in a background thread while the old
+graph keeps answering.  Load graphs when a worker starts, e.g. in
+``wsgi.py``::
+
+    from relationships.graph import engine
+    engine.warm()
+"""
+import calendar
+import datetime
+from contextlib import contextmanager
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+
+ENABLED = getattr(settings, 'RELATIONSHIPS_GRAPH_ENGINE', False)
+REFRESH = getattr(settings, 'RELATIONSHIPS_GRAPH_REFRESH', 1)
+MAX_AGE = getattr(settings, 'RELATIONSHIPS_GRAPH_MAX_AGE', None)
+
+# events younger than this may still be joined by events with lower ids
+# from transactions that have yet to commit, so they are read again
+EVENT_LAG = getattr(settings, 'RELATIONSHIPS_EVENT_LAG', 5)
+
+
+def _contains(ids, user_id):
+    i = bisect_left(ids, user_id)
+    return i < len(ids) and ids[i] == user_id
+
+
+def _insert(ids, user_id):
+    i = bisect_left(ids, user_id)
+    if i == len(ids) or ids[i] != user_id:
+        ids.insert(i, user_id)
+
+
+def _discard(ids, user_id):
+    i = bisect_left(ids, user_id)
+    if i < len(ids) and ids[i] == user_id:
+        del ids[i]
+
+
+def _timestamp(value):
+    """
+    The POSIX timestamp of a datetime, aware or in local time.
+    """
+    if timezone.is_aware(value):
+        seconds = calendar.timegm(value.utctimetuple())
+    else:
+        seconds = time.mktime(value.timetuple())
+    return seconds + value.microsecond / 1e6
+
+
+def _intersection(a, b):
+    result = array('i')
+    i, j, len_a, len_b = 0, 0, len(a), len(b)
+    while i < len_a and j < len_b:
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
+
+
+def _without(ids, excluded):
+    """
+    ``ids`` minus the members of the set ``excluded``, as a new array.
+    """
+    if not excluded:
+        return array('i', ids)
+    return array('i', [pk for pk in ids if pk not in excluded])
+
+
+def _count_without(ids, excluded):
+    if len(excluded) < len(ids):
+        return len(ids) - sum(1 for pk in excluded if _contains(ids, pk))
+    return sum(1 for pk in ids if pk not in excluded)
+
+
+class Node(object):
+    """
+    The sorted ids of the users one user has a relationship to
+    (``outgoing``) and from (``incoming``).
+    """
+    __slots__ = ('outgoing', 'incoming')
+
+    def __init__(self):
+        self.outgoing = array('i')
+        self.incoming = array('i')
+
+
+class Graph(object):
+    """
+    The relationships of one status on one site.  Temporary relationships
+    have their expiry timestamp in ``expiry``, keyed by ``(from_id, to_id)``,
+    and in the ``expiring`` heap of ``(timestamp, from_id, to_id)``.
+    """
+    __slots__ = ('nodes', 'loaded', 'expiry', 'expiring')
+
+    def __init__(self):
+        self.nodes = {}
+        self.loaded = time.time()
+        self.expiry = {}
+        self.expiring = []
+
+    def _node(self, user_id):
+        node = self.nodes.get(user_id)
+        if node is None:
+            node = self.nodes[user_id] = Node()
+        return node
+
+    def _set_expiry(self, from_id, to_id, expires):
+        if expires is None:
+            self.expiry.pop((from_id, to_id), None)
+        else:
+            self.expiry[(from_id, to_id)] = expires
+            heapq.heappush(self.expiring, (expires, from_id, to_id))
+
+    def add(self, from_id, to_id, expires=None):
+        _insert(self._node(from_id).outgoing, to_id)
+        _insert(self._node(to_id).incoming, from_id)
+        self._set_expiry(from_id, to_id, expires)
+
+    def remove(self, from_id, to_id):
+        for user_id, ids, other in ((from_id, 'outgoing', to_id),
+                                    (to_id, 'incoming', from_id)):
+            node = self.nodes.get(user_id)
+            if node is not None:
+                _discard(getattr(node, ids), other)
+        self.expiry.pop((from_id, to_id), None)
+
+    def next_expiry(self):
+        return self.expiring[0][0] if self.expiring else None
+
+    def expire(self, now):
+        """
+        Remove the relationships which expired by the timestamp ``now``.
+        """
+        expiring = self.expiring
+        while expiring and expiring[0][0] <= now:
+            expires, from_id, to_id = heapq.heappop(expiring)
+            # entries of relationships renewed or removed since are stale
+            if self.expiry.get((from_id, to_id)) == expires:
+                self.remove(from_id, to_id)
+
+    def exists(self, from_id, to_id):
+        node = self.nodes.get(from_id)
+        return node is not None and _contains(node.outgoing, to_id)
+
+    def mutual(self, a, b):
+        return self.exists(a, b) and self.exists(b, a)
+
+    def outgoing(self, user_id):
+        node = self.nodes.get(user_id)
+        return node.outgoing if node is not None else array('i')
+
+    def incoming(self, user_id):
+        node = self.nodes.get(user_id)
+        return node.incoming if node is not None else array('i')
+
+    def friends(self, user_id):
+        return _intersection(self.outgoing(user_id), self.incoming(user_id))
+
+    @classmethod
+    def from_edges(cls, edges):
+        """
+        Build a graph from an iterable of ``(from_id, to_id)`` pairs, or of
+        ``(from_id, to_id, expires)`` with an expiry timestamp or None.
+        """
+        outgoing, incoming, expiring = {}, {}, []
+        for edge in edges:
+            from_id, to_id = edge[0], edge[1]
+            outgoing.setdefault(from_id, []).append(to_id)
+            incoming.setdefault(to_id, []).append(from_id)
+            if len(edge) > 2 and edge[2] is not None:
+                expiring.append((edge[2], from_id, to_id))
+
+        graph = cls()
+        for user_id, ids in outgoing.items():
+            graph._node(user_id).outgoing = array('i', sorted(ids))
+        for user_id, ids in incoming.items():
+            graph._node(user_id).incoming = array('i', sorted(ids))
+        for expires, from_id, to_id in expiring:
+            graph._set_expiry(from_id, to_id, expires)
+        return graph
+
+
+class GraphEngine(object):
+    def __init__(self):
+        self.graphs = {}
+        self.position = 0
+        self.checked = 0
+        self.lock = threading.RLock()
+        # the (status, site) graphs being reloaded in the background
+        self.reloading = set()
+        # changes waiting for the transaction of a committing() block
+        self.local = threading.local()
+
+    def _edges(self, status_id, site_id, chunk_size):
+        from .models import Relationship, unexpired
+
+        qs = Relationship.objects.filter(unexpired(), status__pk=status_id, site__pk=site_id)
+        position = 0
+        while True:
+            rows = list(qs.filter(pk__gt=position).order_by('pk').values_list(
+                'pk', 'from_user', 'to_user', 'expires_at')[:chunk_size])
+            if not rows:
+                return
+            for pk, from_id, to_id, expires_at in rows:
+                yield from_id, to_id, expires_at and _timestamp(expires_at)
+            position = rows[-1][0]
+
+    def _expiry(self, events):
+        """
+        The expiry of the temporary relationships added by ``events``, keyed
+        by ``(from_id, to_id, status_id, site_id)``.
+        """
+        from .models import Relationship, RelationshipEvent
+
+        added = [event for event in events if event.action == RelationshipEvent.ADDED]
+        if not added:
+            return {}
+        rows = Relationship.objects.filter(
+            expires_at__isnull=False,
+            from_user__in=set(event.from_user_id for event in added),
+            to_user__in=set(event.to_user_id for event in added),
+        ).values_list('from_user', 'to_user', 'status', 'site', 'expires_at')
+        return dict((row[:4], row[4]) for row in rows)
+
+    def load(self, status_id, site_id, chunk_size=50000):
+        """
+        (Re)load the graph of one status on one site from the table.  The
+        graph being replaced answers reads until the new one is complete.
+        """
+        from .models import RelationshipEvent
+
+        with self.lock:
+            if not self.graphs:
+                last = RelationshipEvent.objects.order_by('-id').values_list('id', flat=True)[:1]
+                self.position = last[0] if last else 0
+                self.checked = time.time()
+            position = self.position
+
+        graph = Graph.from_edges(self._edges(status_id, site_id, chunk_size))
+
+        with self.lock:
+            self.graphs[(status_id, site_id)] = graph
+            # events logged while loading may be missing from the new graph,
+            # the next catch up applies them again
+            self.position = min(self.position, position)
+        return graph
+
+    def _reload(self, status_id, site_id):
+        try:
+            self.load(status_id, site_id)
+        finally:
+            with self.lock:
+                self.reloading.discard((status_id, site_id))
+            connection.close()
+
+    def reload_in_background(self, status_id, site_id):
+        """
+        Start reloading the graph of one status on one site in a thread of
+        its own, unless it is being reloaded already.  Returns the thread,
+        or None.
+        """
+        with self.lock:
+            if (status_id, site_id) in self.reloading:
+                return None
+            self.reloading.add((status_id, site_id))
+        thread = threading.Thread(target=self._reload, args=(status_id, site_id))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def warm(self, statuses=None, site_id=None, chunk_size=50000):
+        """
+        Load the graphs of the given statuses, all of them by default, on
+        the given site, the current one by default.
+        """
+        from .models import RelationshipStatus
+
+        if statuses is None:
+            statuses = RelationshipStatus.objects.all()
+        for status in statuses:
+            self.load(getattr(status, 'pk', status), site_id or settings.SITE_ID, chunk_size)
+
+    def clear(self):
+        with self.lock:
+            self.graphs = {}
+            self.position = 0
+
+    def apply(self, action, from_id, to_id, status_id, site_id, expires_at=None):
+        expires = expires_at and _timestamp(expires_at)
+        with self.lock:
+            graph = self.graphs.get((status_id, site_id))
+            if graph is not None:
+                if action == 'add' and (expires is None or expires > time.time()):
+                    graph.add(from_id, to_id, expires)
+                else:
+                    graph.remove(from_id, to_id)
+
+    def apply_on_commit(self, action, from_id, to_id, status_id, site_id, expires_at=None):
+        """
+        :meth:`apply` a change once its transaction commits, so a rollback
+        never reaches the graph.  Without ``transaction.on_commit`` a change
+        made inside a transaction waits for the enclosing :meth:`committing`
+        block, or is left to the next catch up.
+        """
+        if not self.graphs:
+            return
+        change = (action, from_id, to_id, status_id, site_id, expires_at)
+        if hasattr(transaction, 'on_commit'):
+            transaction.on_commit(lambda: self.apply(*change))
+        elif not connection.in_atomic_block:
+            self.apply(*change)
+        elif getattr(self.local, 'pending', None) is not None:
+            self.local.pending.append(change)
+
+    @contextmanager
+    def committing(self):
+        """
+        Wrap a transaction whose changes :meth:`apply_on_commit` can't hook
+        the commit of: they are applied once the block exits, provided the
+        transaction was the outermost one and so has committed.  Nested
+        blocks leave their changes to the outermost.
+        """
+        if hasattr(transaction, 'on_commit') or getattr(self.local, 'pending', None) is not None:
+            yield
+            return
+        self.local.pending = []
+        try:
+            yield
+            pending = self.local.pending
+        finally:
+            self.local.pending = None
+        if not connection.in_atomic_block:
+            for change in pending:
+                self.apply(*change)
+
+    def catch_up(self):
+        """
+        Apply the events logged since the last catch up.  Applying an event
+        twice is harmless, so recent events are read again next time in case
+        older ones commit after them.
+        """
+        from .events import read_events
+
+        with self.lock:
+            settled = timezone.now() - datetime.timedelta(seconds=EVENT_LAG)
+            position = self.position
+            while True:
+                events = read_events(position, lag=0)
+                if not events:
+                    break
+                expiry = self._expiry(events)
+                for event in events:
+                    key = (event.from_user_id, event.to_user_id, event.status_id, event.site_id)
+                    self.apply(event.action, event.from_user_id, event.to_user_id,
+                               event.status_id, event.site_id, expiry.get(key))
+                    if event.created <= settled:
+                        self.position = event.id
+                position = events[-1].id
+            self.checked = time.time()
+
+    def get(self, status_id, site_id):
+        """
+        Returns the up to date graph of a status on a site, or None if the
+        engine is disabled or the graph is not loaded.
+        """
+        if not ENABLED:
+            return None
+        graph = self.graphs.get((status_id, site_id))
+        if graph is None:
+            return None
+        if MAX_AGE is not None and time.time() - graph.loaded > MAX_AGE:
+            self.reload_in_background(status_id, site_id)
+        if time.time() - self.checked > REFRESH:
+            self.catch_up()
+        next_expiry = graph.next_expiry()
+        if next_expiry is not None and next_expiry <= time.time():
+            with self.lock:
+                graph.expire(time.time())
+        return graph
+
+
+engine = GraphEngine()
+
+
+def relationship_saved(sender, instance, created, raw=False, **kwargs):
+    # saved again when its expiry changes
+    engine.apply_on_commit('add', instance.from_user_id, instance.to_user_id,
+                           instance.status_id, instance.site_id, instance.expires_at)
+
+
+def relationship_deleted(sender, instance, **kwargs):
+    engine.apply_on_commit('remove', instance.from_user_id, instance.to_user_id,
+                           instance.status_id, instance.site_id)
+
+
+def relationships_bulk_changed(sender, from_user_id, status_id, site_id, added,
+                               removed, **kwargs):
+    for to_id in added:
+        engine.apply_on_commit('add', from_user_id, to_id, status_id, site_id)
+    for to_id in removed:
+        engine.apply_on_commit('remove', from_user_id, to_id, status_id, site_id)
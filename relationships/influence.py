@@ -0,0 +1,169 @@
+"""
+Influence scores: PageRank over the "following" graph, computed offline.
+
+:func:`compute_influence` streams the relationships of one status on one site
+by keyset pages into two flat arrays of user indexes, runs a power iteration
+over them and replaces the site's :class:`~relationships.models.UserInfluence`
+rows with the result.  Scores are scaled so that the average user scores 1.0,
+users without any relationship of the status have no row.
+
+Each run starts from the stored scores, so a periodic recomputation after a
+day of changes converges in a few iterations instead of starting over.  When
+NumPy is installed the iterations are vectorized with ``bincount``, otherwise
+a pure Python loop over the same arrays is used, which is fine for small
+sites but much slower on large graphs.
+"""
+from array import array
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import transaction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .models import Relationship, RelationshipStatus, UserInfluence
+
+
+DAMPING = getattr(settings, 'RELATIONSHIPS_INFLUENCE_DAMPING', 0.85)
+TOLERANCE = getattr(settings, 'RELATIONSHIPS_INFLUENCE_TOLERANCE', 1e-6)
+MAX_ITERATIONS = getattr(settings, 'RELATIONSHIPS_INFLUENCE_MAX_ITERATIONS', 100)
+CHUNK_SIZE = getattr(settings, 'RELATIONSHIPS_INFLUENCE_CHUNK_SIZE', 50000)
+
+InfluenceReport = namedtuple('InfluenceReport', ['users', 'edges', 'iterations', 'delta'])
+
+
+def load_edges(status, site_id, chunk_size=CHUNK_SIZE):
+    """
+    Returns ``(from_ids, to_ids)``, two ``array('i')`` of the users on either
+    end of every relationship of ``status`` on the site, read ``chunk_size``
+    rows at a time.
+    """
+    qs = Relationship.objects.filter(status=status, site__pk=site_id).order_by('pk')
+    from_ids, to_ids = array('i'), array('i')
+    position = 0
+    while True:
+        rows = list(qs.filter(pk__gt=position).values_list(
+            'pk', 'from_user', 'to_user')[:chunk_size])
+        if not rows:
+            break
+        for pk, from_id, to_id in rows:
+            from_ids.append(from_id)
+            to_ids.append(to_id)
+        position = rows[-1][0]
+    return from_ids, to_ids
+
+
+def _index_edges(from_ids, to_ids):
+    """
+    Map the user ids of the edges to ``0..n-1``.  Returns the sorted user ids
+    and the edges as indexes into them.
+    """
+    if numpy is not None:
+        ids = numpy.concatenate([numpy.frombuffer(from_ids, dtype=numpy.intc),
+                                 numpy.frombuffer(to_ids, dtype=numpy.intc)])
+        user_ids, inverse = numpy.unique(ids, return_inverse=True)
+        return user_ids, inverse[:len(from_ids)], inverse[len(from_ids):]
+
+    user_ids = sorted(set(from_ids).union(to_ids))
+    index = dict((pk, i) for i, pk in enumerate(user_ids))
+    return (user_ids, array('i', [index[pk] for pk in from_ids]),
+            array('i', [index[pk] for pk in to_ids]))
+
+
+def _numpy_iterate(n, sources, targets, x, damping, tolerance, max_iterations):
+    x = numpy.asarray(x, dtype=float)
+    out_degree = numpy.bincount(sources, minlength=n).astype(float)
+    dangling = out_degree == 0
+    inverse_degree = numpy.zeros(n)
+    inverse_degree[~dangling] = 1.0 / out_degree[~dangling]
+
+    iteration, delta = 0, 0.0
+    for iteration in range(1, max_iterations + 1):
+        spread = numpy.bincount(targets, weights=(x * inverse_degree)[sources], minlength=n)
+        base = (damping * x[dangling].sum() + 1 - damping) / n
+        new = damping * spread + base
+        delta = float(numpy.abs(new - x).sum())
+        x = new
+        if delta < tolerance:
+            break
+    return x, iteration, delta
+
+
+def _python_iterate(n, sources, targets, x, damping, tolerance, max_iterations):
+    out_degree = [0] * n
+    for source in sources:
+        out_degree[source] += 1
+
+    iteration, delta = 0, 0.0
+    for iteration in range(1, max_iterations + 1):
+        share = [x[i] / degree if degree else 0.0 for i, degree in enumerate(out_degree)]
+        leaked = sum(x[i] for i, degree in enumerate(out_degree) if not degree)
+        spread = [0.0] * n
+        for source, target in zip(sources, targets):
+            spread[target] += share[source]
+        base = (damping * leaked + 1 - damping) / n
+        new = [damping * value + base for value in spread]
+        delta = sum(abs(a - b) for a, b in zip(new, x))
+        x = new
+        if delta < tolerance:
+            break
+    return x, iteration, delta
+
+
+def pagerank(user_ids, sources, targets, initial=None, damping=DAMPING,
+             tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    """
+    Power iteration over the edges ``sources[i] -> targets[i]`` between the
+    users ``user_ids``.  ``initial`` is an optional dict of previous scores by
+    user id to start from.  Returns ``(scores, iterations, delta)`` where the
+    scores sum to 1 and ``delta`` is the L1 change of the last iteration.
+    """
+    n = len(user_ids)
+    if not n:
+        return [], 0, 0.0
+
+    initial = initial or {}
+    x = [initial.get(pk, 1.0) for pk in user_ids]
+    total = sum(x) or n
+    x = [value / total for value in x]
+
+    iterate = _numpy_iterate if numpy is not None else _python_iterate
+    return iterate(n, sources, targets, x, damping, tolerance, max_iterations)
+
+
+def compute_influence(status=None, site_id=None, damping=DAMPING, tolerance=TOLERANCE,
+                      max_iterations=MAX_ITERATIONS, chunk_size=CHUNK_SIZE,
+                      warm_start=True, batch_size=1000):
+    """
+    Recompute the influence scores of the users of a site, the current one by
+    default, from their relationships of ``status``, "following" by default.
+    With ``warm_start`` the iteration starts from the stored scores.
+    Returns an ``InfluenceReport``.
+    """
+    if not status:
+        status = RelationshipStatus.objects.following()
+    site_id = site_id or settings.SITE_ID
+
+    from_ids, to_ids = load_edges(status, site_id, chunk_size)
+    user_ids, sources, targets = _index_edges(from_ids, to_ids)
+
+    initial = None
+    if warm_start:
+        initial = dict(UserInfluence.objects.filter(
+            site__pk=site_id).values_list('user', 'score'))
+
+    scores, iterations, delta = pagerank(user_ids, sources, targets, initial,
+                                         damping, tolerance, max_iterations)
+
+    n = len(user_ids)
+    with transaction.atomic():
+        UserInfluence.objects.filter(site__pk=site_id).delete()
+        UserInfluence.objects.bulk_create([
+            UserInfluence(user_id=int(pk), site_id=site_id, score=float(score) * n)
+            for pk, score in zip(user_ids, scores)
+        ], batch_size=batch_size)
+
+    return InfluenceReport(n, len(from_ids), iterations, delta)
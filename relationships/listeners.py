@@ -1,6 +1,7 @@
 from django.db.models import signals
 
 from .models import RelationshipStatus, Relationship
+from .signals import bulk_relationships_changed
 
 
 def mutually_exclusive_fix(sender, instance, created, **kwargs):
@@ -32,12 +33,44 @@ def mutually_exclusive_fix(sender, instance, created, **kwargs):
             ).delete()
 
 
+def mutually_exclusive_bulk_fix(sender, from_user_id, status_id, site_id, added,
+                                batch_size=1000, **kwargs):
+    # the same for the relationships added by RelationshipManager.sync(),
+    # which sends no post_save for them
+    try:
+        following = RelationshipStatus.objects.following()
+        blocking = RelationshipStatus.objects.blocking()
+    except RelationshipStatus.DoesNotExist:
+        pass
+    else:
+        other = None
+        if status_id == following.pk:
+            other = blocking
+        elif status_id == blocking.pk:
+            other = following
+
+        if other and added:
+            added = list(added)
+            for i in range(0, len(added), batch_size):
+                Relationship.objects.filter(
+                    from_user=from_user_id,
+                    to_user__in=added[i:i + batch_size],
+                    site=site_id,
+                    status=other
+                ).delete()
+
+
 DISPATCH_UID = 'relationships.listeners.exclusive_fix'
 
 
-def attach_relationship_listener(func=mutually_exclusive_fix, dispatch_uid=DISPATCH_UID):
+def attach_relationship_listener(func=mutually_exclusive_fix, dispatch_uid=DISPATCH_UID,
+                                 bulk_func=mutually_exclusive_bulk_fix):
     signals.post_save.connect(func, sender=Relationship, dispatch_uid=dispatch_uid)
+    if bulk_func is not None:
+        bulk_relationships_changed.connect(bulk_func, sender=Relationship,
+                                           dispatch_uid=dispatch_uid)
 
 
 def detach_relationship_listener(dispatch_uid=DISPATCH_UID):
     signals.post_save.disconnect(sender=Relationship, dispatch_uid=dispatch_uid)
+    bulk_relationships_changed.disconnect(sender=Relationship, dispatch_uid=dispatch_uid)
@@ -0,0 +1,24 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from relationships.models import RelationshipRollup
+
+
+class Command(BaseCommand):
+    help = 'Fill the relationship rollup tables from existing relationships'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=5000,
+            help='Number of relationships read per query'),
+        make_option('--reset', action='store_true', default=False,
+            help='Zero the added counters and recount every existing relationship, '
+                 'removed counters are kept'),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        processed = RelationshipRollup.objects.backfill(options['chunk_size'],
+                                                        options['reset'])
+        self.stdout.write('Rolled up %d relationships in %.2fs\n' % (processed, time.time() - start))
@@ -0,0 +1,51 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from relationships import influence
+from relationships.models import RelationshipStatus
+
+
+class Command(BaseCommand):
+    help = 'Recompute the influence score of every user from the relationship graph'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--status', dest='status_slug', default=None,
+            help='Score relationships with this status slug (default following)'),
+        make_option('--damping', type='float', default=influence.DAMPING,
+            help='Probability of following a relationship rather than jumping (default %s)' % influence.DAMPING),
+        make_option('--tolerance', type='float', default=influence.TOLERANCE,
+            help='Stop once the scores change by less than this (default %s)' % influence.TOLERANCE),
+        make_option('--max-iterations', type='int', default=influence.MAX_ITERATIONS,
+            help='Stop after this many iterations (default %s)' % influence.MAX_ITERATIONS),
+        make_option('--chunk-size', type='int', default=influence.CHUNK_SIZE,
+            help='Number of relationships read per query'),
+        make_option('--cold', action='store_true', default=False,
+            help='Start from uniform scores instead of the stored ones'),
+    )
+
+    def handle(self, *args, **options):
+        if not 0 < options['damping'] < 1:
+            raise CommandError('--damping must be between 0 and 1')
+
+        status = None
+        if options['status_slug']:
+            try:
+                status = RelationshipStatus.objects.by_slug(options['status_slug'])
+            except RelationshipStatus.DoesNotExist:
+                raise CommandError('Unknown status "%s"' % options['status_slug'])
+
+        start = time.time()
+        report = influence.compute_influence(
+            status,
+            damping=options['damping'],
+            tolerance=options['tolerance'],
+            max_iterations=options['max_iterations'],
+            chunk_size=options['chunk_size'],
+            warm_start=not options['cold'],
+        )
+        self.stdout.write('Scored %d users over %d relationships in %d iterations '
+                          '(last change %.2g) in %.2fs\n' % (
+                              report.users, report.edges, report.iterations,
+                              report.delta, time.time() - start))
@@ -0,0 +1,40 @@
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from relationships.models import RelationshipStatus
+from relationships.weights import decay_weights
+
+
+class Command(BaseCommand):
+    help = 'Decay the weight of every relationship by a constant factor'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--factor', type='float', default=0.95,
+            help='Multiply each weight by this factor (default 0.95)'),
+        make_option('--status', dest='status_slug', default=None,
+            help='Only decay relationships with this status slug'),
+        make_option('--chunk-size', type='int', default=10000,
+            help='Number of primary keys covered by each UPDATE'),
+        make_option('--processes', type='int', default=multiprocessing.cpu_count(),
+            help='Number of worker processes'),
+    )
+
+    def handle(self, *args, **options):
+        factor = options['factor']
+        if not 0 <= factor <= 1:
+            raise CommandError('--factor must be between 0 and 1')
+
+        status = None
+        if options['status_slug']:
+            try:
+                status = RelationshipStatus.objects.by_slug(options['status_slug'])
+            except RelationshipStatus.DoesNotExist:
+                raise CommandError('Unknown status "%s"' % options['status_slug'])
+
+        start = time.time()
+        updated = decay_weights(factor, status, options['chunk_size'],
+                                options['processes'])
+        self.stdout.write('Decayed %d relationships in %.2fs\n' % (updated, time.time() - start))
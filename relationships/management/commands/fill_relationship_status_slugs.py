@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from relationships.models import RelationshipStatusSlug
+
+
+class Command(BaseCommand):
+    help = 'Register the slugs of every relationship status'
+
+    def handle(self, *args, **options):
+        registered = RelationshipStatusSlug.objects.fill()
+        self.stdout.write('Registered %d relationship status slugs\n' % registered)
@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from relationships.privacy import invalidate_private_user_ids, verify_private_user_ids
+
+
+class Command(BaseCommand):
+    help = ('Compare the private user set with the profile table, then rebuild '
+            'cached user lists and private user sets, e.g. after profiles were '
+            'updated in bulk without sending signals')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=10000,
+            help='Number of profiles read per query'),
+    )
+
+    def handle(self, *args, **options):
+        missing, extra = verify_private_user_ids(options['batch_size'])
+        self.stdout.write('Private users missing from the set: %s\n' % _ids(missing))
+        self.stdout.write('Users wrongly in the set: %s\n' % _ids(extra))
+        invalidate_private_user_ids()
+        self.stdout.write('Privacy version bumped, cached lists will be rebuilt\n')
+
+
+def _ids(user_ids):
+    return ', '.join(str(pk) for pk in sorted(user_ids)) or 'none'
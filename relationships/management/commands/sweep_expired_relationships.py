@@ -0,0 +1,25 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from relationships.expiry import sweep_expired
+
+
+class Command(BaseCommand):
+    help = 'Delete relationships whose expiry has passed'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+            help='Number of relationships deleted per transaction'),
+        make_option('--max-batches', type='int', default=None,
+            help='Stop after this many batches, the rest are left for the next run'),
+        make_option('--pause', type='float', default=0,
+            help='Seconds to sleep between batches'),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        deleted = sweep_expired(options['batch_size'], options['max_batches'],
+                                options['pause'])
+        self.stdout.write('Deleted %d expired relationships in %.2fs\n' % (deleted, time.time() - start))
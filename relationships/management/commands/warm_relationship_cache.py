@@ -0,0 +1,51 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from relationships import warm
+from relationships.models import RelationshipStatus
+
+
+class Command(BaseCommand):
+    help = 'Fill the relationship cache for the most followed or most active users'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=1000,
+            help='Number of users to warm (default 1000)'),
+        make_option('--by', choices=(warm.BY_FOLLOWERS, warm.BY_RECENT), default=warm.BY_FOLLOWERS,
+            help='Rank users by "followers" or by followers gained "recent"ly (default followers)'),
+        make_option('--days', type='int', default=7,
+            help='Days of activity considered with --by recent (default 7)'),
+        make_option('--status', dest='status_slug', default=None,
+            help='Rank users by relationships with this status slug (default following)'),
+        make_option('--batch-size', type='int', default=500,
+            help='Number of users loaded per round of queries'),
+        make_option('--threads', type='int', default=8,
+            help='Number of threads writing to the cache'),
+        make_option('--no-views', action='store_false', dest='views', default=True,
+            help='Do not render the follower and following list views'),
+    )
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--threads and --batch-size must be positive')
+
+        status = None
+        if options['status_slug']:
+            try:
+                status = RelationshipStatus.objects.by_slug(options['status_slug'])
+            except RelationshipStatus.DoesNotExist:
+                raise CommandError('Unknown status "%s"' % options['status_slug'])
+
+        start = time.time()
+        user_ids = warm.hot_users(options['limit'], options['by'], status, options['days'])
+        select_time = time.time() - start
+
+        report = warm.warm_users(user_ids, batch_size=options['batch_size'],
+                                 threads=options['threads'], views=options['views'])
+        self.stdout.write('Warmed %d keys for %d users in %.2fs '
+                          '(select %.2fs, load %.2fs, fill %.2fs)\n' % (
+                              report.keys, report.users,
+                              select_time + report.load_time + report.fill_time,
+                              select_time, report.load_time, report.fill_time))
@@ -0,0 +1,62 @@
+"""
+A per-thread memo of relationship checks, so a page asking the same question
+about the same pair of users many times only hits the database once.
+
+The memo is only active inside :func:`relationship_memo` (or for the length
+of a request with :class:`relationships.middleware.RelationshipMemoMiddleware`)
+and is emptied whenever a relationship is saved or deleted.
+"""
+import threading
+from contextlib import contextmanager
+
+
+_local = threading.local()
+
+# distinguishes a memoized falsy value from a miss
+MISSING = object()
+
+
+def start():
+    _local.memo = {}
+
+
+def stop():
+    _local.memo = None
+
+
+def lookup(key):
+    memo = getattr(_local, 'memo', None)
+    if memo is None:
+        return MISSING
+    return memo.get(key, MISSING)
+
+
+def remember(key, value):
+    memo = getattr(_local, 'memo', None)
+    if memo is not None:
+        memo[key] = value
+
+
+def clear(*args, **kwargs):
+    """
+    Forget everything memoized so far, usable as a signal receiver.
+    """
+    memo = getattr(_local, 'memo', None)
+    if memo is not None:
+        memo.clear()
+
+
+@contextmanager
+def relationship_memo():
+    """
+    Memoize relationship checks made inside the block.  Nested blocks share
+    the outermost memo.
+    """
+    if getattr(_local, 'memo', None) is not None:
+        yield
+        return
+    start()
+    try:
+        yield
+    finally:
+        stop()
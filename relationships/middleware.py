@@ -0,0 +1,18 @@
+from . import memo
+
+
+class RelationshipMemoMiddleware(object):
+    """
+    Memoize relationship checks for the duration of each request, so that
+    e.g. a template calling ``{% if_relationship %}`` repeatedly for the same
+    pair of users only runs one query.
+    """
+    def process_request(self, request):
+        memo.start()
+
+    def process_response(self, request, response):
+        memo.stop()
+        return response
+
+    def process_exception(self, request, exception):
+        memo.stop()
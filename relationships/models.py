@@ -1,11 +1,49 @@
+import datetime
+from array import array
+from collections import defaultdict, namedtuple
+from importlib import import_module
+
 import django
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+try:
+    from django.contrib.contenttypes.fields import GenericForeignKey
+except ImportError:
+    from django.contrib.contenttypes.generic import GenericForeignKey
 from django.contrib.sites.models import Site
-from django.db import models, connection
+from django.core.cache import cache
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import signals
+from django.utils import timezone
 from django.db.models.fields.related import create_many_related_manager, ManyToManyRel
 from django.utils.translation import ugettext_lazy as _
 
+from . import graph, memo
+from .cache import (CACHE_TIMEOUT, generic_relationship_changed, get_relationship_version,
+    relationship_changed, relationships_bulk_changed, timeout_until)
+from .privacy import (exclude_private, get_profile_model, privacy_version,
+    private_user_ids, profile_deleted, profile_saved, profile_saving)
+from .signals import bulk_relationships_changed
+
+
+# how following(), followers() and the other user lists load related rows
+# unless told otherwise, e.g. ('user_profile',) so that rendering a page of
+# avatars costs no query per user
+LIST_SELECT_RELATED = getattr(settings, 'RELATIONSHIPS_LIST_SELECT_RELATED', ())
+LIST_PREFETCH_RELATED = getattr(settings, 'RELATIONSHIPS_LIST_PREFETCH_RELATED', ())
+LIST_ONLY = getattr(settings, 'RELATIONSHIPS_LIST_ONLY', ())
+
+# id sets longer than this are not cached, only their length is
+CACHE_MAX_IDS = getattr(settings, 'RELATIONSHIPS_CACHE_MAX_IDS', 10000)
+
+SLUG_REGISTRY_KEY = 'relationships:slug-registry'
+
+# checkpoints of the relationships counted by the rollup signal handlers and
+# by the backfill
+ROLLUP_HIGH_WATER = 'relationships.rollups.high-water'
+ROLLUP_BACKFILLED = 'relationships.rollups.backfilled'
+
 
 class RelationshipStatusManager(models.Manager):
     # convenience methods to handle some default statuses
@@ -16,11 +54,27 @@ class RelationshipStatusManager(models.Manager):
         return self.get(from_slug='blocking')
 
     def by_slug(self, status_slug):
-        return self.get(
+        return self.resolve_slug(status_slug)[0]
+
+    def resolve_slug(self, status_slug):
+        """
+        Returns a ``(status, direction)`` tuple for a slug, where direction is
+        one of 'from', 'to' or 'symmetrical'.  Raises DoesNotExist if no
+        status uses the slug.
+        """
+        registry = RelationshipStatusSlug.objects.registry()
+        if status_slug in registry:
+            return registry[status_slug]
+
+        # statuses saved before the registry existed are not in it until the
+        # fill_relationship_status_slugs command has run
+        status = self.get(
             models.Q(from_slug=status_slug) |
             models.Q(to_slug=status_slug) |
             models.Q(symmetrical_slug=status_slug)
         )
+        RelationshipStatusSlug.objects.sync(status)
+        return status, status.slug_direction(status_slug)
 
 
 class RelationshipStatus(models.Model):
@@ -47,6 +101,103 @@ class RelationshipStatus(models.Model):
     def __unicode__(self):
         return self.name
 
+    def slug_direction(self, slug):
+        for direction in RelationshipStatusSlug.DIRECTIONS:
+            if getattr(self, '%s_slug' % direction) == slug:
+                return direction
+
+
+class RelationshipStatusSlugManager(models.Manager):
+    def registry(self):
+        """
+        Returns a dictionary mapping every slug to a ``(status, direction)``
+        tuple, loaded with one query and cached until a status changes.
+        """
+        registry = cache.get(SLUG_REGISTRY_KEY)
+        if registry is None:
+            registry = dict(
+                (entry.slug, (entry.status, entry.direction))
+                for entry in self.select_related('status')
+            )
+            cache.set(SLUG_REGISTRY_KEY, registry, CACHE_TIMEOUT)
+        return registry
+
+    def sync(self, status):
+        """
+        Make the registry entries of ``status`` match its slugs.  A slug
+        already registered to another status is left to that status.
+        """
+        # reversed so that a slug used twice keeps its first direction, as
+        # slug_direction() would find it
+        slugs = dict(
+            (getattr(status, '%s_slug' % direction), direction)
+            for direction in reversed(RelationshipStatusSlug.DIRECTIONS)
+        )
+        try:
+            with transaction.atomic():
+                self.filter(status=status).delete()
+                taken = set(self.filter(slug__in=slugs.keys()).values_list('slug', flat=True))
+                self.bulk_create([
+                    RelationshipStatusSlug(slug=slug, status=status, direction=direction)
+                    for slug, direction in slugs.items()
+                    if slug and slug not in taken
+                ])
+        except IntegrityError:
+            # a concurrent sync registered the slugs first, its rows stand
+            # and are read back with the registry below
+            pass
+        cache.delete(SLUG_REGISTRY_KEY)
+
+    def fill(self):
+        """
+        Register the slugs of every status, e.g. those created before the
+        registry existed.  Returns the number of slugs registered.
+        """
+        for status in RelationshipStatus.objects.all():
+            self.sync(status)
+        return self.count()
+
+
+class RelationshipStatusSlug(models.Model):
+    """
+    Every slug of every status in one uniquely indexed column, so a slug is
+    resolved to its status and direction without scanning the three slug
+    columns of :class:`RelationshipStatus`.
+    """
+    FROM = 'from'
+    TO = 'to'
+    SYMMETRICAL = 'symmetrical'
+    DIRECTIONS = (FROM, TO, SYMMETRICAL)
+    DIRECTION_CHOICES = (
+        (FROM, _('from')),
+        (TO, _('to')),
+        (SYMMETRICAL, _('symmetrical')),
+    )
+
+    slug = models.CharField(_('slug'), max_length=100, unique=True)
+    status = models.ForeignKey(RelationshipStatus, related_name='slugs',
+        verbose_name=_('status'))
+    direction = models.CharField(_('direction'), max_length=11,
+        choices=DIRECTION_CHOICES)
+
+    objects = RelationshipStatusSlugManager()
+
+    class Meta:
+        verbose_name = _('Relationship status slug')
+        verbose_name_plural = _('Relationship status slugs')
+
+    def __unicode__(self):
+        return self.slug
+
+
+def relationship_status_saved(sender, instance, **kwargs):
+    # fixtures are loaded raw, their statuses are registered all the same
+    RelationshipStatusSlug.objects.sync(instance)
+
+
+def relationship_status_deleted(sender, instance, **kwargs):
+    cache.delete(SLUG_REGISTRY_KEY)
+
 
 class Relationship(models.Model):
     from_user = models.ForeignKey(User,
@@ -58,9 +209,16 @@ class Relationship(models.Model):
     weight = models.FloatField(_('weight'), default=1.0, blank=True, null=True)
     site = models.ForeignKey(Site, default=settings.SITE_ID,
         verbose_name=_('site'), related_name='relationships')
+    expires_at = models.DateTimeField(_('expires at'), blank=True, null=True,
+        db_index=True, help_text=_('The relationship is hidden from this time on'))
 
     class Meta:
         unique_together = (('from_user', 'to_user', 'status', 'site'),)
+        index_together = (
+            ('from_user', 'status', 'site', 'weight', 'to_user', 'expires_at'),
+            ('to_user', 'status', 'site', 'from_user'),
+            ('status', 'site', 'id'),
+        )
         ordering = ('created',)
         verbose_name = _('Relationship')
         verbose_name_plural = _('Relationships')
@@ -70,16 +228,647 @@ class Relationship(models.Model):
                 % {'from_user': self.from_user.username,
                    'to_user': self.to_user.username})
 
+
+class GenericRelationshipManager(models.Manager):
+    def for_target(self, obj, status=None):
+        """
+        The relationships of ``status``, "following" by default, to ``obj``
+        on the current site.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+        return self.filter(
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.pk,
+            status=status,
+            site__pk=settings.SITE_ID,
+        )
+
+    def followers_of(self, obj, status=None, **loading):
+        """
+        Returns a QuerySet of the users with a relationship to ``obj``,
+        loaded as :func:`load_related` describes.
+        """
+        user_ids = self.for_target(obj, status).values('from_user')
+        # WHY: gdpr compliance.
+        return load_related(exclude_private(User.objects.filter(pk__in=user_ids)),
+                            **loading)
+
+    def resolve_targets(self, relationships):
+        """
+        Load the targets of ``relationships``, which may point at any mix of
+        models, with one ``in_bulk`` query per content type, so reading
+        ``target`` afterwards costs nothing.  Targets which no longer exist
+        are set to None.  Returns the relationships as a list.
+        """
+        relationships = list(relationships)
+        object_ids = defaultdict(set)
+        for relationship in relationships:
+            object_ids[relationship.content_type_id].add(relationship.object_id)
+
+        targets = {}
+        for content_type_id, ids in object_ids.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is None:
+                continue
+            for pk, obj in model._default_manager.in_bulk(list(ids)).items():
+                targets[(content_type_id, pk)] = obj
+
+        cache_attr = GenericRelationship.target.cache_attr
+        for relationship in relationships:
+            setattr(relationship, cache_attr, targets.get(
+                (relationship.content_type_id, relationship.object_id)))
+        return relationships
+
+
+class GenericRelationship(models.Model):
+    """
+    A relationship from a user to an object of any model, e.g. following a
+    page or a group.
+    """
+    from_user = models.ForeignKey(User,
+        related_name='generic_relationships', verbose_name=_('from user'))
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    object_id = models.PositiveIntegerField(_('object id'))
+    target = GenericForeignKey('content_type', 'object_id')
+    status = models.ForeignKey(RelationshipStatus, verbose_name=_('status'))
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    site = models.ForeignKey(Site, default=settings.SITE_ID,
+        verbose_name=_('site'), related_name='generic_relationships')
+
+    objects = GenericRelationshipManager()
+
+    class Meta:
+        # the unique index serves "what does this user follow", the other
+        # one "who follows this object" without touching the table
+        unique_together = (('from_user', 'status', 'site', 'content_type', 'object_id'),)
+        index_together = (('content_type', 'object_id', 'status', 'site', 'from_user'),)
+        ordering = ('created',)
+        verbose_name = _('Generic relationship')
+        verbose_name_plural = _('Generic relationships')
+
+    def __unicode__(self):
+        return u'%s -> %s:%s' % (self.from_user_id, self.content_type_id, self.object_id)
+
+
+def unexpired(prefix=''):
+    """
+    A ``Q`` matching relationships without an expiry or which have yet to
+    reach it, ``prefix`` being the lookup path to the relationship.
+    """
+    return (models.Q(**{'%sexpires_at__isnull' % prefix: True}) |
+            models.Q(**{'%sexpires_at__gt' % prefix: timezone.now()}))
+
+
+def _expiry(expires):
+    if isinstance(expires, datetime.timedelta):
+        return timezone.now() + expires
+    return expires
+
+
+class RelationshipRollupManager(models.Manager):
+    def __init__(self):
+        super(RelationshipRollupManager, self).__init__()
+        # whether this process has recorded the rollup high-water mark
+        self._marked = False
+
+    def _increment(self, key, added, removed):
+        qs = self.filter(**key)
+        updates = dict(added=models.F('added') + added,
+                       removed=models.F('removed') + removed)
+        if qs.update(**updates):
+            return
+        try:
+            with transaction.atomic():
+                self.create(added=added, removed=removed, **key)
+        except IntegrityError:
+            # somebody else created the row in the meantime
+            qs.update(**updates)
+
+    def _buckets(self, when):
+        if timezone.is_aware(when):
+            when = timezone.make_naive(when, timezone.utc)
+        hour = when.replace(minute=0, second=0, microsecond=0)
+        buckets = (
+            (RelationshipRollup.HOUR, hour),
+            (RelationshipRollup.DAY, hour.replace(hour=0)),
+        )
+        for resolution, bucket in buckets:
+            if settings.USE_TZ:
+                bucket = timezone.make_aware(bucket, timezone.utc)
+            yield resolution, bucket
+
+    def record(self, user_id, status_id, site_id, when, added=0, removed=0):
+        """
+        Add to the counters of the day and hour buckets containing ``when``
+        for the given user, status and site.
+        """
+        for resolution, bucket in self._buckets(when):
+            self._increment(dict(
+                user_id=user_id,
+                status_id=status_id,
+                site_id=site_id,
+                resolution=resolution,
+                bucket=bucket,
+            ), added, removed)
+
+    def record_many(self, user_ids, status_id, site_id, when, added=0, removed=0,
+                    batch_size=500):
+        """
+        :meth:`record` for many users at once, with one UPDATE and one INSERT
+        per bucket for every ``batch_size`` users.
+        """
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), batch_size):
+            batch = user_ids[i:i + batch_size]
+            for resolution, bucket in self._buckets(when):
+                key = dict(status_id=status_id, site_id=site_id,
+                           resolution=resolution, bucket=bucket)
+                existing = set(self.filter(user__in=batch, **key).values_list('user', flat=True))
+                if existing:
+                    self.filter(user__in=existing, **key).update(
+                        added=models.F('added') + added,
+                        removed=models.F('removed') + removed)
+
+                missing = [pk for pk in batch if pk not in existing]
+                try:
+                    with transaction.atomic():
+                        self.bulk_create([
+                            RelationshipRollup(user_id=pk, added=added, removed=removed, **key)
+                            for pk in missing
+                        ])
+                except IntegrityError:
+                    # somebody else created some of the rows in the meantime
+                    for pk in missing:
+                        self._increment(dict(user_id=pk, **key), added, removed)
+
+    def series(self, user, status=None, resolution='day', since=None, until=None):
+        """
+        Returns a list of ``(bucket, added, removed)`` tuples describing how
+        the number of users with a relationship of the given status to
+        ``user`` changed over time, oldest bucket first.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+
+        qs = self.filter(
+            user=user,
+            status=status,
+            site__pk=settings.SITE_ID,
+            resolution=resolution,
+        )
+        if since:
+            qs = qs.filter(bucket__gte=since)
+        if until:
+            qs = qs.filter(bucket__lt=until)
+
+        return list(qs.order_by('bucket').values_list('bucket', 'added', 'removed'))
+
+    def mark_counted(self, pk):
+        """
+        Record that the signal handlers count relationships from ``pk`` on,
+        so :meth:`backfill` leaves them alone.  Only the first relationship
+        counted by each process matters, later ones have higher ids.
+        """
+        if self._marked:
+            return
+        checkpoints = RelationshipEventCheckpoint.objects
+        checkpoint, created = checkpoints.get_or_create(
+            name=ROLLUP_HIGH_WATER, defaults={'position': pk - 1})
+        if not created and checkpoint.position >= pk:
+            checkpoints.filter(name=ROLLUP_HIGH_WATER, position__gte=pk).update(position=pk - 1)
+        self._marked = True
+
+    def backfill(self, chunk_size=5000, reset=False):
+        """
+        Add the relationships created before the signal handlers started
+        counting to the ``added`` counters, streaming them in primary key
+        order ``chunk_size`` rows at a time.  Only relationships up to the
+        high-water mark recorded by :meth:`mark_counted` are read, and the
+        progress is saved with every chunk, so each relationship is counted
+        once however often the backfill runs or is interrupted.
+
+        ``reset`` zeroes the ``added`` counters and recounts every existing
+        relationship instead, e.g. after the counters were damaged.  The
+        ``removed`` counters cannot be rebuilt from the table and are kept.
+        Run it while relationships are not being changed.  Returns the
+        number of relationships processed.
+        """
+        checkpoints = RelationshipEventCheckpoint.objects
+        with transaction.atomic():
+            last_pk = Relationship.objects.aggregate(last=models.Max('pk'))['last'] or 0
+            if reset:
+                self.all().update(added=0)
+                checkpoints.filter(name=ROLLUP_HIGH_WATER).update(position=last_pk)
+                checkpoints.filter(name=ROLLUP_BACKFILLED).update(position=0)
+            high_water = checkpoints.get_or_create(
+                name=ROLLUP_HIGH_WATER, defaults={'position': last_pk})[0].position
+            position = checkpoints.get_or_create(name=ROLLUP_BACKFILLED)[0].position
+
+        processed = 0
+        while True:
+            rows = list(Relationship.objects.filter(
+                pk__gt=position,
+                pk__lte=high_water,
+            ).order_by('pk').values_list('pk', 'to_user', 'status', 'site', 'created')[:chunk_size])
+            if not rows:
+                break
+
+            counts = {}
+            for pk, user_id, status_id, site_id, created in rows:
+                if timezone.is_aware(created):
+                    created = timezone.make_naive(created, timezone.utc)
+                key = (user_id, status_id, site_id,
+                       created.replace(minute=0, second=0, microsecond=0))
+                counts[key] = counts.get(key, 0) + 1
+
+            position = rows[-1][0]
+            with transaction.atomic():
+                for (user_id, status_id, site_id, hour), count in counts.items():
+                    if settings.USE_TZ:
+                        hour = timezone.make_aware(hour, timezone.utc)
+                    self.record(user_id, status_id, site_id, hour, added=count)
+                checkpoints.filter(name=ROLLUP_BACKFILLED).update(position=position)
+            processed += len(rows)
+
+        return processed
+
+
+class RelationshipRollup(models.Model):
+    """
+    Per-user counters of relationships gained and lost, bucketed by day and
+    by hour, so growth dashboards never have to aggregate the relationships
+    themselves.
+    """
+    DAY = 'day'
+    HOUR = 'hour'
+    RESOLUTION_CHOICES = (
+        (DAY, _('day')),
+        (HOUR, _('hour')),
+    )
+
+    user = models.ForeignKey(User,
+        related_name='relationship_rollups', verbose_name=_('user'))
+    status = models.ForeignKey(RelationshipStatus, verbose_name=_('status'))
+    site = models.ForeignKey(Site,
+        verbose_name=_('site'), related_name='relationship_rollups')
+    resolution = models.CharField(_('resolution'), max_length=4,
+        choices=RESOLUTION_CHOICES)
+    bucket = models.DateTimeField(_('bucket'))
+    added = models.PositiveIntegerField(_('added'), default=0)
+    removed = models.PositiveIntegerField(_('removed'), default=0)
+
+    objects = RelationshipRollupManager()
+
+    class Meta:
+        unique_together = (('user', 'status', 'site', 'resolution', 'bucket'),)
+        ordering = ('bucket',)
+        verbose_name = _('Relationship rollup')
+        verbose_name_plural = _('Relationship rollups')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.user_id, self.bucket)
+
+
+class RelationshipEventManager(models.Manager):
+    def record(self, action, from_user_id, to_user_ids, status_id, site_id):
+        self.bulk_create([
+            RelationshipEvent(action=action, from_user_id=from_user_id,
+                              to_user_id=to_user_id, status_id=status_id,
+                              site_id=site_id)
+            for to_user_id in to_user_ids
+        ])
+
+
+class RelationshipEvent(models.Model):
+    """
+    An append-only log of relationships being added and removed, written in
+    the same transaction as the change.  The ids are plain integers so the
+    log outlives the users and statuses it mentions.  See
+    :mod:`relationships.events` for reading it.
+    """
+    ADDED = 'add'
+    REMOVED = 'remove'
+    ACTION_CHOICES = (
+        (ADDED, _('added')),
+        (REMOVED, _('removed')),
+    )
+
+    action = models.CharField(_('action'), max_length=6, choices=ACTION_CHOICES)
+    from_user_id = models.IntegerField(_('from user'))
+    to_user_id = models.IntegerField(_('to user'))
+    status_id = models.IntegerField(_('status'))
+    site_id = models.IntegerField(_('site'))
+    created = models.DateTimeField(_('created'), default=timezone.now)
+
+    objects = RelationshipEventManager()
+
+    class Meta:
+        ordering = ('id',)
+        verbose_name = _('Relationship event')
+        verbose_name_plural = _('Relationship events')
+
+    def __unicode__(self):
+        return u'%s %s %s %s' % (self.from_user_id, self.action, self.to_user_id,
+                                 self.status_id)
+
+
+class RelationshipEventCheckpoint(models.Model):
+    """
+    How far a named consumer has read the :class:`RelationshipEvent` log.
+    """
+    name = models.CharField(_('name'), max_length=100, unique=True)
+    position = models.IntegerField(_('position'), default=0)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Relationship event checkpoint')
+        verbose_name_plural = _('Relationship event checkpoints')
+
+    def __unicode__(self):
+        return u'%s @ %s' % (self.name, self.position)
+
+
+class UserInfluence(models.Model):
+    """
+    A user's influence on a site, as last computed by
+    :func:`relationships.influence.compute_influence`.
+    """
+    user = models.ForeignKey(User,
+        related_name='influence_scores', verbose_name=_('user'))
+    site = models.ForeignKey(Site,
+        verbose_name=_('site'), related_name='user_influence')
+    score = models.FloatField(_('score'), db_index=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+
+    class Meta:
+        unique_together = (('user', 'site'),)
+        index_together = (('site', 'score'),)
+        verbose_name = _('User influence')
+        verbose_name_plural = _('User influence')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.user_id, self.score)
+
+
+def relationship_added_event(sender, instance, created, raw=False, update_fields=None,
+                             **kwargs):
+    # a new expiry is logged as the relationship being added again, so that
+    # readers of the log learn of it
+    if not raw and (created or 'expires_at' in (update_fields or ())):
+        RelationshipEvent.objects.create(
+            action=RelationshipEvent.ADDED,
+            from_user_id=instance.from_user_id,
+            to_user_id=instance.to_user_id,
+            status_id=instance.status_id,
+            site_id=instance.site_id,
+        )
+
+
+def relationship_removed_event(sender, instance, **kwargs):
+    RelationshipEvent.objects.create(
+        action=RelationshipEvent.REMOVED,
+        from_user_id=instance.from_user_id,
+        to_user_id=instance.to_user_id,
+        status_id=instance.status_id,
+        site_id=instance.site_id,
+    )
+
+
+def relationships_bulk_event(sender, from_user_id, status_id, site_id, added,
+                             removed, renewed=(), **kwargs):
+    # the expiry of a renewed relationship, which no sweep will delete now
+    RelationshipEvent.objects.record(RelationshipEvent.REMOVED, from_user_id,
+                                     renewed, status_id, site_id)
+    RelationshipEvent.objects.record(RelationshipEvent.ADDED, from_user_id,
+                                     added, status_id, site_id)
+    RelationshipEvent.objects.record(RelationshipEvent.REMOVED, from_user_id,
+                                     removed, status_id, site_id)
+
+
+def relationship_added_rollup(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        RelationshipRollup.objects.mark_counted(instance.pk)
+        RelationshipRollup.objects.record(instance.to_user_id, instance.status_id,
+                                          instance.site_id, instance.created, added=1)
+
+
+def relationship_removed_rollup(sender, instance, **kwargs):
+    RelationshipRollup.objects.record(instance.to_user_id, instance.status_id,
+                                      instance.site_id, timezone.now(), removed=1)
+
+
+def relationships_bulk_rollup(sender, from_user_id, status_id, site_id, added,
+                              removed, renewed=(), **kwargs):
+    now = timezone.now()
+    created = sorted(set(added) - set(renewed))
+    if created and not RelationshipRollup.objects._marked:
+        first = Relationship.objects.filter(
+            from_user=from_user_id, to_user__in=created, status=status_id, site=site_id,
+        ).aggregate(first=models.Min('pk'))['first']
+        if first is not None:
+            RelationshipRollup.objects.mark_counted(first)
+    RelationshipRollup.objects.record_many(added, status_id, site_id, now, added=1)
+    RelationshipRollup.objects.record_many(list(removed) + list(renewed), status_id,
+                                           site_id, now, removed=1)
+
+
+def _delete_relationships(pks):
+    """
+    Delete the relationships with the given primary keys in one statement,
+    without the signals ``QuerySet.delete()`` sends for each of them.
+    """
+    pks = list(pks)
+    if not pks:
+        return
+    qn = connection.ops.quote_name
+    opts = Relationship._meta
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+        qn(opts.db_table), qn(opts.pk.column), ', '.join(['%s'] * len(pks))), pks)
+
+
+def _insert_relationships(existing, to_user_ids, **fields):
+    """
+    Bulk insert relationships to ``to_user_ids`` in a savepoint, leaving out
+    those a concurrent writer inserted since ``existing`` was read.  Returns
+    the set of ids left out.
+    """
+    skipped = set()
+    while True:
+        try:
+            with transaction.atomic():
+                Relationship.objects.bulk_create([
+                    Relationship(to_user_id=pk, **fields)
+                    for pk in to_user_ids if pk not in skipped
+                ])
+            return skipped
+        except IntegrityError:
+            inserted = set(existing.filter(to_user__in=to_user_ids)
+                                   .values_list('to_user', flat=True))
+            if inserted <= skipped:
+                raise
+            skipped |= inserted
+
+
+SyncReport = namedtuple('SyncReport', ['added', 'removed', 'unchanged', 'missing'])
+
+
+def _sorted_difference(a, b):
+    """
+    The items of sorted sequence ``a`` missing from sorted sequence ``b``,
+    in a single pass over both.
+    """
+    result = array('l')
+    i, j, len_b = 0, 0, len(b)
+    for item in a:
+        while j < len_b and b[j] < item:
+            j += 1
+        if j == len_b or b[j] != item:
+            result.append(item)
+    return result
+
 field = models.ManyToManyField(User, through=Relationship,
                                symmetrical=False, related_name='related_to')
 
 
+def _lazy(path):
+    """
+    Returns a callable resolving the dotted ``path`` to a module attribute on
+    first use and returning the cached object from then on.
+    """
+    module_name, name = path.rsplit('.', 1)
+    resolved = []
+
+    def resolve():
+        if not resolved:
+            resolved.append(getattr(import_module(module_name), name))
+        return resolved[0]
+    return resolve
+
+_follower_metric_task = _lazy('people.tasks.task_got_follower_metric')
+_white_label_model = _lazy('people.models.PeopleWhiteLabel')
+# relationships.parallel imports this module
+_run_async = _lazy('relationships.parallel.run')
+_run_inline = _lazy('relationships.parallel.run_inline')
+
+
+def _white_label_user_ids():
+    """
+    A subquery of the ids of users whose profile belongs to the current white
+    label site.
+    """
+    white_label_people = _white_label_model().objects.filter(
+        site_id=settings.SITE_ID
+    ).values_list(
+        'id',
+        flat=True
+    )
+    return get_profile_model()._default_manager.filter(
+        white_label_site__in=white_label_people
+    ).values_list(
+        'user',
+        flat=True
+    )
+
+
+def load_related(qs, select_related=None, prefetch_related=None, only=None):
+    """
+    Apply ``select_related``, ``prefetch_related`` and ``only`` to a queryset
+    of users, each taken from the ``RELATIONSHIPS_LIST_*`` settings when
+    None.  Pass an empty tuple to turn one off.
+    """
+    if select_related is None:
+        select_related = LIST_SELECT_RELATED
+    if prefetch_related is None:
+        prefetch_related = LIST_PREFETCH_RELATED
+    if only is None:
+        only = LIST_ONLY
+
+    if select_related:
+        qs = qs.select_related(*select_related)
+    if prefetch_related:
+        qs = qs.prefetch_related(*prefetch_related)
+    if only:
+        qs = qs.only(*only)
+    return qs
+
+
+def _order_by_influence(qs):
+    """
+    Orders a queryset of users by their influence on the current site, users
+    without a score last.
+    """
+    qn = connection.ops.quote_name
+    opts = UserInfluence._meta
+    score = '(SELECT %s FROM %s WHERE %s = %s.%s AND %s = %%s)' % (
+        qn(opts.get_field('score').column), qn(opts.db_table),
+        qn(opts.get_field('user').column),
+        qn(qs.model._meta.db_table), qn(qs.model._meta.pk.column),
+        qn(opts.get_field('site').column))
+    return qs.extra(
+        select={'influence': 'COALESCE(%s, 0)' % score},
+        select_params=(settings.SITE_ID,),
+        order_by=('-influence', 'pk'),
+    )
+
+
+class RelationshipSummary(namedtuple('RelationshipSummary', [
+        'following', 'followed_by', 'friends', 'blocking', 'blocked_by',
+        'outgoing', 'incoming'])):
+    """
+    The relationships between two users, as seen from the first.
+    ``outgoing`` and ``incoming`` are frozensets of the ``from_slug`` of
+    every status in each direction.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_slugs(cls, outgoing, incoming):
+        outgoing, incoming = frozenset(outgoing), frozenset(incoming)
+        return cls(
+            following='following' in outgoing,
+            followed_by='following' in incoming,
+            friends='following' in outgoing and 'following' in incoming,
+            blocking='blocking' in outgoing,
+            blocked_by='blocking' in incoming,
+            outgoing=outgoing,
+            incoming=incoming,
+        )
+
+EMPTY_SUMMARY = RelationshipSummary.from_slugs((), ())
+
+
+# kinds of cached neighbor data
+FOLLOWING = 'following'
+FOLLOWERS = 'followers'
+FRIENDS = 'friends'
+COUNT = '-count'
+
+
+NEIGHBOR_KEY = 'relationships:neighbors:%s:%s.%s:%s:%s:%s'
+
+
+def neighbor_cache_key(user_id, kind, status_id, version=None, privacy=None):
+    """
+    The cache key of a user's neighbor ids or count of the given ``kind``,
+    valid until the relationships of the user or the set of private users
+    change.  The user's relationship version and the privacy version are
+    looked up unless given.
+    """
+    if version is None:
+        version = get_relationship_version(user_id)
+    if privacy is None:
+        privacy = privacy_version()
+    return NEIGHBOR_KEY % (settings.SITE_ID, user_id, version, kind, status_id, privacy)
+
+
 class RelationshipManager(User._default_manager.__class__):
     def __init__(self, instance=None, *args, **kwargs):
         super(RelationshipManager, self).__init__(*args, **kwargs)
         self.instance = instance
 
-    def add(self, user, status=None, symmetrical=False):
+    def add(self, user, status=None, symmetrical=False, expires=None):
         """
         Add a relationship from one user to another with the given status,
         which defaults to "following".
@@ -88,6 +877,10 @@ class RelationshipManager(User._default_manager.__class__):
         someone on twitter).  Specify a symmetrical relationship (akin to being
         friends on facebook) by passing in :param:`symmetrical` = True
 
+        :param:`expires`, a datetime or a timedelta from now, makes the
+        relationship temporary, e.g. to mute someone for a day.  Adding an
+        existing relationship again replaces its expiry.
+
         .. note::
 
             If :param:`symmetrical` is set, the function will return a tuple
@@ -96,23 +889,31 @@ class RelationshipManager(User._default_manager.__class__):
         if not status:
             status = RelationshipStatus.objects.following()
 
-        relationship, created = Relationship.objects.get_or_create(
-            from_user=self.instance,
-            to_user=user,
-            status=status,
-            site=Site.objects.get_current()
-        )
-        if created and status.verb == 'follow':
-            from people.tasks import task_got_follower_metric
-            from django.contrib.contenttypes.models import ContentType
+        expires_at = _expiry(expires)
+
+        # the relationships and their change log entries commit together
+        with graph.engine.committing(), transaction.atomic():
+            relationship, created = Relationship.objects.get_or_create(
+                from_user=self.instance,
+                to_user=user,
+                status=status,
+                site=Site.objects.get_current(),
+                defaults={'expires_at': expires_at},
+            )
+            if not created and relationship.expires_at != expires_at:
+                relationship.expires_at = expires_at
+                relationship.save(update_fields=['expires_at'])
+            if symmetrical:
+                reciprocal = user.relationships.add(self.instance, status, False, expires_at)
 
+        if created and status.verb == 'follow':
             content_type = ContentType.objects.get_for_model(self.instance)
-            task_got_follower_metric.delay(
+            _follower_metric_task().delay(
                 user=user, content_type=content_type, object_id=self.instance.id
             )
 
         if symmetrical:
-            return (relationship, user.relationships.add(self.instance, status, False))
+            return (relationship, reciprocal)
         else:
             return relationship
 
@@ -124,17 +925,132 @@ class RelationshipManager(User._default_manager.__class__):
         if not status:
             status = RelationshipStatus.objects.following()
 
-        res = Relationship.objects.filter(
+        with graph.engine.committing(), transaction.atomic():
+            res = Relationship.objects.filter(
+                from_user=self.instance,
+                to_user=user,
+                status=status,
+                site__pk=settings.SITE_ID
+            ).delete()
+
+            if symmetrical:
+                return (res, user.relationships.remove(self.instance, status, False))
+            else:
+                return res
+
+    def sync(self, target_user_ids, status=None, batch_size=1000):
+        """
+        Make the users this user has a relationship of ``status`` with,
+        "following" by default, exactly ``target_user_ids``, e.g. to mirror
+        an imported address book.
+
+        The current ids are read once and diffed against the targets, then
+        the changes are written with bulk INSERTs and DELETEs of at most
+        ``batch_size`` rows in one transaction.  Expired relationships to
+        targets lose their expiry, and relationships added concurrently are
+        left as they are.  No signal is sent per relationship,
+        ``bulk_relationships_changed`` is sent once instead, so the
+        receivers of ``post_save`` such as
+        :func:`~relationships.listeners.mutually_exclusive_fix` need a bulk
+        counterpart.  The follower metric task is queued for each new follow
+        as :meth:`add` does.
+
+        Returns a ``SyncReport`` of the ``added`` and ``removed`` user ids,
+        the number ``unchanged`` and the target ids ``missing`` from the
+        user table, which are skipped.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+        site_id = settings.SITE_ID
+
+        target = sorted(set(int(pk) for pk in target_user_ids) - set([self.instance.pk]))
+        existing = Relationship.objects.filter(
             from_user=self.instance,
-            to_user=user,
             status=status,
-            site__pk=settings.SITE_ID
-        ).delete()
+            site__pk=site_id,
+        )
 
-        if symmetrical:
-            return (res, user.relationships.remove(self.instance, status, False))
-        else:
-            return res
+        with graph.engine.committing(), transaction.atomic():
+            current = list(existing.filter(unexpired()).order_by('to_user')
+                                   .values_list('to_user', flat=True))
+            to_add = _sorted_difference(target, current)
+            to_remove = _sorted_difference(current, target)
+
+            added, renewed, missing = array('l'), array('l'), array('l')
+            unchanged = len(current) - len(to_remove)
+            for i in range(0, len(to_add), batch_size):
+                batch = to_add[i:i + batch_size]
+                # relationships which expired but were not swept yet are made
+                # permanent again rather than inserted a second time
+                expired = set(existing.filter(to_user__in=batch).exclude(unexpired())
+                                      .values_list('to_user', flat=True))
+                if expired:
+                    existing.filter(to_user__in=expired).update(expires_at=None)
+                found = set(User.objects.filter(pk__in=[pk for pk in batch if pk not in expired])
+                                        .values_list('pk', flat=True))
+                raced = _insert_relationships(
+                    existing, [pk for pk in batch if pk in found],
+                    from_user=self.instance, status=status, site_id=site_id)
+                unchanged += len(raced)
+                for pk in batch:
+                    if pk in raced:
+                        continue
+                    if pk in expired:
+                        renewed.append(pk)
+                    (added if pk in found or pk in expired else missing).append(pk)
+
+            for i in range(0, len(to_remove), batch_size):
+                _delete_relationships(existing.filter(to_user__in=to_remove[i:i + batch_size])
+                                              .values_list('pk', flat=True))
+
+            if added or to_remove:
+                bulk_relationships_changed.send(
+                    sender=Relationship,
+                    from_user_id=self.instance.pk,
+                    status_id=status.pk,
+                    site_id=site_id,
+                    added=added,
+                    removed=to_remove,
+                    renewed=renewed,
+                )
+
+        if status.verb == 'follow':
+            content_type = ContentType.objects.get_for_model(self.instance)
+            renewed_ids = set(renewed)
+            created = [pk for pk in added if pk not in renewed_ids]
+            for i in range(0, len(created), batch_size):
+                for user in User.objects.filter(pk__in=created[i:i + batch_size]):
+                    _follower_metric_task().delay(
+                        user=user, content_type=content_type, object_id=self.instance.id
+                    )
+
+        return SyncReport(added, to_remove, unchanged, missing)
+
+    def strongest(self, status=None, k=10):
+        """
+        Returns a list of the ``k`` users with whom the given user has the
+        strongest relationship of the given status, which defaults to
+        "following", ordered by :attr:`Relationship.weight`.
+
+        The ranking is read from the
+        ``(from_user, status, site, weight, to_user, expires_at)`` index alone,
+        walking it by weight until ``k`` users pass the expiry and privacy
+        checks, however many relationships the user has.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+
+        # WHY: gdpr compliance, before slicing so that k users are returned.
+        user_ids = list(exclude_private(Relationship.objects.filter(
+            unexpired(),
+            from_user=self.instance,
+            status=status,
+            site__pk=settings.SITE_ID,
+            weight__isnull=False,
+        ), 'to_user').order_by('-weight').values_list('to_user', flat=True)[:k])
+
+        users = User.objects.in_bulk(user_ids)
+        return [users[pk] for pk in user_ids if pk in users]
 
     def _get_from_query(self, status):
         return dict(
@@ -158,12 +1074,14 @@ class RelationshipManager(User._default_manager.__class__):
         established a relationship.
         """
         query = self._get_from_query(status)
+        conditions = [unexpired('to_users__')]
 
         if symmetrical:
             query.update(self._get_to_query(status))
+            conditions.append(unexpired('from_users__'))
 
-        # WHY: gdpr compliance.
-        return User.objects.filter(**query).exclude(user_profile__is_private=True)
+        # WHY: gdpr compliance, without joining the profile table.
+        return exclude_private(User.objects.filter(*conditions, **query))
 
     # WHAT: Gets the followers of a user. Excludes followers with a private profile due to GDRP compliance.
     def get_related_to(self, status):
@@ -171,189 +1089,513 @@ class RelationshipManager(User._default_manager.__class__):
         Returns a QuerySet of user objects which have created a relationship to
         the given user.
         """
-        return User.objects.filter(**self._get_to_query(status)).exclude(user_profile__is_private=True)
+        return exclude_private(User.objects.filter(
+            unexpired('from_users__'), **self._get_to_query(status)))
+
+    def _graph(self, status):
+        return graph.engine.get(getattr(status, 'pk', status), settings.SITE_ID)
+
+    def _cached(self, kind, status, load):
+        key = neighbor_cache_key(self.instance.pk, kind, getattr(status, 'pk', status))
+        value = cache.get(key)
+        if value is None:
+            value = load()
+            if not isinstance(value, array) or len(value) <= CACHE_MAX_IDS:
+                cache.set(key, value, self._cache_timeout(kind, status))
+        return value
+
+    def _cache_timeout(self, kind, status):
+        """
+        ``CACHE_TIMEOUT``, or the seconds until the first of the temporary
+        relationships behind a cached value of ``kind`` expires.
+        """
+        if kind.startswith(FOLLOWING):
+            users = models.Q(from_user=self.instance)
+        elif kind.startswith(FOLLOWERS):
+            users = models.Q(to_user=self.instance)
+        else:
+            users = models.Q(from_user=self.instance) | models.Q(to_user=self.instance)
+        now = timezone.now()
+        nearest = Relationship.objects.filter(
+            users,
+            status=status,
+            site__pk=settings.SITE_ID,
+            expires_at__gt=now,
+        ).aggregate(nearest=models.Min('expires_at'))['nearest']
+        return timeout_until(nearest, now)
+
+    def get_relationship_ids(self, status, symmetrical=False):
+        """
+        The ids of :meth:`get_relationships` as a sorted ``array('i')``,
+        read from the graph engine when it has the status loaded and
+        otherwise cached until the user's relationships change.
+        """
+        engine_graph = self._graph(status)
+        if engine_graph is None:
+            return self._cached(
+                FRIENDS if symmetrical else FOLLOWING, status,
+                lambda: array('i', self.get_relationships(status, symmetrical).order_by(
+                    'pk').values_list('pk', flat=True)))
+        if symmetrical:
+            ids = engine_graph.friends(self.instance.pk)
+        else:
+            ids = engine_graph.outgoing(self.instance.pk)
+        return graph._without(ids, private_user_ids())
+
+    def get_related_to_ids(self, status):
+        """
+        The ids of :meth:`get_related_to` as a sorted ``array('i')``.
+        """
+        engine_graph = self._graph(status)
+        if engine_graph is None:
+            return self._cached(
+                FOLLOWERS, status,
+                lambda: array('i', self.get_related_to(status).order_by(
+                    'pk').values_list('pk', flat=True)))
+        return graph._without(engine_graph.incoming(self.instance.pk), private_user_ids())
+
+    def count_relationships(self, status, symmetrical=False):
+        engine_graph = self._graph(status)
+        if engine_graph is None:
+            return self._cached(
+                (FRIENDS if symmetrical else FOLLOWING) + COUNT, status,
+                lambda: self.get_relationships(status, symmetrical).count())
+        if symmetrical:
+            ids = engine_graph.friends(self.instance.pk)
+        else:
+            ids = engine_graph.outgoing(self.instance.pk)
+        return graph._count_without(ids, private_user_ids())
+
+    def count_related_to(self, status):
+        engine_graph = self._graph(status)
+        if engine_graph is None:
+            return self._cached(FOLLOWERS + COUNT, status,
+                                lambda: self.get_related_to(status).count())
+        return graph._count_without(engine_graph.incoming(self.instance.pk),
+                                    private_user_ids())
+
+    def _exclude_reciprocated(self, qs, status, user_field, instance_field):
+        """
+        Restrict ``qs`` to users for which there is no unexpired relationship
+        of the given status whose ``user_field`` is the user and
+        ``instance_field`` is the given user, as a single NOT EXISTS
+        anti-join.
+        """
+        qn = connection.ops.quote_name
+        opts = Relationship._meta
+        where = (
+            'NOT EXISTS (SELECT 1 FROM %(table)s reciprocal '
+            'WHERE reciprocal.%(user_col)s = %(user_table)s.%(user_pk)s '
+            'AND reciprocal.%(instance_col)s = %%s '
+            'AND reciprocal.%(status_col)s = %%s '
+            'AND reciprocal.%(site_col)s = %%s '
+            'AND (reciprocal.%(expires_col)s IS NULL OR reciprocal.%(expires_col)s > %%s))'
+        ) % dict(
+            table=qn(opts.db_table),
+            user_col=qn(opts.get_field(user_field).column),
+            user_table=qn(User._meta.db_table),
+            user_pk=qn(User._meta.pk.column),
+            instance_col=qn(opts.get_field(instance_field).column),
+            status_col=qn(opts.get_field('status').column),
+            site_col=qn(opts.get_field('site').column),
+            expires_col=qn(opts.get_field('expires_at').column),
+        )
+        status_id = getattr(status, 'pk', status)
+        return qs.extra(where=[where], params=[
+            self.instance.pk, status_id, settings.SITE_ID, timezone.now()])
 
     def only_to(self, status):
         """
         Returns a QuerySet of user objects who have created a relationship to
         the given user, but which the given user has not reciprocated
         """
-        from_relationships = self.get_relationships(status)
-        to_relationships = self.get_related_to(status)
-        return to_relationships.exclude(pk__in=from_relationships.values_list('pk'))
+        return self._exclude_reciprocated(self.get_related_to(status), status,
+                                          'to_user', 'from_user')
 
     def only_from(self, status):
         """
         Like :method:`only_to`, returns user objects with whom the given user
         has created a relationship, but which have not reciprocated
         """
-        from_relationships = self.get_relationships(status)
-        to_relationships = self.get_related_to(status)
-        return from_relationships.exclude(pk__in=to_relationships.values_list('pk'))
+        return self._exclude_reciprocated(self.get_relationships(status), status,
+                                          'from_user', 'to_user')
+
+    def only_to_count(self, status):
+        return self.only_to(status).count()
+
+    def only_from_count(self, status):
+        return self.only_from(status).count()
 
     def exists(self, user, status=None, symmetrical=False):
         """
         Returns boolean whether or not a relationship exists between the given
         users.  An optional :class:`RelationshipStatus` instance can be specified.
         """
-        query = dict(
-            to_users__from_user=self.instance,
-            to_users__to_user=user,
-            to_users__site__pk=settings.SITE_ID,
-        )
+        status_id = getattr(status, 'pk', status)
+        key = ('exists', settings.SITE_ID, self.instance.pk, user.pk, status_id, symmetrical)
+        result = memo.lookup(key)
+        if result is not memo.MISSING:
+            return result
+
+        engine_graph = status_id and graph.engine.get(status_id, settings.SITE_ID)
+        if engine_graph is not None:
+            if symmetrical:
+                result = engine_graph.mutual(self.instance.pk, user.pk)
+            else:
+                result = engine_graph.exists(self.instance.pk, user.pk)
+            memo.remember(key, result)
+            return result
 
+        qs = Relationship.objects.filter(unexpired(), site__pk=settings.SITE_ID)
         if status:
-            query.update(to_users__status=status)
+            qs = qs.filter(status__pk=status_id)
 
-        if symmetrical:
-            query.update(
-                from_users__to_user=self.instance,
-                from_users__from_user=user,
-                from_users__site__pk=settings.SITE_ID
-            )
+        if not symmetrical:
+            result = qs.filter(from_user=self.instance, to_user=user).exists()
+        else:
+            # both directions in one statement, there is at most one distinct
+            # from_user per direction
+            from_user_ids = set(qs.filter(
+                models.Q(from_user=self.instance, to_user=user) |
+                models.Q(from_user=user, to_user=self.instance)
+            ).values_list('from_user', flat=True).distinct())
+            result = from_user_ids == set([self.instance.pk, user.pk])
+
+        memo.remember(key, result)
+        return result
+
+    def follow_object(self, obj, status=None):
+        """
+        Add a relationship of ``status``, "following" by default, to an
+        object of any model.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+        return GenericRelationship.objects.get_or_create(
+            from_user=self.instance,
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.pk,
+            status=status,
+            site=Site.objects.get_current(),
+        )[0]
 
-            if status:
-                query.update(from_users__status=status)
+    def unfollow_object(self, obj, status=None):
+        GenericRelationship.objects.for_target(obj, status).filter(
+            from_user=self.instance).delete()
 
-        return User.objects.filter(**query).exists()
+    def follows_object(self, obj, status=None):
+        return GenericRelationship.objects.for_target(obj, status).filter(
+            from_user=self.instance).exists()
 
-    def following(self):
+    def followed_objects(self, status=None, model=None):
+        """
+        Returns a list of the objects this user has a relationship of
+        ``status`` to, newest first, optionally only those of ``model``.
+        Each content type is loaded with a single query.
+        """
+        if not status:
+            status = RelationshipStatus.objects.following()
+        qs = GenericRelationship.objects.filter(
+            from_user=self.instance,
+            status=status,
+            site__pk=settings.SITE_ID,
+        ).order_by('-created', '-pk')
+        if model is not None:
+            qs = qs.filter(content_type=ContentType.objects.get_for_model(model))
+        return [relationship.target for relationship in
+                GenericRelationship.objects.resolve_targets(qs)
+                if relationship.target is not None]
+
+    def summary_with(self, user):
+        """
+        Returns a :class:`RelationshipSummary` of every relationship between
+        this user and ``user``, in both directions and of every status,
+        fetched with a single query.
+        """
+        if user is None or not user.pk or not self.instance.pk:
+            return EMPTY_SUMMARY
+
+        edges = Relationship.objects.filter(
+            models.Q(from_user=self.instance, to_user=user) |
+            models.Q(from_user=user, to_user=self.instance),
+            unexpired(),
+            site__pk=settings.SITE_ID,
+        ).values_list('from_user', 'status__from_slug')
+
+        outgoing, incoming = [], []
+        for from_user_id, slug in edges:
+            if from_user_id == self.instance.pk:
+                outgoing.append(slug)
+            else:
+                incoming.append(slug)
+        return RelationshipSummary.from_slugs(outgoing, incoming)
+
+    # the user lists take the select_related, prefetch_related and only
+    # arguments of load_related(), defaulting to the RELATIONSHIPS_LIST_*
+    # settings
+
+    def following(self, **loading):
+        qs = self.get_relationships(RelationshipStatus.objects.following())
         if settings.SITE_ID > 1:
-            from people.models import PeopleWhiteLabel, UserProfile
-            white_label_people = PeopleWhiteLabel.objects.filter(
-                site_id=settings.SITE_ID
-            ).values_list(
-                'id',
-                flat=True
-            )
+            qs = qs.filter(id__in=_white_label_user_ids())
+        return load_related(qs, **loading)
 
-            people = UserProfile.objects.filter(
-                white_label_site__in=white_label_people
-            ).values_list(
-                'user',
-                flat=True
-            )
+    def followers(self, order_by=None, **loading):
+        """
+        The users following this one.  ``order_by='influence'`` lists the
+        most influential followers first, by their precomputed
+        :class:`UserInfluence` score.
+        """
+        if order_by not in (None, 'influence'):
+            raise ValueError('Unknown follower ordering %r' % (order_by,))
 
-            return self.get_relationships(RelationshipStatus.objects.following()).filter(
-                id__in=people,
-            )
-        return self.get_relationships(RelationshipStatus.objects.following())
+        qs = self.get_related_to(RelationshipStatus.objects.following())
+        if settings.SITE_ID > 1:
+            qs = qs.filter(id__in=_white_label_user_ids())
+        if order_by == 'influence':
+            qs = _order_by_influence(qs)
+        return load_related(qs, **loading)
 
-    def followers(self):
+    def blocking(self, **loading):
+        return load_related(self.get_relationships(RelationshipStatus.objects.blocking()),
+                            **loading)
+
+    def blockers(self, **loading):
+        return load_related(self.get_related_to(RelationshipStatus.objects.blocking()),
+                            **loading)
+
+    def friends(self, **loading):
+        qs = self.get_relationships(RelationshipStatus.objects.following(), True)
         if settings.SITE_ID > 1:
-            from people.models import PeopleWhiteLabel, UserProfile
-            white_label_people = PeopleWhiteLabel.objects.filter(
+            qs = qs.filter(
+                id__in=_white_label_user_ids(),
                 site_id=settings.SITE_ID
-            ).values_list(
-                'id',
-                flat=True
             )
+        return load_related(qs, **loading)
 
-            people = UserProfile.objects.filter(
-                white_label_site__in=white_label_people
-            ).values_list(
-                'user',
-                flat=True
-            )
+    def _iter_ids(self, status, user_field, instance_field, chunk_size):
+        if not status:
+            status = RelationshipStatus.objects.following()
 
-            return self.get_related_to(RelationshipStatus.objects.following()).filter(
-                id__in=people
-            )
-        return self.get_related_to(RelationshipStatus.objects.following())
+        # WHY: gdpr compliance.
+        qs = exclude_private(Relationship.objects.filter(unexpired(), **{
+            instance_field: self.instance,
+            'status': status,
+            'site__pk': settings.SITE_ID,
+        }), user_field).order_by(user_field).values_list(user_field, flat=True)
 
-    def blocking(self):
-        return self.get_relationships(RelationshipStatus.objects.blocking())
+        position = 0
+        while True:
+            ids = list(qs.filter(**{'%s__gt' % user_field: position})[:chunk_size])
+            if not ids:
+                return
+            position = ids[-1]
+            yield array('l', ids)
 
-    def blockers(self):
-        return self.get_related_to(RelationshipStatus.objects.blocking())
+            if len(ids) < chunk_size:
+                return
 
-    def friends(self):
-        if settings.SITE_ID > 1:
-            from people.models import PeopleWhiteLabel, UserProfile
-            if settings.SITE_ID > 1:
-                white_label_people = PeopleWhiteLabel.objects.filter(
-                    site_id=settings.SITE_ID
-                ).values_list(
-                    'id',
-                    flat=True
+    def iter_follower_ids(self, chunk_size=10000, status=None):
+        """
+        Yields the ids of the users with a relationship of the given status,
+        which defaults to "following", to the given user as arrays of at most
+        ``chunk_size`` ids.
+
+        Pages are read by keyset over the ``(to_user, status, site, from_user)``
+        index, so memory stays flat and no query ever skips rows with OFFSET,
+        however many followers there are.
+        """
+        return self._iter_ids(status, 'from_user', 'to_user', chunk_size)
+
+    def iter_following_ids(self, chunk_size=10000, status=None):
+        """
+        Like :method:`iter_follower_ids`, for the users the given user has a
+        relationship to.
+        """
+        return self._iter_ids(status, 'to_user', 'from_user', chunk_size)
+
+    def iter_followers(self, chunk_size=1000, status=None):
+        """
+        Yields lists of at most ``chunk_size`` follower ``User`` objects.
+        """
+        for ids in self.iter_follower_ids(chunk_size, status):
+            yield list(User.objects.filter(pk__in=ids).order_by('pk'))
+
+    def iter_following(self, chunk_size=1000, status=None):
+        """
+        Yields lists of at most ``chunk_size`` followed ``User`` objects.
+        """
+        for ids in self.iter_following_ids(chunk_size, status):
+            yield list(User.objects.filter(pk__in=ids).order_by('pk'))
+
+    # concurrent counterparts, each starts the call in a thread and returns an
+    # AsyncResult, see relationships.parallel
+    def aexists(self, user, status=None, symmetrical=False):
+        return _run_async()(self.exists, user, status, symmetrical)
+
+    # writes run in the calling thread, inside its transaction, and return
+    # their result ready
+    def aadd(self, user, status=None, symmetrical=False, expires=None):
+        return _run_inline()(self.add, user, status, symmetrical, expires)
+
+    def aremove(self, user, status=None, symmetrical=False):
+        return _run_inline()(self.remove, user, status, symmetrical)
+
+    def afollowing(self):
+        return _run_async()(lambda: list(self.following()))
+
+    def afollowers(self):
+        return _run_async()(lambda: list(self.followers()))
+
+    def afriends(self):
+        return _run_async()(lambda: list(self.friends()))
+
+
+def _relationships_descriptor():
+    """
+    Builds the manager class backing ``user.relationships`` for the running
+    version of Django and returns a descriptor creating one per user.
+    """
+    if django.VERSION < (1, 2):
+        RelatedManager = create_many_related_manager(RelationshipManager, Relationship)
+
+        class RelationshipsDescriptor(object):
+            def __get__(self, instance, instance_type=None):
+                qn = connection.ops.quote_name
+                manager = RelatedManager(
+                    model=User,
+                    core_filters={'related_to__pk': instance._get_pk_val()},
+                    instance=instance,
+                    symmetrical=False,
+                    join_table=qn('relationships_relationship'),
+                    source_col_name=qn('from_user_id'),
+                    target_col_name=qn('to_user_id'),
                 )
+                return manager
 
-                people = UserProfile.objects.filter(
-                    white_label_site__in=white_label_people
-                ).values_list(
-                    'user',
-                    flat=True
+    elif django.VERSION > (1, 2) and django.VERSION < (1, 4):
+        fake_rel = ManyToManyRel(
+            to=User,
+            through=Relationship)
+
+        RelatedManager = create_many_related_manager(RelationshipManager, fake_rel)
+
+        class RelationshipsDescriptor(object):
+            def __get__(self, instance, instance_type=None):
+                manager = RelatedManager(
+                    model=User,
+                    core_filters={'related_to__pk': instance._get_pk_val()},
+                    instance=instance,
+                    symmetrical=False,
+                    source_field_name='from_user',
+                    target_field_name='to_user'
                 )
+                return manager
+
+    else:
+        fake_rel = ManyToManyRel(
+            to=User,
+            through=Relationship)
 
-                return self.get_relationships(RelationshipStatus.objects.following(), True).filter(
-                    id__in=people,
-                    site_id=settings.SITE_ID
+        RelatedManager = create_many_related_manager(RelationshipManager, fake_rel)
+
+        class RelationshipsDescriptor(object):
+            def __get__(self, instance, instance_type=None):
+                manager = RelatedManager(
+                    model=User,
+                    query_field_name='related_to',
+                    instance=instance,
+                    symmetrical=False,
+                    source_field_name='from_user',
+                    target_field_name='to_user',
+                    through=Relationship,
                 )
-            return self.get_relationships(RelationshipStatus.objects.following(), True).filter(
-                site_id=settings.SITE_ID
-            )
-        return self.get_relationships(RelationshipStatus.objects.following(), True)
+                return manager
 
+    return RelationshipsDescriptor()
 
-if django.VERSION < (1, 2):
 
-    RelatedManager = create_many_related_manager(RelationshipManager, Relationship)
+# the sender the privacy receivers are connected for, None for every sender
+_privacy_sender = [None]
 
-    class RelationshipsDescriptor(object):
-        def __get__(self, instance, instance_type=None):
-            qn = connection.ops.quote_name
-            manager = RelatedManager(
-                model=User,
-                core_filters={'related_to__pk': instance._get_pk_val()},
-                instance=instance,
-                symmetrical=False,
-                join_table=qn('relationships_relationship'),
-                source_col_name=qn('from_user_id'),
-                target_col_name=qn('to_user_id'),
-            )
-            return manager
 
-elif django.VERSION > (1, 2) and django.VERSION < (1, 4):
+def connect_signals(profile_model=None):
+    signals.post_save.connect(relationship_status_saved, sender=RelationshipStatus,
+                              dispatch_uid='relationships.slugs.post_save')
+    signals.post_delete.connect(relationship_status_deleted, sender=RelationshipStatus,
+                                dispatch_uid='relationships.slugs.post_delete')
+    signals.post_save.connect(relationship_changed, sender=Relationship,
+                              dispatch_uid='relationships.cache.post_save')
+    signals.post_delete.connect(relationship_changed, sender=Relationship,
+                                dispatch_uid='relationships.cache.post_delete')
+    bulk_relationships_changed.connect(relationships_bulk_changed, sender=Relationship,
+                                       dispatch_uid='relationships.cache.bulk')
+    signals.post_save.connect(generic_relationship_changed, sender=GenericRelationship,
+                              dispatch_uid='relationships.cache.generic.post_save')
+    signals.post_delete.connect(generic_relationship_changed, sender=GenericRelationship,
+                                dispatch_uid='relationships.cache.generic.post_delete')
 
-    fake_rel = ManyToManyRel(
-        to=User,
-        through=Relationship)
+    signals.post_save.connect(relationship_added_rollup, sender=Relationship,
+                              dispatch_uid='relationships.rollup.post_save')
+    signals.post_delete.connect(relationship_removed_rollup, sender=Relationship,
+                                dispatch_uid='relationships.rollup.post_delete')
+    bulk_relationships_changed.connect(relationships_bulk_rollup, sender=Relationship,
+                                       dispatch_uid='relationships.rollup.bulk')
 
-    RelatedManager = create_many_related_manager(RelationshipManager, fake_rel)
+    signals.post_save.connect(relationship_added_event, sender=Relationship,
+                              dispatch_uid='relationships.events.post_save')
+    signals.post_delete.connect(relationship_removed_event, sender=Relationship,
+                                dispatch_uid='relationships.events.post_delete')
+    bulk_relationships_changed.connect(relationships_bulk_event, sender=Relationship,
+                                       dispatch_uid='relationships.events.bulk')
+
+    signals.post_save.connect(graph.relationship_saved, sender=Relationship,
+                              dispatch_uid='relationships.graph.post_save')
+    signals.post_delete.connect(graph.relationship_deleted, sender=Relationship,
+                                dispatch_uid='relationships.graph.post_delete')
+    bulk_relationships_changed.connect(graph.relationships_bulk_changed, sender=Relationship,
+                                       dispatch_uid='relationships.graph.bulk')
+
+    signals.post_save.connect(memo.clear, sender=Relationship,
+                              dispatch_uid='relationships.memo.post_save')
+    signals.post_delete.connect(memo.clear, sender=Relationship,
+                                dispatch_uid='relationships.memo.post_delete')
+    bulk_relationships_changed.connect(memo.clear, sender=Relationship,
+                                       dispatch_uid='relationships.memo.bulk')
+
+    # receivers are told apart by dispatch_uid and sender.  Until the app
+    # registry is ready the profile model can't be looked up, then the
+    # receivers see every save and check the sender themselves, and are
+    # replaced once connected to the profile model.
+    if profile_model is None:
+        if django.VERSION >= (1, 7):
+            profile_model = get_profile_model()
+        else:
+            profile_model = _privacy_sender[0]
+    privacy_receivers = (
+        (signals.pre_save, profile_saving, 'relationships.privacy.pre_save'),
+        (signals.post_save, profile_saved, 'relationships.privacy.post_save'),
+        (signals.post_delete, profile_deleted, 'relationships.privacy.post_delete'),
+    )
+    for signal, receiver, dispatch_uid in privacy_receivers:
+        if profile_model is not None:
+            signal.disconnect(sender=None, dispatch_uid=dispatch_uid)
+        signal.connect(receiver, sender=profile_model, dispatch_uid=dispatch_uid)
+    _privacy_sender[0] = profile_model
+
+
+def install(profile_model=None):
+    """
+    Adds ``relationships`` to ``User`` and connects the signal receivers.
+    Called once the app registry is ready, safe to call more than once.
+    """
+    if 'relationships' not in User.__dict__:
+        #HACK
+        field.contribute_to_class(User, 'relationships')
+        setattr(User, 'relationships', _relationships_descriptor())
+    connect_signals(profile_model)
 
-    class RelationshipsDescriptor(object):
-        def __get__(self, instance, instance_type=None):
-            manager = RelatedManager(
-                model=User,
-                core_filters={'related_to__pk': instance._get_pk_val()},
-                instance=instance,
-                symmetrical=False,
-                source_field_name='from_user',
-                target_field_name='to_user'
-            )
-            return manager
-
-else:
-
-    fake_rel = ManyToManyRel(
-        to=User,
-        through=Relationship)
-
-    RelatedManager = create_many_related_manager(RelationshipManager, fake_rel)
-
-    class RelationshipsDescriptor(object):
-        def __get__(self, instance, instance_type=None):
-            manager = RelatedManager(
-                model=User,
-                query_field_name='related_to',
-                instance=instance,
-                symmetrical=False,
-                source_field_name='from_user',
-                target_field_name='to_user',
-                through=Relationship,
-            )
-            return manager
 
-#HACK
-field.contribute_to_class(User, 'relationships')
-setattr(User, 'relationships', RelationshipsDescriptor())
+if django.VERSION < (1, 7):
+    # no AppConfig.ready() to defer to
+    install()
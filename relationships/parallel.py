@@ -0,0 +1,120 @@
+"""
+Running independent relationship lookups concurrently.
+
+The ORM is blocking, so a page needing several unrelated lookups (counts,
+mutual state, block checks) waits for them one after another.  The
+``a``-prefixed methods of ``user.relationships`` instead start the lookup in
+a shared pool of threads and return at once with an ``AsyncResult``, whose
+``get()`` waits for the value::
+
+    followers = owner.relationships.afollowers()
+    blocked = viewer.relationships.aexists(owner, blocking)
+    context = {'followers': followers.get(), 'blocked': blocked.get()}
+
+Each call uses the database connection of its thread, closed again once it
+returns, so it only sees what other transactions have committed.  Set
+``RELATIONSHIPS_ASYNC_INLINE = True`` to run the calls in the calling thread
+instead, e.g. for tests against an in-memory database which other threads
+cannot see.
+
+``aadd()`` and ``aremove()`` always write in the calling thread, inside its
+transaction, and return a result that is already ready.  There are no
+concurrent versions of the ``get_followers`` and ``get_follower_subset``
+views: Django serves them synchronously and each lists the followers with a
+single query, leaving nothing to overlap.
+"""
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import six
+
+from .models import RelationshipStatus
+
+
+MAX_WORKERS = getattr(settings, 'RELATIONSHIPS_ASYNC_MAX_WORKERS', 8)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    # started on first use, a pool created at import would not survive the
+    # fork of a preforking server
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(MAX_WORKERS)
+        return _pool
+
+
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+class InlineResult(object):
+    """
+    The ``AsyncResult`` interface for a call that already ran.
+    """
+    def __init__(self, func, args, kwargs):
+        try:
+            self.value, self.exc_info = func(*args, **kwargs), None
+        except Exception:
+            self.value, self.exc_info = None, sys.exc_info()
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self.exc_info is None
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self.exc_info is not None:
+            six.reraise(*self.exc_info)
+        return self.value
+
+
+def run_inline(func, *args, **kwargs):
+    """
+    Call ``func`` in the calling thread and return an ``AsyncResult`` of it.
+    """
+    return InlineResult(func, args, kwargs)
+
+
+def run(func, *args, **kwargs):
+    """
+    Start a blocking callable in the relationships thread pool and return
+    an ``AsyncResult`` of it.
+    """
+    if getattr(settings, 'RELATIONSHIPS_ASYNC_INLINE', False):
+        return run_inline(func, *args, **kwargs)
+    return _get_pool().apply_async(_call, (func, args, kwargs))
+
+
+def profile_relationships(viewer, owner):
+    """
+    Everything a profile page needs to know about the relationships between
+    the viewer and the profile owner, with the lookups run concurrently.
+    """
+    following = RelationshipStatus.objects.following()
+    blocking = RelationshipStatus.objects.blocking()
+    owner_rel, viewer_rel = owner.relationships, viewer.relationships
+    results = [
+        run(lambda: owner_rel.followers().count()),
+        run(lambda: owner_rel.following().count()),
+        viewer_rel.aexists(owner, following),
+        owner_rel.aexists(viewer, following),
+        viewer_rel.aexists(owner, blocking),
+        owner_rel.aexists(viewer, blocking),
+    ]
+    keys = ('followers_count', 'following_count', 'following', 'followed_by',
+            'blocking', 'blocked_by')
+    return dict(zip(keys, [result.get() for result in results]))
@@ -0,0 +1,189 @@
+"""
+Hiding users with a private profile from relationship lists (GDPR).
+
+Querysets exclude private users with a subquery on the profile table's
+private flag, so lists never carry the ids of private users as query
+parameters however many there are.  Code holding ids in memory, such as the
+graph engine, filters them through :func:`private_user_ids`, a set loaded
+once per process and privacy version.
+
+The privacy version is part of the cache keys of everything listing users.
+It is bumped when a profile is saved or deleted with a different privacy
+setting, once right away and once more after the transaction commits, so a
+list cached by a concurrent reader from the old data is never served under
+the final version.
+"""
+import time
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+PROFILE_MODEL = getattr(settings, 'RELATIONSHIPS_PROFILE_MODEL', 'people.UserProfile')
+
+# profile privacy is not site specific, so neither is this key
+PRIVACY_VERSION_KEY = 'relationships:private-users-version'
+
+# the private user ids of the current privacy version, loaded per process
+_private_ids = {}
+
+
+def get_profile_model():
+    """
+    Returns the profile model, or None when its app is not installed.
+    """
+    app_label, model_name = PROFILE_MODEL.split('.')
+    try:
+        from django.apps import apps
+    except ImportError:
+        from django.db.models.loading import get_model
+        return get_model(app_label, model_name)
+
+    try:
+        if django.VERSION >= (1, 11):
+            # also called from AppConfig.ready()
+            return apps.get_model(app_label, model_name, require_ready=False)
+        return apps.get_model(app_label, model_name)
+    except LookupError:
+        return None
+
+
+def private_profiles():
+    """
+    Returns the profiles marked private, or None without a profile model.
+    """
+    Profile = get_profile_model()
+    if Profile is None:
+        return None
+    return Profile._default_manager.filter(is_private=True)
+
+
+def _load_private_user_ids():
+    profiles = private_profiles()
+    if profiles is None:
+        return frozenset()
+    return frozenset(profiles.values_list('user', flat=True))
+
+
+def privacy_version():
+    """
+    A value that changes whenever the set of private users does, for use in
+    cache keys of anything listing users.
+    """
+    version = cache.get(PRIVACY_VERSION_KEY)
+    if version is None:
+        version = int(time.time() * 1000)
+        if not cache.add(PRIVACY_VERSION_KEY, version, None):
+            version = cache.get(PRIVACY_VERSION_KEY, version)
+    return version
+
+
+def private_user_ids():
+    """
+    Returns a frozenset of the ids of users with a private profile, for
+    filtering ids already in memory.  Querysets should use
+    :func:`exclude_private` instead.
+    """
+    version = privacy_version()
+    ids = _private_ids.get(version)
+    if ids is None:
+        ids = _load_private_user_ids()
+        _private_ids.clear()
+        _private_ids[version] = ids
+    return ids
+
+
+def invalidate_private_user_ids():
+    try:
+        cache.incr(PRIVACY_VERSION_KEY)
+    except ValueError:
+        cache.set(PRIVACY_VERSION_KEY, int(time.time() * 1000), None)
+
+
+def _on_commit(func):
+    # before Django 1.9 there is no commit hook, but post_save and
+    # post_delete are sent once the change committed unless the caller holds
+    # a transaction open
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is None:
+        func()
+    else:
+        on_commit(func)
+
+
+def _privacy_changed():
+    invalidate_private_user_ids()
+    _on_commit(invalidate_private_user_ids)
+
+
+def exclude_private(qs, field='pk'):
+    """
+    Exclude users with a private profile from ``qs``, where ``field`` is the
+    lookup to the user's id.
+    """
+    profiles = private_profiles()
+    if profiles is None:
+        return qs
+    return qs.exclude(**{'%s__in' % field: profiles.values('user')})
+
+
+def _is_profile_model(model):
+    label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+    return label.lower() == PROFILE_MODEL.lower()
+
+
+def profile_saving(sender, instance, raw=False, **kwargs):
+    """
+    Signal receiver remembering whether a profile about to be saved was
+    private, for :func:`profile_saved` to compare with.
+    """
+    if not _is_profile_model(sender):
+        return
+    instance._relationships_was_private = bool(
+        not raw and instance.pk is not None and
+        sender._default_manager.filter(pk=instance.pk, is_private=True).exists())
+
+
+def profile_saved(sender, instance, **kwargs):
+    """
+    Signal receiver bumping the privacy version when a profile's privacy
+    changed.
+    """
+    if not _is_profile_model(sender):
+        return
+    if getattr(instance, '_relationships_was_private', False) != bool(instance.is_private):
+        _privacy_changed()
+
+
+def profile_deleted(sender, instance, **kwargs):
+    if not _is_profile_model(sender):
+        return
+    if instance.is_private:
+        _privacy_changed()
+
+
+def verify_private_user_ids(batch_size=10000):
+    """
+    Compare this process's set of private users with the profile table,
+    reading profiles in primary key order ``batch_size`` at a time.  Returns
+    a tuple of ``(missing, extra)`` sets of user ids, missing being private
+    users absent from the set and extra users wrongly in it.
+    """
+    cached = private_user_ids()
+    actual = set()
+
+    Profile = get_profile_model()
+    position = None
+    while Profile is not None:
+        qs = Profile._default_manager.order_by('pk')
+        if position is not None:
+            qs = qs.filter(pk__gt=position)
+        rows = list(qs.values_list('pk', 'user', 'is_private')[:batch_size])
+        if not rows:
+            break
+        actual.update(user_id for pk, user_id, is_private in rows if is_private)
+        position = rows[-1][0]
+
+    return actual.difference(cached), cached.difference(actual)
@@ -1,16 +1,54 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+from unittest import skipIf, skipUnless
+
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
 from django.contrib.sites.models import Site
-from django.core.urlresolvers import reverse
-from django.template import Template, Context
-from django.test import TestCase
-
+from django.core.urlresolvers import (NoReverseMatch, get_script_prefix, reverse,
+    set_script_prefix)
+from django.db import IntegrityError, connection, transaction
+from django.db.models import signals
+from django.template import Context, Template, TemplateSyntaxError, loader
+from django.db.transaction import TransactionManagementError
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone, translation
+from django.utils.six import StringIO
+
+from relationships import (coalesce, graph, influence, models, parallel, privacy,
+    typeahead, urlbuilder, utils, views, warm, weights)
+from relationships.admin import (EstimatedCountPaginator, RelationshipAdmin,
+    RelationshipInline, INLINE_PAGE_VAR)
+from relationships.events import EventConsumer, read_events
+from relationships.expiry import sweep_expired
+from relationships.cache import (get_relationship_version, target_version_id,
+    versioned_cache_key)
+from relationships.decorators import cache_follow_list
+from relationships.memo import relationship_memo
+from relationships.signals import bulk_relationships_changed
+from relationships.urlbuilder import clear_templates, get_template, url_for
 from relationships.forms import RelationshipStatusAdminForm
 from relationships.listeners import (attach_relationship_listener,
     detach_relationship_listener)
-from relationships.models import Relationship, RelationshipStatus
+from relationships.models import (GenericRelationship, Relationship, RelationshipEvent,
+    RelationshipRollup, RelationshipStatus, RelationshipStatusSlug, UserInfluence,
+    install)
+from relationships.weights import (InteractionBuffer, decay_weights,
+    record_interactions)
 from relationships.utils import (relationship_exists, extract_user_field,
-    positive_filter, negative_filter)
+    positive_filter, negative_filter, relationship_exists_many,
+    relationship_matrix, with_relationship_annotations)
 
 
 class BaseRelationshipsTestCase(TestCase):
@@ -41,9 +79,19 @@ class BaseRelationshipsTestCase(TestCase):
 
         self.site = Site.objects.get_current()
 
+        # versioned keys would outlive the rollback of the previous test
+        cache.clear()
+
     def tearDown(self):
         settings.SITE_ID = self.site_id
 
+    def _set_private(self, *users):
+        profiles = privacy.get_profile_model()._default_manager
+        for user in users:
+            profile = profiles.get_or_create(user=user)[0]
+            profile.is_private = True
+            profile.save()
+
     def _sort_by_pk(self, list_or_qs):
         annotated = [(item.pk, item) for item in list_or_qs]
         annotated.sort()
@@ -84,6 +132,33 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         rel = self.yoko.related_to.all()
         self.assertQuerysetEqual(rel, [self.john])
 
+    def test_install(self):
+        descriptor = User.__dict__['relationships']
+        receivers = len(signals.post_save.receivers)
+
+        pre_save = len(signals.pre_save.receivers)
+        post_delete = len(signals.post_delete.receivers)
+
+        # installing again changes nothing
+        install()
+        install(privacy.get_profile_model())
+        install()
+        self.assertTrue(User.__dict__['relationships'] is descriptor)
+        self.assertEqual(len(signals.post_save.receivers), receivers)
+        self.assertEqual(len(signals.pre_save.receivers), pre_save)
+        self.assertEqual(len(signals.post_delete.receivers), post_delete)
+
+    def test_profile_model(self):
+        self.assertTrue(privacy.get_profile_model() is not None)
+
+        profile_model = privacy.PROFILE_MODEL
+        privacy.PROFILE_MODEL = 'missing.Profile'
+        try:
+            self.assertEqual(privacy.get_profile_model(), None)
+            self.assertEqual(privacy.private_profiles(), None)
+        finally:
+            privacy.PROFILE_MODEL = profile_model
+
     def test_inherited_manager_methods(self):
         # does filter work?
         rel = self.john.relationships.filter(username='Paul')
@@ -183,6 +258,102 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         rel = self.yoko.related_to.all()
         self.assertQuerysetEqual(rel, [])
 
+    def test_sync(self):
+        john_version = get_relationship_version(self.john)
+        paul_version = get_relationship_version(self.paul)
+
+        report = self.john.relationships.sync([self.walrus.pk, self.yoko.pk, self.john.pk, 999])
+        self.assertEqual(list(report.added), [self.walrus.pk])
+        self.assertEqual(list(report.removed), [self.paul.pk])
+        self.assertEqual(report.unchanged, 1)
+        self.assertEqual(list(report.missing), [999])
+
+        self.assertQuerysetEqual(self.john.relationships.following(), [self.walrus, self.yoko])
+        self.assertTrue(Relationship.objects.get(from_user=self.john, to_user=self.walrus).created)
+
+        # caches and rollups are kept up to date
+        self.assertNotEqual(get_relationship_version(self.john), john_version)
+        self.assertNotEqual(get_relationship_version(self.paul), paul_version)
+        self.assertEqual([row[1:] for row in RelationshipRollup.objects.series(self.walrus)], [(1, 0)])
+        self.assertEqual([row[1:] for row in RelationshipRollup.objects.series(self.paul)], [(0, 1)])
+
+        # other statuses are left alone
+        self.assertTrue(self.paul.relationships.exists(self.john, self.blocking))
+
+        # nothing to do
+        report = self.john.relationships.sync([self.yoko.pk, self.walrus.pk], self.following)
+        self.assertEqual((len(report.added), len(report.removed), report.unchanged), (0, 0, 2))
+
+        report = self.john.relationships.sync([], batch_size=1)
+        self.assertEqual(sorted(report.removed), [self.walrus.pk, self.yoko.pk])
+        self.assertQuerysetEqual(self.john.relationships.following(), [])
+
+    def test_sync_expired(self):
+        expired = timezone.now() - datetime.timedelta(days=1)
+        Relationship.objects.filter(from_user=self.john, to_user=self.yoko).update(
+            expires_at=expired)
+        sent = []
+
+        def receiver(sender, **kwargs):
+            sent.append(kwargs)
+        bulk_relationships_changed.connect(receiver, sender=Relationship)
+        try:
+            report = self.john.relationships.sync([self.yoko.pk])
+        finally:
+            bulk_relationships_changed.disconnect(receiver, sender=Relationship)
+
+        # the expired relationship is renewed, not counted as unchanged
+        self.assertEqual(list(report.added), [self.yoko.pk])
+        self.assertEqual(list(report.removed), [self.paul.pk])
+        self.assertEqual(report.unchanged, 0)
+        self.assertQuerysetEqual(self.john.relationships.following(), [self.yoko])
+        self.assertEqual(Relationship.objects.get(
+            from_user=self.john, to_user=self.yoko, status=self.following).expires_at, None)
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(list(sent[0]['renewed']), [self.yoko.pk])
+        self.assertEqual(list(sent[0]['removed']), [self.paul.pk])
+        self.assertEqual([row[1:] for row in RelationshipRollup.objects.series(self.yoko)], [(1, 1)])
+
+    def test_sync_concurrent_add(self):
+        existing = Relationship.objects.filter(from_user=self.walrus, status=self.following)
+        # added by another request after sync() read the current ids
+        self.walrus.relationships.add(self.paul)
+        skipped = models._insert_relationships(
+            existing, [self.john.pk, self.paul.pk, self.yoko.pk],
+            from_user=self.walrus, status=self.following, site_id=1)
+        self.assertEqual(skipped, set([self.paul.pk]))
+        self.assertQuerysetEqual(self.walrus.relationships.following(),
+                                 [self.john, self.paul, self.yoko])
+
+        # other errors are raised
+        self.assertRaises(IntegrityError, models._insert_relationships,
+                          existing, [999], from_user=self.walrus,
+                          status=self.following, site_id=None)
+
+    def test_sync_follower_metric(self):
+        calls = []
+
+        class Task(object):
+            def delay(self, **kwargs):
+                calls.append(kwargs)
+        follower_metric_task = models._follower_metric_task
+        models._follower_metric_task = lambda: Task()
+        try:
+            Relationship.objects.filter(from_user=self.john, to_user=self.yoko).update(
+                expires_at=timezone.now() - datetime.timedelta(days=1))
+            self.john.relationships.sync([self.walrus.pk, self.yoko.pk, self.paul.pk])
+            self.paul.relationships.sync([self.walrus.pk], self.blocking)
+        finally:
+            models._follower_metric_task = follower_metric_task
+
+        # as add() would, for the new follow only
+        self.assertEqual(calls, [{
+            'user': self.walrus,
+            'content_type': ContentType.objects.get_for_model(User),
+            'object_id': self.john.pk,
+        }])
+
     def test_custom_methods(self):
         rel = self.john.relationships.following()
         self.assertQuerysetEqual(rel, [self.paul, self.yoko])
@@ -215,6 +386,32 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         rel = self.paul.relationships.friends()
         self.assertQuerysetEqual(rel, [])
 
+    def test_iterators(self):
+        for i in range(5):
+            User.objects.create(username='fan%d' % i).relationships.add(self.paul)
+        fans = list(User.objects.filter(username__startswith='fan').order_by('pk'))
+        followers = [self.john] + fans
+
+        batches = list(self.paul.relationships.iter_follower_ids(chunk_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 2])
+        self.assertEqual([pk for batch in batches for pk in batch],
+                         sorted(user.pk for user in followers))
+
+        batches = list(self.paul.relationships.iter_followers(chunk_size=4))
+        self.assertEqual([len(batch) for batch in batches], [4, 2])
+        self.assertQuerysetEqual([user for batch in batches for user in batch], followers)
+
+        # pages are read by keyset, one query each plus a final empty one
+        with self.assertNumQueries(2):
+            self.assertEqual(len(list(self.paul.relationships.iter_follower_ids(6, self.following))), 1)
+
+        self.assertEqual(list(self.paul.relationships.iter_following_ids()), [])
+        self.assertEqual([list(batch) for batch in self.john.relationships.iter_following_ids(1)],
+                         [[self.paul.pk], [self.yoko.pk]])
+        self.assertEqual(list(self.john.relationships.iter_following(status=self.blocking)), [])
+        self.assertEqual(list(self.paul.relationships.iter_following(status=self.blocking)),
+                         [[self.john]])
+
     def test_exists(self):
         self.assertTrue(self.john.relationships.exists(self.yoko))
         self.assertTrue(self.john.relationships.exists(self.paul))
@@ -241,6 +438,90 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         self.assertFalse(self.paul.relationships.exists(self.yoko, self.blocking))
         self.assertFalse(self.paul.relationships.exists(self.walrus, self.blocking))
 
+    def test_exists_symmetrical(self):
+        self.assertTrue(self.john.relationships.exists(self.yoko, symmetrical=True))
+        self.assertTrue(self.yoko.relationships.exists(self.john, self.following, True))
+        self.assertFalse(self.john.relationships.exists(self.walrus, symmetrical=True))
+        self.assertFalse(self.john.relationships.exists(self.paul, self.following, True))
+        self.assertFalse(self.john.relationships.exists(self.paul, self.blocking, True))
+        self.assertFalse(self.john.relationships.exists(self.john, symmetrical=True))
+
+        # without a status the two directions may differ, john follows paul
+        # and paul is blocking john
+        self.assertTrue(self.john.relationships.exists(self.paul, symmetrical=True))
+
+        # a single query per check
+        with self.assertNumQueries(1):
+            self.john.relationships.exists(self.yoko, self.following, True)
+        with self.assertNumQueries(1):
+            self.john.relationships.exists(self.yoko)
+
+    def test_exists_memo(self):
+        with relationship_memo():
+            with self.assertNumQueries(2):
+                for i in range(3):
+                    self.assertTrue(self.john.relationships.exists(self.yoko, self.following))
+                    self.assertFalse(self.john.relationships.exists(self.walrus, self.following))
+
+            # writes empty the memo
+            self.john.relationships.add(self.walrus)
+            self.assertTrue(self.john.relationships.exists(self.walrus, self.following))
+
+        # outside of a memo block every check queries
+        with self.assertNumQueries(2):
+            self.john.relationships.exists(self.yoko, self.following)
+            self.john.relationships.exists(self.yoko, self.following)
+
+    def test_list_loading(self):
+        beatles = self.paul.groups.create(name='beatles')
+
+        following = self.john.relationships.following
+        # the status, the users and one query for all their groups
+        with self.assertNumQueries(3):
+            users = list(following(prefetch_related=('groups',)))
+            self.assertEqual([list(user.groups.all()) for user in self._sort_by_pk(users)],
+                             [[beatles], []])
+
+        users = following(only=('username',))
+        self.assertEqual(sorted(user.username for user in users), ['Paul', 'Yoko'])
+        self.assertTrue(all(type(user)._deferred for user in users))
+
+        defaults = models.LIST_SELECT_RELATED, models.LIST_ONLY
+        models.LIST_SELECT_RELATED, models.LIST_ONLY = ('user_profile',), ('username',)
+        try:
+            qs = self.john.relationships.followers()
+            self.assertEqual(qs.query.select_related, {'user_profile': {}})
+            self.assertEqual(qs.query.deferred_loading, (set(['username']), False))
+            qs = self.john.relationships.followers(select_related=(), only=())
+            self.assertFalse(qs.query.select_related or qs.query.deferred_loading[0])
+        finally:
+            models.LIST_SELECT_RELATED, models.LIST_ONLY = defaults
+
+    def test_summary_with(self):
+        with self.assertNumQueries(1):
+            summary = self.john.relationships.summary_with(self.paul)
+        self.assertTrue(summary.following)
+        self.assertFalse(summary.followed_by)
+        self.assertFalse(summary.friends)
+        self.assertFalse(summary.blocking)
+        self.assertTrue(summary.blocked_by)
+        self.assertEqual(summary.outgoing, frozenset(['following']))
+        self.assertEqual(summary.incoming, frozenset(['blocking']))
+
+        summary = self.paul.relationships.summary_with(self.john)
+        self.assertTrue(summary.followed_by)
+        self.assertTrue(summary.blocking)
+
+        summary = self.john.relationships.summary_with(self.yoko)
+        self.assertTrue(summary.friends)
+        self.assertFalse(summary.blocked_by)
+
+        summary = self.walrus.relationships.summary_with(self.john)
+        self.assertFalse(any(summary[:5]))
+
+        # the summary is immutable
+        self.assertRaises(AttributeError, setattr, summary, 'following', True)
+
     def test_oneway_methods(self):
         self.assertQuerysetEqual(self.john.relationships.only_from(self.following), [self.paul])
         self.assertQuerysetEqual(self.john.relationships.only_to(self.following), [])
@@ -248,6 +529,25 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         self.assertQuerysetEqual(self.john.relationships.only_from(self.blocking), [])
         self.assertQuerysetEqual(self.john.relationships.only_to(self.blocking), [self.paul])
 
+        self.walrus.relationships.add(self.john)
+        self.assertQuerysetEqual(self.john.relationships.only_to(self.following), [self.walrus])
+        self.assertQuerysetEqual(self.walrus.relationships.only_from(self.following), [self.john])
+        self.assertQuerysetEqual(self.walrus.relationships.only_to(self.following), [])
+
+        # relationships on other sites are not considered reciprocal
+        Relationship.objects.create(from_user=self.john, to_user=self.walrus,
+                                    status=self.following, site=self.second_site)
+        self.assertQuerysetEqual(self.john.relationships.only_to(self.following), [self.walrus])
+
+    def test_oneway_counts(self):
+        for user in (self.walrus, self.john, self.paul, self.yoko):
+            for status in (self.following, self.blocking):
+                expected = len(user.relationships.only_to(status))
+                with self.assertNumQueries(1):
+                    self.assertEqual(user.relationships.only_to_count(status), expected)
+                self.assertEqual(user.relationships.only_from_count(status),
+                                 len(user.relationships.only_from(status)))
+
     def test_site_behavior(self):
         # relationships are site-dependent
 
@@ -274,6 +574,976 @@ class RelationshipsTestCase(BaseRelationshipsTestCase):
         self.assertQuerysetEqual(self.walrus.relationships.all(), [self.john, self.paul])
 
 
+class RelationshipWeightTestCase(BaseRelationshipsTestCase):
+    def _weight(self, from_user, to_user, status=None):
+        return Relationship.objects.get(from_user=from_user, to_user=to_user,
+                                        status=status or self.following).weight
+
+    def test_strongest(self):
+        self.john.relationships.add(self.walrus)
+        Relationship.objects.filter(from_user=self.john, to_user=self.yoko).update(weight=5.0)
+        Relationship.objects.filter(from_user=self.john, to_user=self.walrus).update(weight=3.0)
+
+        self.assertEqual(self.john.relationships.strongest(), [self.yoko, self.walrus, self.paul])
+        self.assertEqual(self.john.relationships.strongest(k=2), [self.yoko, self.walrus])
+        self.assertEqual(self.john.relationships.strongest(self.blocking), [])
+        self.assertEqual(self.paul.relationships.strongest(self.blocking), [self.john])
+
+        # private users are skipped before counting k
+        self._set_private(self.yoko)
+        self.assertEqual(self.john.relationships.strongest(k=1), [self.walrus])
+
+    def test_record_interactions(self):
+        self.john.relationships.add(self.walrus)
+
+        # three distinct amounts after summing -> three updates
+        with self.assertNumQueries(3):
+            updated = record_interactions([
+                (self.john, self.paul, 1.0),
+                (self.john, self.paul, 1.0),
+                (self.john.pk, self.yoko.pk, 0.5),
+                (self.yoko, self.john, 1.0),
+                (self.john, self.walrus, 2.0),
+                # no relationship, nothing to update
+                (self.walrus, self.john, 2.0),
+            ], self.following)
+        self.assertEqual(updated, 4)
+
+        self.assertEqual(self._weight(self.john, self.paul), 3.0)
+        self.assertEqual(self._weight(self.john, self.yoko), 1.5)
+        self.assertEqual(self._weight(self.yoko, self.john), 2.0)
+        self.assertEqual(self._weight(self.john, self.walrus), 3.0)
+
+        with InteractionBuffer(batch_size=2) as buf:
+            buf.add(self.john, self.paul)
+            buf.add(self.john, self.paul)
+            # flushed once the batch size was reached
+            self.assertEqual(self._weight(self.john, self.paul), 5.0)
+            buf.add(self.john, self.yoko)
+        self.assertEqual(self._weight(self.john, self.yoko), 2.5)
+
+    def test_decay_weights(self):
+        record_interactions([(self.john, self.paul, 1.0)])
+
+        self.assertEqual(decay_weights(0.5, chunk_size=2), 4)
+        self.assertEqual(self._weight(self.john, self.paul), 1.0)
+        self.assertEqual(self._weight(self.john, self.yoko), 0.5)
+        self.assertEqual(self._weight(self.paul, self.john, self.blocking), 0.5)
+
+        self.assertEqual(decay_weights(0.5, self.blocking), 1)
+        self.assertEqual(self._weight(self.john, self.paul), 1.0)
+        self.assertEqual(self._weight(self.paul, self.john, self.blocking), 0.25)
+
+        # the workers would close the connection of the open transaction
+        self.assertRaises(TransactionManagementError, decay_weights, 0.5, processes=2)
+
+
+class RelationshipDecayProcessesTestCase(TransactionTestCase):
+    fixtures = ['relationships.json']
+
+    def setUp(self):
+        if weights._in_memory():
+            self.skipTest('worker processes cannot reach an in-memory database')
+
+    def test_decay_processes(self):
+        self.assertEqual(decay_weights(0.5, chunk_size=1, processes=2), 4)
+        self.assertEqual(set(Relationship.objects.values_list('weight', flat=True)),
+                         set([0.5]))
+
+
+class RelationshipRollupTestCase(BaseRelationshipsTestCase):
+    def _series(self, user, resolution='day'):
+        return [(added, removed) for bucket, added, removed in
+                RelationshipRollup.objects.series(user, resolution=resolution)]
+
+    def test_incremental(self):
+        self.assertEqual(self._series(self.walrus), [])
+
+        self.john.relationships.add(self.walrus)
+        self.paul.relationships.add(self.walrus)
+        self.assertEqual(self._series(self.walrus), [(2, 0)])
+        self.assertEqual(self._series(self.walrus, 'hour'), [(2, 0)])
+
+        self.john.relationships.remove(self.walrus)
+        self.assertEqual(self._series(self.walrus), [(2, 1)])
+
+        # the rollups are kept per status
+        self.yoko.relationships.add(self.walrus, self.blocking)
+        self.assertEqual(self._series(self.walrus), [(2, 1)])
+        self.assertEqual([row[1:] for row in RelationshipRollup.objects.series(
+            self.walrus, self.blocking)], [(1, 0)])
+
+    def test_backfill(self):
+        # the fixture relationships were all created on 2010-03-21
+        self.assertEqual(RelationshipRollup.objects.backfill(chunk_size=3), 4)
+
+        series = RelationshipRollup.objects.series(self.john)
+        self.assertEqual(len(series), 1)
+        self.assertEqual(series[0][0].date(), datetime.date(2010, 3, 21))
+        self.assertEqual(series[0][1:], (1, 0))
+        self.assertEqual(self._series(self.paul), [(1, 0)])
+        self.assertEqual(self._series(self.john, 'hour'), [(1, 0)])
+
+        # counted once, however often it runs
+        self.assertEqual(RelationshipRollup.objects.backfill(), 0)
+        self.assertEqual(self._series(self.paul), [(1, 0)])
+
+    def test_backfill_after_signals(self):
+        RelationshipRollup.objects._marked = False
+        self.walrus.relationships.add(self.paul)
+        self.john.relationships.remove(self.yoko)
+
+        # the relationship counted by the signal handlers is left alone
+        self.assertEqual(RelationshipRollup.objects.backfill(), 3)
+        self.assertEqual(self._series(self.paul), [(1, 0), (1, 0)])
+        self.assertEqual(self._series(self.yoko), [(0, 1)])
+
+        # a reset recounts the existing relationships and keeps the removals
+        self.assertEqual(RelationshipRollup.objects.backfill(reset=True), 4)
+        self.assertEqual(self._series(self.paul), [(1, 0), (1, 0)])
+        self.assertEqual(self._series(self.yoko), [(0, 1)])
+
+
+class RelationshipEventTestCase(BaseRelationshipsTestCase):
+    def _log(self, after=0):
+        return [(e.action, e.from_user_id, e.to_user_id, e.status_id)
+                for e in read_events(after, lag=0)]
+
+    def test_log(self):
+        # fixtures are not logged
+        self.assertEqual(self._log(), [])
+
+        self.walrus.relationships.add(self.john)
+        self.john.relationships.remove(self.yoko, symmetrical=True)
+        self.paul.relationships.sync([self.walrus.pk], self.blocking)
+
+        following, blocking = self.following.pk, self.blocking.pk
+        self.assertEqual(self._log(), [
+            ('add', self.walrus.pk, self.john.pk, following),
+            ('remove', self.john.pk, self.yoko.pk, following),
+            ('remove', self.yoko.pk, self.john.pk, following),
+            ('add', self.paul.pk, self.walrus.pk, blocking),
+            ('remove', self.paul.pk, self.john.pk, blocking),
+        ])
+
+        # recent events are held back until the lag has passed
+        self.assertEqual(read_events(lag=60), [])
+
+    def test_consumer(self):
+        for user in (self.john, self.paul, self.yoko):
+            self.walrus.relationships.add(user)
+
+        consumer = EventConsumer('test', batch_size=2, lag=0)
+        self.assertEqual(consumer.position, 0)
+
+        batches = []
+        self.assertEqual(consumer.consume(batches.append), 3)
+        self.assertEqual([[e.to_user_id for e in batch] for batch in batches],
+                         [[self.john.pk, self.paul.pk], [self.yoko.pk]])
+        self.assertEqual(consumer.position, batches[-1][-1].id)
+
+        # nothing new
+        self.assertEqual(consumer.consume(batches.append), 0)
+
+        # a batch that fails is read again
+        self.walrus.relationships.remove(self.john)
+
+        def fail(events):
+            raise ValueError
+
+        self.assertRaises(ValueError, consumer.consume, fail)
+        self.assertEqual(EventConsumer('test', lag=0).consume(batches.append), 1)
+        self.assertEqual(batches[-1][0].action, 'remove')
+
+        # consumers keep their own checkpoint
+        other = EventConsumer('other', lag=0)
+        self.assertEqual(other.consume(lambda events: None), 4)
+        other.reset()
+        self.assertEqual(other.position, 0)
+
+
+class RelationshipGraphTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        super(RelationshipGraphTestCase, self).setUp()
+        self._enabled, graph.ENABLED = graph.ENABLED, True
+        self._refresh, graph.REFRESH = graph.REFRESH, 60
+        self._lag, graph.EVENT_LAG = graph.EVENT_LAG, 0
+        graph.engine.warm()
+        # the private ids are cached, as they would be in a warm worker
+        privacy.private_user_ids()
+
+    def tearDown(self):
+        super(RelationshipGraphTestCase, self).tearDown()
+        graph.engine.clear()
+        graph.ENABLED, graph.REFRESH, graph.EVENT_LAG = self._enabled, self._refresh, self._lag
+
+    def test_reads(self):
+        john = self.john.relationships
+        with self.assertNumQueries(0):
+            self.assertTrue(john.exists(self.paul, self.following))
+            self.assertTrue(john.exists(self.yoko, self.following, True))
+            self.assertFalse(john.exists(self.paul, self.following, True))
+            self.assertTrue(self.paul.relationships.exists(self.john, self.blocking))
+
+            self.assertEqual(list(john.get_relationship_ids(self.following)),
+                             [self.paul.pk, self.yoko.pk])
+            self.assertEqual(list(john.get_relationship_ids(self.following, True)),
+                             [self.yoko.pk])
+            self.assertEqual(list(john.get_related_to_ids(self.blocking)), [self.paul.pk])
+            self.assertEqual(john.count_relationships(self.following), 2)
+            self.assertEqual(john.count_related_to(self.following), 1)
+
+        # the same answers from the database
+        graph.engine.clear()
+        self.assertEqual(list(john.get_relationship_ids(self.following)),
+                         [self.paul.pk, self.yoko.pk])
+        self.assertEqual(list(john.get_relationship_ids(self.following, True)),
+                         [self.yoko.pk])
+        self.assertEqual(list(john.get_related_to_ids(self.blocking)), [self.paul.pk])
+        self.assertEqual(john.count_relationships(self.following), 2)
+        self.assertEqual(john.count_related_to(self.following), 1)
+
+    def test_updates(self):
+        # changes made by this process inside a transaction, as every test
+        # runs in one, are applied once committed or read from the change log
+        self.walrus.relationships.add(self.john)
+        self.john.relationships.remove(self.paul)
+        self.paul.relationships.sync([self.walrus.pk], self.blocking)
+        graph.engine.checked = 0
+        self.assertTrue(self.walrus.relationships.exists(self.john, self.following))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.walrus.relationships.exists(self.john, self.following))
+            self.assertFalse(self.john.relationships.exists(self.paul, self.following))
+            self.assertEqual(list(self.paul.relationships.get_relationship_ids(self.blocking)),
+                             [self.walrus.pk])
+
+        # changes made elsewhere are read from the change log
+        Relationship.objects.bulk_create([Relationship(
+            from_user=self.yoko, to_user=self.walrus, status=self.following, site_id=1)])
+        RelationshipEvent.objects.record('add', self.yoko.pk, [self.walrus.pk],
+                                         self.following.pk, 1)
+        self.assertFalse(self.yoko.relationships.exists(self.walrus, self.following))
+        graph.engine.checked = 0
+        self.assertTrue(self.yoko.relationships.exists(self.walrus, self.following))
+        self.assertEqual(self.walrus.relationships.count_related_to(self.following), 1)
+
+
+    def test_apply_on_commit(self):
+        # tests never commit, so the change waits for the commit or, without
+        # transaction.on_commit, for the change log
+        graph.engine.apply_on_commit('add', self.walrus.pk, self.yoko.pk,
+                                     self.following.pk, 1)
+        self.assertFalse(graph.engine.graphs[(self.following.pk, 1)].exists(
+            self.walrus.pk, self.yoko.pk))
+
+    def test_max_age(self):
+        started = []
+        engine = graph.engine
+        engine.reload_in_background = lambda *key: started.append(key)
+        max_age, graph.MAX_AGE = graph.MAX_AGE, 0
+        try:
+            old = engine.graphs[(self.following.pk, 1)]
+            Relationship.objects.bulk_create([Relationship(
+                from_user=self.yoko, to_user=self.walrus, status=self.following, site_id=1)])
+            # the stale graph answers while the new one is loaded elsewhere
+            with self.assertNumQueries(0):
+                self.assertFalse(self.yoko.relationships.exists(self.walrus, self.following))
+            self.assertEqual(started[0], (self.following.pk, 1))
+
+            engine.load(self.following.pk, 1)
+            self.assertFalse(engine.graphs[(self.following.pk, 1)] is old)
+            self.assertTrue(self.yoko.relationships.exists(self.walrus, self.following))
+        finally:
+            graph.MAX_AGE = max_age
+            del engine.reload_in_background
+
+
+class RelationshipGraphCommitTestCase(TransactionTestCase):
+    fixtures = ['relationships.json']
+
+    def setUp(self):
+        self._enabled, graph.ENABLED = graph.ENABLED, True
+        self._refresh, graph.REFRESH = graph.REFRESH, 60
+        self.following = RelationshipStatus.objects.following()
+        self.blocking = RelationshipStatus.objects.blocking()
+        self.walrus = User.objects.get(username='The_Walrus')
+        self.john = User.objects.get(username='John')
+        self.paul = User.objects.get(username='Paul')
+        self.yoko = User.objects.get(username='Yoko')
+        graph.engine.warm()
+        privacy.private_user_ids()
+
+    def tearDown(self):
+        graph.engine.clear()
+        graph.ENABLED, graph.REFRESH = self._enabled, self._refresh
+
+    def test_committed_changes(self):
+        # applied as the methods commit, with no catch up to wait for
+        self.walrus.relationships.add(self.john)
+        self.john.relationships.remove(self.paul)
+        self.paul.relationships.sync([self.walrus.pk], self.blocking)
+        self.yoko.relationships.add(self.walrus, symmetrical=True)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.walrus.relationships.exists(self.john, self.following))
+            self.assertFalse(self.john.relationships.exists(self.paul, self.following))
+            self.assertEqual(list(self.paul.relationships.get_relationship_ids(self.blocking)),
+                             [self.walrus.pk])
+            self.assertTrue(self.yoko.relationships.exists(self.walrus, self.following, True))
+
+    def test_rolled_back_changes(self):
+        try:
+            with transaction.atomic():
+                self.walrus.relationships.add(self.yoko)
+                raise ValueError
+        except ValueError:
+            pass
+        with self.assertNumQueries(0):
+            self.assertFalse(self.walrus.relationships.exists(self.yoko, self.following))
+
+
+class RelationshipGraphReloadTestCase(TransactionTestCase):
+    fixtures = ['relationships.json']
+
+    def setUp(self):
+        if weights._in_memory():
+            self.skipTest('other threads cannot reach an in-memory database')
+        self._enabled, graph.ENABLED = graph.ENABLED, True
+        self.following = RelationshipStatus.objects.following()
+        graph.engine.warm()
+
+    def tearDown(self):
+        graph.engine.clear()
+        graph.ENABLED = self._enabled
+
+    def test_reload_in_background(self):
+        walrus = User.objects.get(username='The_Walrus')
+        yoko = User.objects.get(username='Yoko')
+        Relationship.objects.bulk_create([Relationship(
+            from_user=yoko, to_user=walrus, status=self.following, site_id=1)])
+
+        thread = graph.engine.reload_in_background(self.following.pk, 1)
+        # only one reload at a time
+        self.assertEqual(graph.engine.reload_in_background(self.following.pk, 1), None)
+        thread.join()
+        self.assertEqual(graph.engine.reloading, set())
+        self.assertTrue(graph.engine.graphs[(self.following.pk, 1)].exists(yoko.pk, walrus.pk))
+
+
+class RelationshipInfluenceTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        super(RelationshipInfluenceTestCase, self).setUp()
+        self.walrus.relationships.add(self.john)
+        self.paul.relationships.add(self.john)
+
+    def _scores(self):
+        return dict(UserInfluence.objects.values_list('user', 'score'))
+
+    def test_compute_influence(self):
+        report = influence.compute_influence(tolerance=1e-9, max_iterations=500)
+        self.assertEqual((report.users, report.edges), (4, 5))
+        self.assertTrue(report.delta < 1e-9)
+
+        scores = self._scores()
+        self.assertAlmostEqual(sum(scores.values()), 4)
+        # everyone follows john, who follows paul and yoko back
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        self.assertEqual((ranked[0], ranked[-1]), (self.john.pk, self.walrus.pk))
+        self.assertAlmostEqual(scores[self.paul.pk], scores[self.yoko.pk])
+
+        # starting from the stored scores converges straight away
+        warm = influence.compute_influence(tolerance=1e-6)
+        self.assertEqual(warm.iterations, 1)
+        cold = influence.compute_influence(tolerance=1e-6, warm_start=False)
+        self.assertTrue(cold.iterations > warm.iterations)
+
+    @skipIf(influence.numpy is None, 'numpy is not installed')
+    def test_python_fallback(self):
+        influence.compute_influence(tolerance=1e-9, max_iterations=500, warm_start=False)
+        expected = self._scores()
+
+        numpy, influence.numpy = influence.numpy, None
+        try:
+            influence.compute_influence(tolerance=1e-9, max_iterations=500, warm_start=False)
+        finally:
+            influence.numpy = numpy
+        for user_id, score in self._scores().items():
+            self.assertAlmostEqual(score, expected[user_id])
+
+    def test_followers_by_influence(self):
+        # without scores the followers are listed by id
+        self.assertEqual(list(self.john.relationships.followers(order_by='influence')),
+                         [self.walrus, self.paul, self.yoko])
+
+        call_command('compute_relationship_influence', stdout=StringIO())
+        followers = list(self.john.relationships.followers(order_by='influence'))
+        self.assertEqual(followers, [self.paul, self.yoko, self.walrus])
+        self.assertTrue(followers[1].influence > followers[2].influence)
+
+        self.assertRaises(ValueError, self.john.relationships.followers, order_by='name')
+
+
+class RelationshipTypeaheadTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        cache.clear()
+
+    def test_search(self):
+        self.assertEqual(typeahead.search(self.john, 'p'), [(self.paul.pk, 'Paul')])
+        self.assertEqual(typeahead.search(self.john, 'YO'), [(self.yoko.pk, 'Yoko')])
+        self.assertEqual(typeahead.search(self.john, ''), [
+            (self.paul.pk, 'Paul'), (self.yoko.pk, 'Yoko')])
+        self.assertEqual(typeahead.search(self.john, '', limit=1), [(self.paul.pk, 'Paul')])
+        self.assertEqual(typeahead.search(self.john, 'pz'), [])
+        self.assertEqual(typeahead.search(self.john, '', typeahead.FRIENDS),
+                         [(self.yoko.pk, 'Yoko')])
+        self.assertRaises(ValueError, typeahead.search, self.john, 'p', 'blocking')
+
+        # a warm index is searched without touching the database
+        with self.assertNumQueries(0):
+            typeahead.search(self.john, 'y')
+            typeahead.search(self.john, 'y', typeahead.FRIENDS)
+
+    def test_updates(self):
+        typeahead.search(self.john, '')
+        typeahead.search(self.john, '', typeahead.FRIENDS)
+
+        # a warm index costs a follow no queries, the next search builds a
+        # new one
+        with CaptureQueriesContext(connection) as cold:
+            self.yoko.relationships.add(self.paul)
+        typeahead.search(self.yoko, '')
+        with self.assertNumQueries(len(cold.captured_queries)):
+            self.yoko.relationships.add(self.walrus)
+        self.assertEqual(typeahead.search(self.yoko, 't'), [(self.walrus.pk, 'The_Walrus')])
+
+        self.john.relationships.add(self.walrus)
+        self.john.relationships.remove(self.paul)
+        self.john.relationships.add(self.paul, self.blocking)
+        self.assertEqual(typeahead.search(self.john, 'the'), [(self.walrus.pk, 'The_Walrus')])
+        with self.assertNumQueries(0):
+            self.assertEqual(typeahead.search(self.john, 'p'), [])
+
+        self.walrus.relationships.add(self.john)
+        self.yoko.relationships.remove(self.john)
+        self.assertEqual(typeahead.search(self.john, '', typeahead.FRIENDS),
+                         [(self.walrus.pk, 'The_Walrus')])
+        self.assertEqual(typeahead.search(self.walrus, '', typeahead.FRIENDS),
+                         [(self.john.pk, 'John')])
+
+        # bulk changes drop the index, which is rebuilt on the next search
+        self.john.relationships.sync([self.paul.pk])
+        self.assertEqual(typeahead.search(self.john, ''), [(self.paul.pk, 'Paul')])
+
+    def test_view(self):
+        url = reverse('relationship_typeahead')
+        self.assertEqual(self.client.get(url, {'q': 'p'}).status_code, 302)
+
+        self.client.login(username='John', password='John')
+        resp = self.client.get(url, {'q': 'y', 'kind': 'friends'})
+        self.assertEqual(resp['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(resp.content),
+                         {'results': [{'id': self.yoko.pk, 'username': 'Yoko'}]})
+        self.assertEqual(json.loads(self.client.get(url).content), {'results': []})
+        self.assertEqual(self.client.get(url, {'q': 'y', 'kind': 'blocking'}).status_code, 404)
+
+
+class RelationshipExpiryTestCase(BaseRelationshipsTestCase):
+    def _expire(self, from_user, to_user):
+        Relationship.objects.filter(from_user=from_user, to_user=to_user).update(
+            expires_at=timezone.now() - datetime.timedelta(seconds=1))
+
+    def test_add_expires(self):
+        rel = self.walrus.relationships.add(self.john, expires=datetime.timedelta(days=1))
+        self.assertTrue(rel.expires_at > timezone.now())
+        self.assertTrue(self.walrus.relationships.exists(self.john, self.following))
+
+        # adding again replaces the expiry
+        rel = self.walrus.relationships.add(self.john)
+        self.assertEqual(Relationship.objects.get(pk=rel.pk).expires_at, None)
+
+        until = timezone.now() + datetime.timedelta(hours=1)
+        self.walrus.relationships.add(self.paul, symmetrical=True, expires=until)
+        self.assertEqual(set(Relationship.objects.filter(
+            from_user__in=[self.walrus, self.paul], to_user__in=[self.walrus, self.paul]
+        ).values_list('expires_at', flat=True)), set([until]))
+
+    def test_expired_hidden(self):
+        self._expire(self.john, self.yoko)
+        self.assertFalse(self.john.relationships.exists(self.yoko, self.following))
+        self.assertFalse(self.yoko.relationships.exists(self.john, self.following, True))
+        self.assertQuerysetEqual(self.john.relationships.following(), [self.paul])
+        self.assertQuerysetEqual(self.john.relationships.friends(), [])
+        self.assertQuerysetEqual(self.yoko.relationships.followers(), [])
+        self.assertFalse(self.john.relationships.summary_with(self.yoko).following)
+        self.assertFalse(relationship_exists_many([(self.john, self.yoko)])[(self.john, self.yoko)])
+
+        annotated = with_relationship_annotations(User.objects.filter(pk=self.yoko.pk), self.john)
+        self.assertEqual((bool(annotated[0].viewer_follows), annotated[0].follower_count), (False, 0))
+
+        # yoko still follows john, unreciprocated now
+        self.assertQuerysetEqual(self.john.relationships.only_to(self.following), [self.yoko])
+        self.assertQuerysetEqual(self.yoko.relationships.only_from(self.following), [self.john])
+
+    def test_cache_timeout(self):
+        self.walrus.relationships.add(self.john, expires=datetime.timedelta(hours=1))
+        walrus = self.walrus.relationships
+        self.assertTrue(3590 < walrus._cache_timeout(models.FOLLOWING, self.following) <= 3600)
+        self.assertTrue(3590 < walrus._cache_timeout(models.FRIENDS, self.following) <= 3600)
+        self.assertEqual(walrus._cache_timeout(models.FOLLOWERS, self.following),
+                         models.CACHE_TIMEOUT)
+        self.assertTrue(3590 < self.john.relationships._cache_timeout(
+            models.FOLLOWERS + models.COUNT, self.following) <= 3600)
+
+        # an expired relationship doesn't shorten the timeout any more
+        self._expire(self.walrus, self.john)
+        self.assertEqual(walrus._cache_timeout(models.FOLLOWING, self.following),
+                         models.CACHE_TIMEOUT)
+
+    def test_graph(self):
+        enabled, graph.ENABLED = graph.ENABLED, True
+        try:
+            self._expire(self.john, self.yoko)
+            graph.engine.warm()
+            # expired relationships are not loaded
+            self.assertFalse(self.john.relationships.exists(self.yoko, self.following))
+            self.assertEqual(list(self.yoko.relationships.get_related_to_ids(self.following)), [])
+
+            # temporary ones are dropped once they expire
+            self.walrus.relationships.add(self.john, expires=datetime.timedelta(days=1))
+            graph.engine.catch_up()
+            following = graph.engine.graphs[(self.following.pk, 1)]
+            self.assertTrue(following.exists(self.walrus.pk, self.john.pk))
+            following.expire(time.time() + 2 * 86400)
+            self.assertFalse(following.exists(self.walrus.pk, self.john.pk))
+
+            # unless they were made permanent
+            self.walrus.relationships.add(self.john)
+            graph.engine.catch_up()
+            following.expire(time.time() + 2 * 86400)
+            self.assertTrue(following.exists(self.walrus.pk, self.john.pk))
+        finally:
+            graph.engine.clear()
+            graph.ENABLED = enabled
+
+    def test_sweep(self):
+        self.walrus.relationships.add(self.john, expires=datetime.timedelta(days=1))
+        self._expire(self.john, self.yoko)
+        self._expire(self.john, self.paul)
+
+        self.assertEqual(sweep_expired(batch_size=1, max_batches=1), 1)
+        call_command('sweep_expired_relationships', stdout=StringIO())
+        self.assertFalse(Relationship.objects.filter(from_user=self.john).exists())
+        self.assertTrue(self.walrus.relationships.exists(self.john, self.following))
+
+        # deletions reach the change log like any other removal
+        self.assertEqual(RelationshipEvent.objects.filter(
+            action=RelationshipEvent.REMOVED, from_user_id=self.john.pk).count(), 2)
+        self.assertEqual(sweep_expired(), 0)
+
+
+class GenericRelationshipTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        self.user_type = ContentType.objects.get_for_model(User)
+        self.site_type = ContentType.objects.get_for_model(Site)
+
+    def test_follow_objects(self):
+        self.john.relationships.follow_object(self.site)
+        self.paul.relationships.follow_object(self.site)
+        self.john.relationships.follow_object(self.user_type)
+        self.john.relationships.follow_object(self.site_type, self.blocking)
+
+        self.assertTrue(self.john.relationships.follows_object(self.site))
+        self.assertFalse(self.yoko.relationships.follows_object(self.site))
+        self.assertQuerysetEqual(GenericRelationship.objects.followers_of(self.site),
+                                 [self.john, self.paul])
+        self.assertQuerysetEqual(views._followers_of(self.site), [self.john, self.paul])
+        self.assertQuerysetEqual(views._followers_of(self.yoko), [self.john])
+
+        # the status, the relationships, then one query per content type
+        with self.assertNumQueries(4):
+            self.assertEqual(self.john.relationships.followed_objects(),
+                             [self.user_type, self.site])
+        self.assertEqual(self.john.relationships.followed_objects(model=Site), [self.site])
+        self.assertEqual(self.john.relationships.followed_objects(self.blocking),
+                         [self.site_type])
+
+        self.john.relationships.unfollow_object(self.site)
+        self.assertFalse(self.john.relationships.follows_object(self.site))
+        self.assertQuerysetEqual(GenericRelationship.objects.followers_of(self.site), [self.paul])
+
+    def test_missing_targets(self):
+        other = Site.objects.create(name='ex2.com', domain='ex2.com')
+        self.john.relationships.follow_object(other)
+        relationships = GenericRelationship.objects.filter(from_user=self.john)
+        other.delete()
+
+        resolved = GenericRelationship.objects.resolve_targets(relationships)
+        with self.assertNumQueries(0):
+            self.assertEqual([rel.target for rel in resolved], [None])
+        self.assertEqual(self.john.relationships.followed_objects(), [])
+
+    def test_cache_versions(self):
+        self.assertEqual(target_version_id(self.user_type.pk, '3'), 3)
+        key = target_version_id(self.site_type.pk, self.site.pk)
+        self.assertEqual(key, '%s.%s' % (self.site_type.pk, self.site.pk))
+
+        versions = get_relationship_version(key), get_relationship_version(self.john)
+        self.john.relationships.follow_object(self.site)
+        self.assertNotEqual(get_relationship_version(key), versions[0])
+        self.assertNotEqual(get_relationship_version(self.john), versions[1])
+
+
+class RelationshipWarmTestCase(BaseRelationshipsTestCase):
+    def test_hot_users(self):
+        # the fixtures' relationships only reach the rollups when backfilled
+        RelationshipRollup.objects.backfill()
+        self.walrus.relationships.add(self.paul)
+        self.yoko.relationships.add(self.walrus)
+        self.yoko.relationships.remove(self.walrus)
+        self.assertEqual(warm.hot_users(2), [self.paul.pk, self.john.pk])
+        self.assertEqual(warm.hot_users(5, status=self.blocking), [self.john.pk])
+
+        now = timezone.now()
+        record = RelationshipRollup.objects.record
+        record(self.yoko.pk, self.following.pk, 1, now, added=3)
+        record(self.john.pk, self.following.pk, 1, now, added=2)
+        record(self.walrus.pk, self.following.pk, 1, now - datetime.timedelta(days=10), added=9)
+        self.assertEqual(warm.hot_users(2, warm.BY_RECENT), [self.yoko.pk, self.john.pk])
+        self.assertEqual(warm.hot_users(5, warm.BY_RECENT, days=30)[0], self.walrus.pk)
+
+        self.assertRaises(ValueError, warm.hot_users, 5, 'influence')
+
+    def test_warm_users(self):
+        users = [self.walrus, self.john, self.paul, self.yoko]
+        report = warm.warm_users([user.pk for user in users], batch_size=3, threads=2,
+                                 views=False)
+        self.assertEqual(report.users, 4)
+        # 6 keys per user and status, and two typeahead indexes per user
+        self.assertEqual(report.keys, 4 * 2 * 6 + 4 * 2)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(self.john.relationships.get_relationship_ids(
+                self.following)), [self.paul.pk, self.yoko.pk])
+            self.assertEqual(list(self.john.relationships.get_relationship_ids(
+                self.following, True)), [self.yoko.pk])
+            self.assertEqual(list(self.john.relationships.get_related_to_ids(
+                self.following)), [self.yoko.pk])
+            self.assertEqual(self.john.relationships.count_related_to(self.blocking), 1)
+            self.assertEqual(self.paul.relationships.count_relationships(self.blocking), 1)
+            self.assertEqual(self.walrus.relationships.count_relationships(self.following), 0)
+            self.assertEqual(RelationshipStatus.objects.resolve_slug('blockers'),
+                             (self.blocking, 'to'))
+        with self.assertNumQueries(0):
+            self.assertEqual(typeahead.search(self.john, 'p'), [(self.paul.pk, 'Paul')])
+            self.assertEqual(typeahead.search(self.john, '', typeahead.FRIENDS),
+                             [(self.yoko.pk, 'Yoko')])
+
+        # the warmed entries are not used once the relationships change
+        self.walrus.relationships.add(self.john)
+        self.assertEqual(list(self.john.relationships.get_related_to_ids(self.following)),
+                         [self.walrus.pk, self.yoko.pk])
+        self.assertEqual(self.walrus.relationships.count_relationships(self.following), 1)
+
+    def test_temporary_relationships(self):
+        # entries with a temporary relationship are left to the read path,
+        # which caches them until the relationship expires
+        self.walrus.relationships.add(self.paul, expires=datetime.timedelta(hours=1))
+        report = warm.warm_users([self.walrus.pk, self.paul.pk, self.yoko.pk],
+                                 [self.following], views=False)
+        self.assertEqual(report.keys, 6 + 3 * 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(self.yoko.relationships.get_relationship_ids(
+                self.following)), [self.john.pk])
+
+    def test_private_users(self):
+        self._set_private(self.yoko)
+        warm.warm_users([self.john.pk], views=False)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(self.john.relationships.get_relationship_ids(
+                self.following)), [self.paul.pk])
+            self.assertEqual(self.john.relationships.count_related_to(self.following), 0)
+
+    def test_command(self):
+        out = StringIO()
+        RelationshipRollup.objects.backfill()
+        call_command('warm_relationship_cache', limit=2, threads=1, views=False, stdout=out)
+        self.assertTrue(out.getvalue().startswith('Warmed 28 keys for 2 users'))
+
+    def test_views(self):
+        try:
+            loader.get_template('relationships/render_friend_list_all.html')
+        except TemplateSyntaxError:
+            self.skipTest('the list templates need tag libraries which are not installed')
+
+        report = warm.warm_users([self.paul.pk], [self.following])
+        self.assertEqual(report.keys, 6 + 2 + 4)
+        content_type = ContentType.objects.get_for_model(User).pk
+        with self.assertNumQueries(0):
+            for name in ('get_followers', 'get_following'):
+                response = self.client.get(reverse(name, args=[content_type, self.paul.pk]))
+                self.assertEqual(response.status_code, 200)
+
+
+class RelationshipCoalesceTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        cache.clear()
+        self.scheduled = []
+        self._window, coalesce.WINDOW = coalesce.WINDOW, 5
+        self._schedule_flush = coalesce._schedule_flush
+        coalesce._schedule_flush = lambda *args: self.scheduled.append(args)
+        # the flushes below run in this process, which sees its own cache
+        self._shared_cache = coalesce._shared_cache
+        coalesce._shared_cache = lambda: True
+
+    def tearDown(self):
+        coalesce.WINDOW = self._window
+        coalesce._schedule_flush = self._schedule_flush
+        coalesce._shared_cache = self._shared_cache
+        BaseRelationshipsTestCase.tearDown(self)
+
+    def _flush(self):
+        scheduled, self.scheduled = self.scheduled, []
+        return [coalesce.flush_relationship_change(*args) for args in scheduled]
+
+    def test_toggles_coalesced(self):
+        for add in (True, False, True, False, True):
+            coalesce.submit_relationship_change(self.john, self.walrus, self.following, add)
+
+        # nothing is written until the flush, which is scheduled only once
+        self.assertFalse(self.john.relationships.exists(self.walrus))
+        self.assertEqual(self.scheduled, [(self.john.pk, self.walrus.pk, self.following.pk)])
+
+        self.assertEqual(self._flush(), [True])
+        self.assertTrue(self.john.relationships.exists(self.walrus, self.following))
+
+        # toggling back and forth to the current state writes nothing
+        coalesce.submit_relationship_change(self.john, self.walrus, self.following, False)
+        coalesce.submit_relationship_change(self.john, self.walrus, self.following, True)
+        self.assertEqual(self._flush(), [False])
+        self.assertTrue(self.john.relationships.exists(self.walrus, self.following))
+
+        coalesce.submit_relationship_change(self.john, self.yoko, self.following, False, True)
+        self.assertEqual(self._flush(), [True])
+        self.assertFalse(self.john.relationships.exists(self.yoko))
+        self.assertFalse(self.yoko.relationships.exists(self.john))
+
+    def test_concurrent_flush(self):
+        coalesce.submit_relationship_change(self.john, self.walrus, self.following, True)
+        args = self.scheduled[0]
+
+        # a flush already running for this pair defers the second one
+        _, _, lock_key = coalesce._keys(*args)
+        cache.add(lock_key, True)
+        self.assertEqual(self._flush(), [False])
+        self.assertEqual(self.scheduled, [args])
+        self.assertFalse(self.john.relationships.exists(self.walrus))
+
+        cache.delete(lock_key)
+        self.assertEqual(self._flush(), [True])
+        self.assertTrue(self.john.relationships.exists(self.walrus))
+
+    def test_no_window(self):
+        coalesce.WINDOW = 0
+        coalesce.submit_relationship_change(self.john, self.walrus, self.following, True)
+        self.assertTrue(self.john.relationships.exists(self.walrus))
+        self.assertEqual(self.scheduled, [])
+
+    def test_local_cache(self):
+        # a worker could never read a request kept in a per-process cache
+        coalesce._shared_cache = self._shared_cache
+        with self.settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                CELERY_ALWAYS_EAGER=False):
+            self.assertFalse(coalesce._shared_cache())
+            coalesce.submit_relationship_change(self.john, self.walrus, self.following, True)
+        self.assertTrue(self.john.relationships.exists(self.walrus))
+        self.assertEqual(self.scheduled, [])
+
+        with self.settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}}):
+            self.assertTrue(coalesce._shared_cache())
+
+
+class ParallelEquivalenceMixin(object):
+    # (sync method, concurrent method) pairs which must agree for every user
+    LIST_MATRIX = (
+        ('following', 'afollowing'),
+        ('followers', 'afollowers'),
+        ('friends', 'afriends'),
+    )
+
+    def assertEquivalent(self):
+        for user in self.users:
+            for sync_name, async_name in self.LIST_MATRIX:
+                self.assertEqual(
+                    sorted(u.pk for u in getattr(user.relationships, async_name)().get(5)),
+                    sorted(u.pk for u in getattr(user.relationships, sync_name)()))
+
+            for other in self.users:
+                for status in (None, self.following, self.blocking):
+                    for symmetrical in (False, True):
+                        self.assertEqual(
+                            user.relationships.aexists(other, status, symmetrical).get(5),
+                            user.relationships.exists(other, status, symmetrical))
+
+    def test_equivalence(self):
+        self.assertEquivalent()
+
+        result = self.walrus.relationships.aadd(self.john, symmetrical=True,
+                                                expires=datetime.timedelta(days=1))
+        # written in this thread, before aadd() returns
+        self.assertTrue(result.ready())
+        self.assertTrue(self.walrus.relationships.exists(self.john, self.following, True))
+        self.assertTrue(result.get()[0].expires_at > timezone.now())
+        self.assertEquivalent()
+
+        self.john.relationships.aremove(self.yoko).get()
+        self.assertFalse(self.john.relationships.exists(self.yoko))
+        self.assertEquivalent()
+
+
+class RelationshipParallelTestCase(ParallelEquivalenceMixin, BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        # the in-memory test database is not visible from other threads
+        self._inline = getattr(settings, 'RELATIONSHIPS_ASYNC_INLINE', False)
+        settings.RELATIONSHIPS_ASYNC_INLINE = True
+        self.users = [self.walrus, self.john, self.paul, self.yoko]
+
+    def tearDown(self):
+        settings.RELATIONSHIPS_ASYNC_INLINE = self._inline
+        BaseRelationshipsTestCase.tearDown(self)
+
+    def test_writes_in_transaction(self):
+        # the write joins the caller's transaction and rolls back with it
+        try:
+            with transaction.atomic():
+                settings.RELATIONSHIPS_ASYNC_INLINE = False
+                self.walrus.relationships.aadd(self.yoko).get()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(self.walrus.relationships.exists(self.yoko))
+
+    def test_profile_relationships(self):
+        state = parallel.profile_relationships(self.john, self.paul)
+        self.assertEqual(state, {
+            'followers_count': self.paul.relationships.followers().count(),
+            'following_count': self.paul.relationships.following().count(),
+            'following': True,
+            'followed_by': False,
+            'blocking': False,
+            'blocked_by': True,
+        })
+
+    def test_threads(self):
+        settings.RELATIONSHIPS_ASYNC_INLINE = False
+        results = [parallel.run(pow, 2, n) for n in range(10)]
+        self.assertEqual([result.get(5) for result in results], [2 ** n for n in range(10)])
+
+        # errors are raised by get(), in either mode
+        self.assertRaises(ZeroDivisionError, parallel.run(divmod, 1, 0).get, 5)
+        settings.RELATIONSHIPS_ASYNC_INLINE = True
+        self.assertRaises(ZeroDivisionError, parallel.run(divmod, 1, 0).get)
+
+
+class RelationshipParallelThreadsTestCase(ParallelEquivalenceMixin, TransactionTestCase):
+    fixtures = ['relationships.json']
+
+    def setUp(self):
+        if weights._in_memory():
+            self.skipTest('other threads cannot reach an in-memory database')
+        self._inline = getattr(settings, 'RELATIONSHIPS_ASYNC_INLINE', False)
+        settings.RELATIONSHIPS_ASYNC_INLINE = False
+        self.walrus = User.objects.get(username='The_Walrus')
+        self.john = User.objects.get(username='John')
+        self.paul = User.objects.get(username='Paul')
+        self.yoko = User.objects.get(username='Yoko')
+        self.users = [self.walrus, self.john, self.paul, self.yoko]
+        self.following = RelationshipStatus.objects.following()
+        self.blocking = RelationshipStatus.objects.blocking()
+        cache.clear()
+
+    def tearDown(self):
+        settings.RELATIONSHIPS_ASYNC_INLINE = self._inline
+
+
+class RelationshipPrivacyTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        self.profile_model = privacy.get_profile_model()
+
+    def test_lists_exclude_private(self):
+        self._set_private(self.yoko)
+
+        qs = self.john.relationships.following()
+        # filtered by the profile table, not by a list of ids
+        self.assertTrue('is_private' in str(qs.query))
+        self.assertQuerysetEqual(qs, [self.paul])
+        self.assertQuerysetEqual(self.john.relationships.followers(), [])
+        self.assertEqual(self.john.relationships.strongest(), [self.paul])
+        self.assertEqual([list(ids) for ids in self.john.relationships.iter_following_ids()],
+                         [[self.paul.pk]])
+
+    def test_profile_signals(self):
+        version = privacy.privacy_version()
+        profiles = self.profile_model._default_manager
+
+        # saving a profile without changing its privacy keeps the version
+        profile = profiles.create(user=self.paul)
+        profile.save()
+        self.assertEqual(privacy.privacy_version(), version)
+
+        profile.is_private = True
+        profile.save()
+        self.assertNotEqual(privacy.privacy_version(), version)
+        self.assertEqual(privacy.private_user_ids(), frozenset([self.paul.pk]))
+
+        version = privacy.privacy_version()
+        profile.delete()
+        self.assertNotEqual(privacy.privacy_version(), version)
+        self.assertEqual(privacy.private_user_ids(), frozenset())
+
+        # other models are ignored
+        version = privacy.privacy_version()
+        privacy.profile_deleted(User, profile)
+        self.assertEqual(privacy.privacy_version(), version)
+
+    def test_verify(self):
+        profile = self.profile_model._default_manager.create(user=self.yoko)
+        privacy.private_user_ids()
+        # changed behind the signals' back
+        self.profile_model._default_manager.filter(pk=profile.pk).update(is_private=True)
+        self.assertEqual(privacy.verify_private_user_ids(batch_size=1),
+                         (set([self.yoko.pk]), set()))
+
+        privacy.invalidate_private_user_ids()
+        self.assertEqual(privacy.verify_private_user_ids(), (set(), set()))
+
+    def test_repair_command(self):
+        profile = self.profile_model._default_manager.create(user=self.yoko)
+        privacy.private_user_ids()
+        self.profile_model._default_manager.filter(pk=profile.pk).update(is_private=True)
+
+        out = StringIO()
+        call_command('repair_relationship_privacy', batch_size=1, stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[:2], [
+            'Private users missing from the set: %s' % self.yoko.pk,
+            'Users wrongly in the set: none',
+        ])
+        self.assertEqual(privacy.private_user_ids(), frozenset([self.yoko.pk]))
+
+    def test_verify_without_profiles(self):
+        get_profile_model = privacy.get_profile_model
+        privacy.get_profile_model = lambda: None
+        try:
+            self.assertEqual(privacy.verify_private_user_ids(), (set(), set()))
+        finally:
+            privacy.get_profile_model = get_profile_model
+
+
 class RelationshipsListenersTestCase(BaseRelationshipsTestCase):
     def setUp(self):
         BaseRelationshipsTestCase.setUp(self)
@@ -300,6 +1570,15 @@ class RelationshipsListenersTestCase(BaseRelationshipsTestCase):
         self.assertQuerysetEqual(self.paul.relationships.following(), [self.john])
         self.assertQuerysetEqual(self.paul.relationships.blocking(), [])
 
+    def test_sync(self):
+        # relationships added in bulk are exclusive just the same
+        self.john.relationships.sync([self.yoko.pk, self.paul.pk], self.blocking)
+        self.assertQuerysetEqual(self.john.relationships.blocking(), [self.paul, self.yoko])
+        self.assertQuerysetEqual(self.john.relationships.following(), [])
+
+        self.paul.relationships.sync([self.john.pk], self.following)
+        self.assertQuerysetEqual(self.paul.relationships.blocking(), [])
+
     def test_listener_disconnecting(self):
         # this test simply ensures the default behavior
         detach_relationship_listener()
@@ -474,6 +1753,81 @@ class RelationshipsTagsTestCase(BaseRelationshipsTestCase):
         url = reverse('relationship_add', args=['Paul', 'blocking'])
         self.assertEqual(rendered, url)
 
+    def test_url_builder(self):
+        values = ['Paul', 'john-doe_2', 'john.doe', 'a+b@c.com', u'J\xf6rg', 'x%20y', 'sl/ash']
+        for username in values:
+            for slug in ('following', 'friends', 'has space'):
+                for name in ('relationship_add', 'relationship_remove'):
+                    kwargs = dict(username=username, status_slug=slug)
+                    try:
+                        expected = reverse(name, kwargs=kwargs)
+                    except NoReverseMatch:
+                        self.assertRaises(NoReverseMatch, url_for, name, **kwargs)
+                    else:
+                        self.assertEqual(url_for(name, **kwargs), expected)
+
+        for object_id in (1, '42', 'x'):
+            kwargs = dict(content_type_id=3, object_id=object_id, sIndex=0, lIndex='10')
+            for name in ('get_followers', 'get_following'):
+                args = dict(content_type_id=3, object_id=object_id)
+                if object_id == 'x':
+                    self.assertRaises(NoReverseMatch, url_for, name, **args)
+                else:
+                    self.assertEqual(url_for(name, **args), reverse(name, kwargs=args))
+            for name in ('get_follower_subset', 'get_following_subset'):
+                if object_id == 'x':
+                    self.assertRaises(NoReverseMatch, url_for, name, **kwargs)
+                else:
+                    self.assertEqual(url_for(name, **kwargs), reverse(name, kwargs=kwargs))
+
+        # safe values are filled into a template reversed once
+        template = get_template('relationship_add', ['username', 'status_slug'])
+        self.assertEqual(template % {'username': 'Paul', 'status_slug': 'following'},
+                         reverse('relationship_add', args=['Paul', 'following']))
+
+        # each script prefix has a template of its own
+        prefix = get_script_prefix()
+        set_script_prefix('/mounted/')
+        try:
+            self.assertEqual(url_for('relationship_add', username='Paul', status_slug='following'),
+                             reverse('relationship_add', args=['Paul', 'following']))
+        finally:
+            set_script_prefix(prefix)
+            clear_templates()
+
+        # and so does each language, for i18n_patterns and translated urls
+        url_for('relationship_add', username='Paul', status_slug='following')
+        with translation.override('fr'):
+            self.assertEqual(url_for('relationship_add', username='Paul', status_slug='following'),
+                             reverse('relationship_add', args=['Paul', 'following']))
+        self.assertEqual(len(urlbuilder._templates), 2)
+        clear_templates()
+
+    def test_info_url_tags(self):
+        content_type = ContentType.objects.get_for_model(User).pk
+        t = Template('{% load relationship_tags %}{% follower_info_url user %} '
+                     '{% following_info_url user %} {% follower_subset_url user 0 10 as s %}{{ s }}')
+        self.assertEqual(t.render(Context({'user': self.paul})), ' '.join([
+            reverse('get_followers', args=[content_type, self.paul.pk]),
+            reverse('get_following', args=[content_type, self.paul.pk]),
+            reverse('get_follower_subset', args=[content_type, self.paul.pk, 0, 10]),
+        ]))
+
+    def test_relationship_summary_tag(self):
+        t = Template('{% load relationship_tags %}'
+                     '{% relationship_summary viewer owner as rel %}'
+                     '{% if rel.following %}following {% endif %}'
+                     '{% if rel.friends %}friends {% endif %}'
+                     '{% if rel.blocked_by %}blocked{% endif %}')
+        c = Context({'viewer': self.john, 'owner': self.paul})
+        self.assertEqual(t.render(c), 'following blocked')
+
+        c = Context({'viewer': self.john, 'owner': self.yoko})
+        self.assertEqual(t.render(c), 'following friends ')
+
+        c = Context({'viewer': AnonymousUser(), 'owner': self.yoko})
+        self.assertEqual(t.render(c), '')
+
     def test_remove_url_filter(self):
         t = Template('{% load relationship_tags %}{{ user|remove_relationship_url:"following" }}')
         c = Context({'user': self.paul})
@@ -582,6 +1936,95 @@ class RelationshipsTagsTestCase(BaseRelationshipsTestCase):
         self.assertEqual(rendered, 'beatles|')
 
 
+class RelationshipsCacheTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        BaseRelationshipsTestCase.setUp(self)
+        cache.clear()
+
+    def test_version_bumped(self):
+        john_version = get_relationship_version(self.john)
+        walrus_version = get_relationship_version(self.walrus)
+        yoko_version = get_relationship_version(self.yoko)
+
+        # reads are stable
+        self.assertEqual(get_relationship_version(self.john), john_version)
+
+        self.john.relationships.add(self.walrus)
+        self.assertNotEqual(get_relationship_version(self.john), john_version)
+        self.assertNotEqual(get_relationship_version(self.walrus), walrus_version)
+
+        # uninvolved users keep their version
+        self.assertEqual(get_relationship_version(self.yoko), yoko_version)
+
+        walrus_version = get_relationship_version(self.walrus)
+        self.john.relationships.remove(self.walrus)
+        self.assertNotEqual(get_relationship_version(self.walrus), walrus_version)
+
+    def test_versioned_cache_key(self):
+        key = versioned_cache_key('test', [self.john, self.paul], 'a')
+        self.assertEqual(key, versioned_cache_key('test', [self.john.pk, self.paul.pk], 'a'))
+        self.assertNotEqual(key, versioned_cache_key('test', [self.john, self.paul], 'b'))
+
+        self.paul.relationships.add(self.yoko)
+        self.assertNotEqual(key, versioned_cache_key('test', [self.john, self.paul], 'a'))
+
+    def test_relationship_cache_tag(self):
+        t = Template('{% load relationship_tags %}{% relationship_cache "button" john paul %}'
+                     '{% if_relationship john paul "following" %}y{% else %}n{% endif_relationship %}'
+                     '{% endrelationship_cache %}')
+        c = Context({'john': self.john, 'paul': self.paul})
+        self.assertEqual(t.render(c), 'y')
+
+        # a relationship change involving one of the users invalidates the fragment
+        self.john.relationships.remove(self.paul)
+        self.assertEqual(t.render(c), 'n')
+
+        # changes that do not involve either user leave it cached
+        Relationship.objects.filter(from_user=self.walrus).delete()
+        Relationship.objects.create(from_user=self.john, to_user=self.paul,
+                                    status=self.following, site=self.site)
+        key = versioned_cache_key('button', [self.john, self.paul])
+        cache.set(key, 'cached')
+        self.yoko.relationships.add(self.walrus)
+        self.assertEqual(t.render(c), 'cached')
+
+    def test_relationship_cache_tag_expiry(self):
+        t = Template('{% load relationship_tags %}{% relationship_cache "button" walrus john %}'
+                     '{% if_relationship walrus john "following" %}y{% else %}n{% endif_relationship %}'
+                     '{% endrelationship_cache %}')
+        c = Context({'walrus': self.walrus, 'john': self.john})
+        self.walrus.relationships.add(self.john, expires=datetime.timedelta(seconds=1))
+        self.assertEqual(t.render(c), 'y')
+
+        # expiring bumps no version, the fragment is only cached until then
+        time.sleep(1.1)
+        self.assertEqual(t.render(c), 'n')
+
+    def test_cache_follow_list_expiry(self):
+        @cache_follow_list
+        def following(request, content_type_id, object_id):
+            user = User.objects.get(pk=object_id)
+            return HttpResponse(','.join(u.username for u in user.relationships.following()))
+
+        user_type = ContentType.objects.get_for_model(User)
+        request = RequestFactory().get('/following/')
+        request.user = self.paul
+        self.walrus.relationships.add(self.john, expires=datetime.timedelta(seconds=1))
+        self.assertEqual(following(request, user_type.pk, self.walrus.pk).content, 'John')
+
+        time.sleep(1.1)
+        self.assertEqual(following(request, user_type.pk, self.walrus.pk).content, '')
+
+        # and a temporary relationship of the viewer bounds it just the same
+        self.paul.relationships.add(self.yoko, expires=datetime.timedelta(seconds=1))
+        self.walrus.relationships.add(self.john)
+        self.assertEqual(following(request, user_type.pk, self.walrus.pk).content, 'John')
+        Relationship.objects.filter(from_user=self.walrus).update(
+            expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        time.sleep(1.1)
+        self.assertEqual(following(request, user_type.pk, self.walrus.pk).content, '')
+
+
 class RelationshipStatusAdminFormTestCase(BaseRelationshipsTestCase):
     def test_no_dupes(self):
         payload = {
@@ -636,6 +2079,191 @@ class RelationshipStatusAdminFormTestCase(BaseRelationshipsTestCase):
         self.assertTrue('from_slug' in form.errors)
 
 
+
+
+class RelationshipStatusSlugTestCase(BaseRelationshipsTestCase):
+    def test_registry(self):
+        # the fixture statuses are registered even though loaded raw
+        self.assertEqual(
+            sorted(self.following.slugs.values_list('slug', 'direction')),
+            [('followers', 'to'), ('following', 'from'), ('friends', 'symmetrical')])
+
+        self.following.to_slug = 'fans'
+        self.following.save()
+        self.assertEqual(
+            sorted(self.following.slugs.values_list('slug', flat=True)),
+            ['fans', 'following', 'friends'])
+
+        self.following.delete()
+        self.assertFalse(RelationshipStatusSlug.objects.filter(slug='following').exists())
+
+    def test_resolve_slug(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(RelationshipStatus.objects.resolve_slug('following'),
+                             (self.following, 'from'))
+        self.assertEqual(RelationshipStatus.objects.resolve_slug('followers'),
+                         (self.following, 'to'))
+        self.assertEqual(RelationshipStatus.objects.resolve_slug('friends'),
+                         (self.following, 'symmetrical'))
+        self.assertEqual(RelationshipStatus.objects.by_slug('blockers'), self.blocking)
+
+    def test_fill(self):
+        RelationshipStatusSlug.objects.all().delete()
+        out = StringIO()
+        call_command('fill_relationship_status_slugs', stdout=out)
+        self.assertEqual(out.getvalue(), 'Registered 6 relationship status slugs\n')
+        with self.assertNumQueries(1):
+            self.assertEqual(RelationshipStatus.objects.resolve_slug('blockers'),
+                             (self.blocking, 'to'))
+
+    def test_concurrent_sync(self):
+        manager = RelationshipStatusSlug.objects
+        bulk_create = manager.bulk_create
+
+        def racing_bulk_create(objs):
+            # another request registers the same slugs first
+            for obj in objs:
+                RelationshipStatusSlug.objects.create(
+                    slug=obj.slug, status=obj.status, direction=obj.direction)
+            return bulk_create(objs)
+
+        RelationshipStatusSlug.objects.all().delete()
+        manager.bulk_create = racing_bulk_create
+        try:
+            self.assertEqual(RelationshipStatus.objects.resolve_slug('following'),
+                             (self.following, 'from'))
+        finally:
+            del manager.bulk_create
+
+        # the racing rows went with the savepoint here, a real concurrent
+        # request commits its own and the next lookup finds them
+        self.assertFalse(RelationshipStatusSlug.objects.exists())
+        self.assertEqual(RelationshipStatus.objects.by_slug('following'), self.following)
+        self.assertTrue(RelationshipStatusSlug.objects.filter(slug='following').exists())
+        self.assertRaises(RelationshipStatus.DoesNotExist,
+                          RelationshipStatus.objects.resolve_slug, 'unknown')
+
+    def test_unregistered_status(self):
+        # a status saved before the registry existed is found the slow way
+        # once, and registered on the way
+        RelationshipStatusSlug.objects.filter(status=self.blocking).delete()
+        self.assertEqual(RelationshipStatus.objects.resolve_slug('blockers'),
+                         (self.blocking, 'to'))
+        with self.assertNumQueries(1):
+            self.assertEqual(RelationshipStatus.objects.resolve_slug('blocking'),
+                             (self.blocking, 'from'))
+
+class RelationshipAdminTestCase(BaseRelationshipsTestCase):
+    def setUp(self):
+        super(RelationshipAdminTestCase, self).setUp()
+        self.request = RequestFactory().get('/')
+        self.request.user = self.walrus
+
+    def test_paginator(self):
+        # sqlite has no row estimate, so the paginator counts exactly
+        qs = Relationship.objects.all()
+        paginator = EstimatedCountPaginator(qs, 2)
+        self.assertEqual(paginator.count, 4)
+        self.assertEqual(paginator.num_pages, 2)
+
+        paginator = EstimatedCountPaginator(qs.filter(status=self.blocking), 2)
+        self.assertEqual(paginator.count, 1)
+
+    def test_changelist_queryset(self):
+        model_admin = admin.site._registry[Relationship]
+        self.assertTrue(isinstance(model_admin, RelationshipAdmin))
+
+        cl = model_admin.get_changelist(self.request)(
+            self.request, Relationship, model_admin.list_display,
+            model_admin.list_display_links, model_admin.list_filter,
+            model_admin.date_hierarchy, model_admin.search_fields,
+            model_admin.list_select_related, model_admin.list_per_page,
+            model_admin.list_max_show_all, model_admin.list_editable,
+            model_admin)
+        qs = cl.get_queryset(self.request)
+        with self.assertNumQueries(1):
+            rows = [unicode(r) for r in qs]
+        self.assertEqual(len(rows), 4)
+
+        # filtered, only the matching rows are counted: the status and site
+        # filter choices, the count and the page, without a count of all rows
+        request = RequestFactory().get('/', {'status__id__exact': self.blocking.pk})
+        request.user = self.walrus
+        with self.assertNumQueries(4):
+            cl = model_admin.get_changelist(request)(
+                request, Relationship, model_admin.list_display,
+                model_admin.list_display_links, model_admin.list_filter,
+                model_admin.date_hierarchy, model_admin.search_fields,
+                model_admin.list_select_related, model_admin.list_per_page,
+                model_admin.list_max_show_all, model_admin.list_editable,
+                model_admin)
+            list(cl.result_list)
+        self.assertEqual(cl.result_count, 1)
+        self.assertEqual(cl.full_result_count, 1)
+
+    def test_inline_formset(self):
+        inline = RelationshipInline(User, admin.site)
+        FormSet = inline.get_formset(self.request, self.john)
+        self.assertEqual(FormSet.page, 1)
+
+        formset = FormSet(instance=self.john, queryset=inline.get_queryset(self.request))
+        with self.assertNumQueries(3):
+            # the page of relationships, then the status and site choices
+            # shared by every form
+            forms = formset.forms
+            labels = [
+                form.fields['to_user'].widget.label_for_value(form['to_user'].value())
+                for form in forms if form.instance.pk
+            ]
+            for form in forms:
+                list(form.fields['status'].choices)
+                list(form.fields['site'].choices)
+        self.assertEqual(len(forms), 3)
+        self.assertEqual(sorted(labels), [
+            '&nbsp;<strong>Paul</strong>', '&nbsp;<strong>Yoko</strong>'])
+
+        FormSet.per_page = 1
+        formset = FormSet(instance=self.john, queryset=inline.get_queryset(self.request))
+        self.assertEqual(formset.initial_form_count(), 1)
+        newest = Relationship.objects.filter(from_user=self.john).latest('pk')
+        self.assertEqual(formset.get_queryset()[0], newest)
+
+        FormSet.page = 2
+        formset = FormSet(instance=self.john, queryset=inline.get_queryset(self.request))
+        self.assertEqual(formset.initial_form_count(), 1)
+        self.assertNotEqual(formset.get_queryset()[0], newest)
+
+        request = RequestFactory().get('/', {INLINE_PAGE_VAR: 'junk'})
+        request.user = self.walrus
+        self.assertEqual(inline.get_formset(request, self.john).page, 1)
+
+    def test_inline_pages(self):
+        inline = RelationshipInline(User, admin.site)
+        FormSet = inline.get_formset(self.request, self.john)
+        FormSet.per_page = 1
+        loader.get_template(inline.template)
+        template = loader.get_template('relationships/admin/inline_pages.html')
+
+        formset = FormSet(instance=self.john, queryset=inline.get_queryset(self.request))
+        self.assertFalse(formset.has_previous)
+        self.assertTrue(formset.has_next)
+        html = template.render(Context({'formset': formset}))
+        self.assertTrue('href="?%s=2"' % INLINE_PAGE_VAR in html)
+        self.assertFalse('href="?%s=0"' % INLINE_PAGE_VAR in html)
+
+        FormSet.page = 2
+        formset = FormSet(instance=self.john, queryset=inline.get_queryset(self.request))
+        self.assertTrue(formset.has_previous)
+        self.assertFalse(formset.has_next)
+        html = template.render(Context({'formset': formset}))
+        self.assertTrue('href="?%s=1"' % INLINE_PAGE_VAR in html)
+        self.assertFalse('href="?%s=3"' % INLINE_PAGE_VAR in html)
+
+        FormSet.per_page = 2
+        FormSet.page = 1
+        formset = FormSet(instance=self.john, queryset=inline.get_queryset(self.request))
+        self.assertEqual(template.render(Context({'formset': formset})).strip(), '')
+
 class RelationshipUtilsTestCase(BaseRelationshipsTestCase):
     def test_extract_user_field(self):
         # just test a known pass and known fail
@@ -803,3 +2431,182 @@ class RelationshipUtilsTestCase(BaseRelationshipsTestCase):
 
         self.assertTrue(relationship_exists(self.paul, self.john, 'blocking'))
         self.assertFalse(relationship_exists(self.paul, self.john, 'blockers'))
+
+    def test_relationship_exists_many(self):
+        pairs = [
+            (self.john, self.yoko),
+            (self.yoko, self.john),
+            (self.john, self.paul),
+            (self.paul, self.john),
+            (self.walrus.pk, self.john.pk),
+        ]
+        for slug in ('following', 'followers', 'friends', 'blocking', 'blockers'):
+            with self.assertNumQueries(2):
+                result = relationship_exists_many(pairs, slug)
+            for pair in pairs:
+                from_user, to_user = pair
+                if not isinstance(from_user, User):
+                    from_user = User.objects.get(pk=from_user)
+                    to_user = User.objects.get(pk=to_user)
+                self.assertEqual(result[pair],
+                                 relationship_exists(from_user, to_user, slug))
+
+        self.assertEqual(relationship_exists_many([]), {})
+        self.assertRaises(RelationshipStatus.DoesNotExist,
+                          relationship_exists_many, pairs, 'walrus-friends')
+
+    def test_with_relationship_annotations(self):
+        qs = User.objects.order_by('pk')
+        with self.assertNumQueries(1):
+            users = list(with_relationship_annotations(qs, self.john, self.following))
+        self.assertEqual(
+            [(u, bool(u.viewer_follows), bool(u.follows_viewer), u.follower_count)
+             for u in users],
+            [(self.walrus, False, False, 0),
+             (self.john, False, False, 1),
+             (self.paul, True, False, 1),
+             (self.yoko, True, True, 1)])
+
+        # querysets already joining the relationships table
+        users = with_relationship_annotations(
+            self.john.relationships.following(), self.paul, self.blocking)
+        self.assertEqual(
+            sorted((u.username, bool(u.viewer_follows), u.follower_count) for u in users),
+            [('Paul', False, 0), ('Yoko', False, 0)])
+        users = with_relationship_annotations(
+            self.paul.relationships.following(), self.paul, self.blocking)
+        self.assertEqual([u.follower_count for u in users], [])
+
+        users = with_relationship_annotations(qs.filter(pk=self.john.pk), AnonymousUser())
+        self.assertEqual([(u.viewer_follows, u.follows_viewer, u.follower_count)
+                          for u in users], [(0, 0, 1)])
+
+        # private followers are filtered by the profile table
+        self._set_private(self.yoko)
+        annotated = with_relationship_annotations(qs.filter(pk=self.john.pk), self.paul)
+        self.assertEqual(annotated[0].follower_count, 0)
+        self.assertFalse(self.yoko.pk in annotated.query.sql_with_params()[1])
+
+    def test_annotations_white_label(self):
+        white_label = models._white_label_model().objects.create(site_id=2)
+        profiles = privacy.get_profile_model()._default_manager
+        profiles.create(user=self.walrus, white_label_site=white_label)
+        Site.objects.create(pk=2, domain='example.org', name='example.org')
+
+        settings.SITE_ID = 2
+        self.walrus.relationships.add(self.john)
+        self.yoko.relationships.add(self.john)
+        annotated = with_relationship_annotations(User.objects.filter(pk=self.john.pk), self.paul)
+        self.assertEqual(annotated[0].follower_count, 1)
+        self.assertEqual(annotated[0].follower_count, self.john.relationships.followers().count())
+
+    def test_relationship_matrix(self):
+        users = [self.walrus, self.john, self.paul, self.yoko]
+        slugs = ['following', 'followers', 'friends', 'blocking', 'blockers']
+
+        with self.assertNumQueries(2):
+            matrix = relationship_matrix(users, users, slugs)
+
+        self.assertEqual(len(matrix), 16)
+        for from_user in users:
+            for to_user in users:
+                for slug in slugs:
+                    self.assertEqual(matrix[(from_user, to_user)][slug],
+                                     relationship_exists(from_user, to_user, slug))
+
+        # one query per chunk of either side, every chunk pair checked
+        chunk_size, utils.EDGE_CHUNK_SIZE = utils.EDGE_CHUNK_SIZE, 2
+        try:
+            with self.assertNumQueries(1 + 2 * 1):
+                matrix = relationship_matrix(users, [self.john], slugs)
+        finally:
+            utils.EDGE_CHUNK_SIZE = chunk_size
+        self.assertEqual(len(matrix), 4)
+        for from_user in users:
+            for slug in slugs:
+                self.assertEqual(matrix[(from_user, self.john)][slug],
+                                 relationship_exists(from_user, self.john, slug))
+
+
+@skipUnless(os.environ.get('RELATIONSHIPS_BENCHMARK'),
+            'set RELATIONSHIPS_BENCHMARK=<number of users> to run the benchmarks')
+class RelationshipBenchmarkTestCase(TestCase):
+    """
+    Timings on a generated graph, reported on stderr.  The graph has a single
+    popular user followed by everybody, following back every other follower.
+    """
+    def setUp(self):
+        self.size = int(os.environ['RELATIONSHIPS_BENCHMARK'])
+        self.site_id, settings.SITE_ID = settings.SITE_ID, 1
+        self.following = RelationshipStatus.objects.following()
+
+        User.objects.bulk_create([
+            User(username='bench%d' % i, password='!') for i in range(self.size)
+        ])
+        self.users = list(User.objects.filter(username__startswith='bench').order_by('pk'))
+        self.popular = self.users[0]
+
+        relationships = []
+        for i, user in enumerate(self.users[1:]):
+            relationships.append(Relationship(from_user=user, to_user=self.popular,
+                                              status=self.following, site_id=1))
+            if i % 2:
+                relationships.append(Relationship(from_user=self.popular, to_user=user,
+                                                  status=self.following, site_id=1))
+        Relationship.objects.bulk_create(relationships)
+
+    def tearDown(self):
+        settings.SITE_ID = self.site_id
+
+    def _time(self, label, func, repeat=5):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            result = func()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        sys.stderr.write('\n%s (%d users): %.2fms' % (label, self.size, best * 1000))
+        return result
+
+    def test_only_to(self):
+        manager = self.popular.relationships
+
+        def not_in():
+            from_relationships = manager.get_relationships(self.following)
+            to_relationships = manager.get_related_to(self.following)
+            return to_relationships.exclude(pk__in=from_relationships.values_list('pk')).count()
+
+        legacy = self._time('only_to, NOT IN', not_in)
+        anti_join = self._time('only_to, NOT EXISTS', lambda: manager.only_to_count(self.following))
+        self.assertEqual(legacy, anti_join)
+
+
+IMPORT_SCRIPT = """
+import time
+start = time.time()
+import runtests
+import django
+getattr(django, 'setup', lambda: None)()
+from django.contrib.auth.models import User
+import relationships.models
+assert 'relationships' in User.__dict__
+print(time.time() - start)
+"""
+
+
+@skipUnless(os.environ.get('RELATIONSHIPS_BENCHMARK'),
+            'set RELATIONSHIPS_BENCHMARK=<number of users> to run the benchmarks')
+class RelationshipImportBenchmarkTestCase(TestCase):
+    """
+    Cold start time of a fresh process importing the app, as paid by every
+    new worker, reported on stderr.
+    """
+    def test_import(self):
+        import relationships
+        root = os.path.dirname(os.path.dirname(os.path.abspath(relationships.__file__)))
+
+        timings = []
+        for i in range(5):
+            output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], cwd=root)
+            timings.append(float(output.strip().splitlines()[-1]))
+        sys.stderr.write('\nimport relationships.models: %.2fms' % (min(timings) * 1000))
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+
+# sent with ``sender=Relationship`` after relationships from one user were
+# added or removed in bulk, in place of a post_save or post_delete for each.
+# ``added`` and ``removed`` are sequences of ``to_user`` ids.  The optional
+# ``renewed`` lists the ids of ``added`` whose relationship had expired and
+# was kept rather than created again
+bulk_relationships_changed = Signal(
+    providing_args=['from_user_id', 'status_id', 'site_id', 'added', 'removed', 'renewed'])
@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from .coalesce import flush_relationship_change as _flush_relationship_change
+
+
+@shared_task(ignore_result=True)
+def flush_relationship_change(from_user_id, to_user_id, status_id):
+    _flush_relationship_change(from_user_id, to_user_id, status_id)
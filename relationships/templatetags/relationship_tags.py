@@ -1,9 +1,11 @@
 from django import template
-from django.core.urlresolvers import reverse
+from django.core.cache import cache
 from django.db.models.loading import get_model
 from django.template import TemplateSyntaxError, Node, Variable
 from django.utils.functional import wraps
-from relationships.models import RelationshipStatus
+from relationships.cache import expiry_timeout, versioned_cache_key
+from relationships.models import EMPTY_SUMMARY, RelationshipStatus
+from relationships.urlbuilder import url_for
 from relationships.utils import positive_filter, negative_filter
 from django.contrib.contenttypes.models import ContentType
 
@@ -25,13 +27,13 @@ class IfRelationshipNode(template.Node):
             return self.nodelist_false.render(context)
 
         try:
-            status = RelationshipStatus.objects.by_slug(self.status)
+            status, direction = RelationshipStatus.objects.resolve_slug(self.status)
         except RelationshipStatus.DoesNotExist:
             raise template.TemplateSyntaxError('RelationshipStatus not found')
 
-        if status.from_slug == self.status:
+        if direction == 'from':
             val = from_user.relationships.exists(to_user, status)
-        elif status.to_slug == self.status:
+        elif direction == 'to':
             val = to_user.relationships.exists(from_user, status)
         else:
             val = from_user.relationships.exists(to_user, status, symmetrical=True)
@@ -63,8 +65,8 @@ def if_relationship(parser, token):
     """
     bits = list(token.split_contents())
     if len(bits) != 4:
-        raise TemplateSyntaxError, "%r takes 3 arguments:\n%s" % \
-            (bits[0], if_relationship.__doc__)
+        raise TemplateSyntaxError("%r takes 3 arguments:\n%s" %
+            (bits[0], if_relationship.__doc__))
     end_tag = 'end' + bits[0]
     nodelist_true = parser.parse(('else', end_tag))
     token = parser.next_token()
@@ -76,6 +78,53 @@ def if_relationship(parser, token):
     return IfRelationshipNode(nodelist_true, nodelist_false, *bits[1:])
 
 
+class RelationshipCacheNode(template.Node):
+    def __init__(self, nodelist, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        users, vary_on = [], []
+        for var in self.vary_on:
+            value = var.resolve(context)
+            if hasattr(value, 'is_anonymous'):
+                users.append(value.pk)
+            else:
+                vary_on.append(value)
+
+        key = versioned_cache_key(self.fragment_name, users, *vary_on)
+        value = cache.get(key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, expiry_timeout(users))
+        return value
+
+
+@register.tag
+def relationship_cache(parser, token):
+    """
+    Cache the contents of a template fragment until the relationships of any
+    of the users it varies on change or one of them expires.  Arguments that are not users are used
+    to vary the cache key as with django's ``{% cache %}`` tag, but there is
+    no timeout to guess.
+
+    Example::
+
+        {% relationship_cache "follow_button" request.user friend %}
+            ... follow / unfollow buttons ...
+        {% endrelationship_cache %}
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise TemplateSyntaxError("%r takes at least one argument" % bits[0])
+    nodelist = parser.parse(('end' + bits[0],))
+    parser.delete_first_token()
+    fragment_name = bits[1].strip('"\'')
+    vary_on = [parser.compile_filter(bit) for bit in bits[2:]]
+    return RelationshipCacheNode(nodelist, fragment_name, vary_on)
+
+
 @register.filter
 def add_relationship_url(user, status):
     """
@@ -89,7 +138,7 @@ def add_relationship_url(user, status):
     """
     if isinstance(status, RelationshipStatus):
         status = status.from_slug
-    return reverse('relationship_add', args=[user.username, status])
+    return url_for('relationship_add', username=user.username, status_slug=status)
 
 
 @register.filter
@@ -105,7 +154,7 @@ def remove_relationship_url(user, status):
     """
     if isinstance(status, RelationshipStatus):
         status = status.from_slug
-    return reverse('relationship_remove', args=[user.username, status])
+    return url_for('relationship_remove', username=user.username, status_slug=status)
 
 
 def positive_filter_decorator(func):
@@ -166,7 +215,7 @@ class FollowerList(Node):
     def render(self, context):
         user_instance = self.user.resolve(context)
         content_type = ContentType.objects.get_for_model(user_instance).pk
-        return reverse('get_followers', kwargs={'content_type_id': content_type, 'object_id': user_instance.pk })
+        return url_for('get_followers', content_type_id=content_type, object_id=user_instance.pk)
 @register.tag
 def follower_info_url(parser, token):
     bits = token.split_contents()
@@ -182,7 +231,7 @@ class FollowingList(Node):
     def render(self, context):
         user_instance = self.user.resolve(context)
         content_type = ContentType.objects.get_for_model(user_instance).pk
-        return reverse('get_following', kwargs={'content_type_id': content_type, 'object_id': user_instance.pk })
+        return url_for('get_following', content_type_id=content_type, object_id=user_instance.pk)
         
 @register.tag
 def following_info_url(parser, token):
@@ -234,6 +283,30 @@ class AsNode(template.Node):
     def render_result(self, context):
         raise NotImplementedError("Must be implemented by a subclass")
 
+class RelationshipSummaryNode(AsNode):
+    args_count = 2
+
+    def render_result(self, context):
+        viewer = self.args[0].resolve(context)
+        owner = self.args[1].resolve(context)
+        if viewer is None or viewer.is_anonymous():
+            return EMPTY_SUMMARY
+        return viewer.relationships.summary_with(owner)
+
+
+@register.tag
+def relationship_summary(parser, token):
+    """
+    Look up every relationship between two users with a single query.
+
+    Example::
+
+        {% relationship_summary request.user profile_user as rel %}
+        {% if rel.friends %}...{% endif %}
+        {% if rel.blocked_by %}...{% endif %}
+    """
+    return RelationshipSummaryNode.handle_token(parser, token)
+
 class FollowingListSubset(AsNode):
 
     def render_result(self, context):
@@ -242,8 +315,8 @@ class FollowingListSubset(AsNode):
         lIndex = self.args[2].resolve(context)
         content_type = ContentType.objects.get_for_model(obj_instance).pk
         
-        return reverse('get_following_subset', kwargs={
-            'content_type_id': content_type, 'object_id': obj_instance.pk, 'sIndex':sIndex, 'lIndex':lIndex})
+        return url_for('get_following_subset', content_type_id=content_type,
+                       object_id=obj_instance.pk, sIndex=sIndex, lIndex=lIndex)
 
 @register.tag
 def following_subset_url(parser, token):
@@ -262,8 +335,8 @@ class FollowerListSubset(AsNode):
         lIndex = self.args[2].resolve(context)
         content_type = ContentType.objects.get_for_model(obj_instance).pk
         
-        return reverse('get_follower_subset', kwargs={
-            'content_type_id': content_type, 'object_id': obj_instance.pk, 'sIndex':sIndex, 'lIndex':lIndex})
+        return url_for('get_follower_subset', content_type_id=content_type,
+                       object_id=obj_instance.pk, sIndex=sIndex, lIndex=lIndex)
 
 @register.tag
 def follower_subset_url(parser, token):
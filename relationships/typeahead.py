@@ -0,0 +1,89 @@
+"""
+Prefix search over the users someone follows or is friends with, for
+"mention" and "share with" boxes that search on every keystroke.
+
+Each user's connections are kept in the cache as a list of
+``(lowercased username, id, username)`` tuples sorted by name, so a search is
+a binary search into the list and a warm cache answers it without touching
+the database.  An index is built from ``following()`` or ``friends()`` the
+first time it is searched.  Indexes are keyed on the user's relationship
+version and the privacy version, so any change to the user's relationships,
+or a profile turning private or public, has the next search build a new one
+rather than anything being updated in place.
+"""
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .cache import get_relationship_version
+from .privacy import privacy_version
+
+
+TIMEOUT = getattr(settings, 'RELATIONSHIPS_TYPEAHEAD_TIMEOUT', 60 * 60 * 24)
+LIMIT = getattr(settings, 'RELATIONSHIPS_TYPEAHEAD_LIMIT', 10)
+MAX_LIMIT = getattr(settings, 'RELATIONSHIPS_TYPEAHEAD_MAX_LIMIT', 50)
+
+FOLLOWING = 'following'
+FRIENDS = 'friends'
+KINDS = (FOLLOWING, FRIENDS)
+
+INDEX_KEY = 'relationships:typeahead:%s:%s.%s:%s:%s'
+
+
+def _key(user, kind):
+    return INDEX_KEY % (settings.SITE_ID, user.pk, get_relationship_version(user),
+                        kind, privacy_version())
+
+
+def _entry(user):
+    return (user.username.lower(), user.pk, user.username)
+
+
+def _connections(user, kind):
+    loading = dict(select_related=(), prefetch_related=(), only=('pk', 'username'))
+    if kind == FRIENDS:
+        return user.relationships.friends(**loading)
+    return user.relationships.following(**loading)
+
+
+def build_index(user, kind=FOLLOWING):
+    """
+    Load the sorted index of ``user``'s connections and cache it, until the
+    first temporary relationship in it expires at the latest.
+    """
+    from .models import RelationshipStatus
+
+    # the key is read first, so a change made while loading goes to a newer
+    # version rather than being overwritten
+    key = _key(user, kind)
+    index = sorted(_entry(connection) for connection in _connections(user, kind))
+    timeout = user.relationships._cache_timeout(kind, RelationshipStatus.objects.following())
+    cache.set(key, index, min(TIMEOUT, timeout))
+    return index
+
+
+def get_index(user, kind=FOLLOWING):
+    index = cache.get(_key(user, kind))
+    if index is None:
+        index = build_index(user, kind)
+    return index
+
+
+def search(user, prefix, kind=FOLLOWING, limit=LIMIT):
+    """
+    Returns up to ``limit`` ``(id, username)`` tuples of ``user``'s
+    connections whose username starts with ``prefix``, case insensitively,
+    in username order.
+    """
+    if kind not in KINDS:
+        raise ValueError('Unknown connection kind %r' % (kind,))
+
+    prefix = prefix.lower()
+    index = get_index(user, kind)
+    results = []
+    i = bisect_left(index, (prefix,))
+    while i < len(index) and len(results) < limit and index[i][0].startswith(prefix):
+        results.append(index[i][1:])
+        i += 1
+    return results
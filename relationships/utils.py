@@ -1,18 +1,215 @@
+from collections import OrderedDict
+
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
 
-from .models import RelationshipStatus
+from .models import (Relationship, RelationshipStatus, RelationshipStatusSlug,
+    _white_label_user_ids, unexpired)
+from .privacy import private_profiles
 
 
 def relationship_exists(from_user, to_user, status_slug='following'):
-    status = RelationshipStatus.objects.by_slug(status_slug)
-    if status.from_slug == status_slug:
+    status, direction = RelationshipStatus.objects.resolve_slug(status_slug)
+    if direction == 'from':
         return from_user.relationships.exists(to_user, status)
-    elif status.to_slug == status_slug:
+    elif direction == 'to':
         return to_user.relationships.exists(from_user, status)
     else:
         return from_user.relationships.exists(to_user, status, True)
 
 
+def _pk(user):
+    return getattr(user, 'pk', user)
+
+
+def _resolve_slugs(slugs):
+    """
+    Map each slug to a ``(status_id, direction)`` tuple, where direction is
+    one of 'from', 'to' or 'symmetrical', using a single query.
+    """
+    slugs = set(slugs)
+    resolved = dict(
+        (slug, (status_id, direction))
+        for slug, status_id, direction in RelationshipStatusSlug.objects.filter(
+            slug__in=slugs
+        ).values_list('slug', 'status', 'direction')
+    )
+
+    missing = slugs.difference(resolved)
+    for slug in missing:
+        try:
+            status, direction = RelationshipStatus.objects.resolve_slug(slug)
+        except RelationshipStatus.DoesNotExist:
+            raise RelationshipStatus.DoesNotExist(
+                'RelationshipStatus matching %s does not exist' % ', '.join(sorted(missing)))
+        resolved[slug] = (status.pk, direction)
+    return resolved
+
+
+# ids per IN list: the two lists of each direction plus a few more
+# parameters keep a query under SQLite's limit of 999 variables
+EDGE_CHUNK_SIZE = 200
+
+
+def _chunks(ids):
+    ids = sorted(ids)
+    return [ids[i:i + EDGE_CHUNK_SIZE] for i in range(0, len(ids), EDGE_CHUNK_SIZE)]
+
+
+def _edges_between(from_ids, to_ids, statuses):
+    """
+    Returns a set of ``(from_user_id, to_user_id, status_id)`` for the
+    relationships on the current site that the ``(status_id, direction)``
+    tuples in ``statuses`` need to be checked from ``from_ids`` to
+    ``to_ids``: those from ``from_ids`` to ``to_ids`` for the 'from' and
+    'symmetrical' directions, those the other way round for 'to' and
+    'symmetrical'.  One query is run per chunk of each id list.
+    """
+    forward = set(pk for pk, direction in statuses if direction != 'to')
+    backward = set(pk for pk, direction in statuses if direction != 'from')
+
+    edges = set()
+    for from_chunk in _chunks(from_ids):
+        for to_chunk in _chunks(to_ids):
+            among = Q()
+            if forward:
+                among |= Q(from_user__in=from_chunk, to_user__in=to_chunk,
+                           status__in=forward)
+            if backward:
+                among |= Q(from_user__in=to_chunk, to_user__in=from_chunk,
+                           status__in=backward)
+            edges.update(Relationship.objects.filter(
+                among,
+                unexpired(),
+                site__pk=settings.SITE_ID,
+            ).values_list('from_user', 'to_user', 'status'))
+    return edges
+
+
+def _edge_exists(edges, from_id, to_id, status_id, direction):
+    if direction == 'from':
+        return (from_id, to_id, status_id) in edges
+    elif direction == 'to':
+        return (to_id, from_id, status_id) in edges
+    return (from_id, to_id, status_id) in edges and \
+           (to_id, from_id, status_id) in edges
+
+
+def relationship_exists_many(pairs, status_slug='following'):
+    """
+    Like :func:`relationship_exists`, but checks many ``(from_user, to_user)``
+    pairs at once using two queries, plus one for every further 200 users on
+    either side.  Users may be passed as instances or primary keys.
+
+    Returns a dictionary mapping each pair to a boolean.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return {}
+
+    status_id, direction = _resolve_slugs([status_slug])[status_slug]
+    from_ids = set(_pk(from_user) for from_user, _ in pairs)
+    to_ids = set(_pk(to_user) for _, to_user in pairs)
+    edges = _edges_between(from_ids, to_ids, [(status_id, direction)])
+
+    return dict(
+        (pair, _edge_exists(edges, _pk(pair[0]), _pk(pair[1]), status_id, direction))
+        for pair in pairs
+    )
+
+
+def relationship_matrix(from_users, to_users, slugs):
+    """
+    Check every status slug in ``slugs`` between every user in ``from_users``
+    and every user in ``to_users`` using two queries, plus one for every
+    further 200 users on either side.
+
+    Returns a dictionary mapping each ``(from_user, to_user)`` pair to a
+    dictionary of ``{slug: boolean}``.
+    """
+    from_users, to_users, slugs = list(from_users), list(to_users), list(slugs)
+    if not (from_users and to_users and slugs):
+        return {}
+
+    resolved = _resolve_slugs(slugs)
+    edges = _edges_between(set(_pk(user) for user in from_users),
+                           set(_pk(user) for user in to_users),
+                           set(resolved.values()))
+
+    matrix = {}
+    for from_user in from_users:
+        for to_user in to_users:
+            matrix[(from_user, to_user)] = dict(
+                (slug, _edge_exists(edges, _pk(from_user), _pk(to_user), status_id, direction))
+                for slug, (status_id, direction) in resolved.items()
+            )
+    return matrix
+
+
+def with_relationship_annotations(qs, viewer, status=None):
+    """
+    Annotate every user in ``qs`` with its relationships to ``viewer``, so
+    that a page of users costs a single query:
+
+    * ``viewer_follows`` -- the viewer has a relationship to the user
+    * ``follows_viewer`` -- the user has a relationship to the viewer
+    * ``follower_count`` -- how many users have a relationship to the user,
+      not counting private profiles nor, on a white label site, users of
+      other sites, as ``followers().count()`` would
+
+    ``status`` defaults to "following".  The flags are computed with
+    correlated ``EXISTS`` subqueries and are false for an anonymous viewer.
+    """
+    if not status:
+        status = RelationshipStatus.objects.following()
+
+    qn = connection.ops.quote_name
+    opts = Relationship._meta
+    from_column = qn(opts.get_field('from_user').column)
+    to_column = qn(opts.get_field('to_user').column)
+    user_column = '%s.%s' % (qn(qs.model._meta.db_table), qn(qs.model._meta.pk.column))
+
+    expires_column = qn(opts.get_field('expires_at').column)
+    now = timezone.now()
+
+    def subquery(select, *where):
+        where = ('%s = %%s' % qn(opts.get_field('status').column),
+                 '%s = %%s' % qn(opts.get_field('site').column),
+                 '(%s IS NULL OR %s > %%s)' % (expires_column, expires_column)) + where
+        return '(SELECT %s FROM %s WHERE %s)' % (
+            select, qn(opts.db_table), ' AND '.join(where))
+
+    select = OrderedDict()
+    select_params = []
+
+    if viewer is not None and viewer.is_authenticated():
+        select['viewer_follows'] = 'EXISTS %s' % subquery(
+            '1', '%s = %%s' % from_column, '%s = %s' % (to_column, user_column))
+        select['follows_viewer'] = 'EXISTS %s' % subquery(
+            '1', '%s = %%s' % to_column, '%s = %s' % (from_column, user_column))
+        select_params.extend([status.pk, settings.SITE_ID, now, viewer.pk] * 2)
+    else:
+        select['viewer_follows'] = select['follows_viewer'] = '0'
+
+    where = ['%s = %s' % (to_column, user_column)]
+    select_params.extend([status.pk, settings.SITE_ID, now])
+    # WHY: gdpr compliance.
+    private = private_profiles()
+    if private is not None:
+        sql, params = private.values('user').query.sql_with_params()
+        where.append('%s NOT IN (%s)' % (from_column, sql))
+        select_params.extend(params)
+    if settings.SITE_ID > 1:
+        sql, params = _white_label_user_ids().query.sql_with_params()
+        where.append('%s IN (%s)' % (from_column, sql))
+        select_params.extend(params)
+    select['follower_count'] = subquery('COUNT(*)', *where)
+
+    return qs.extra(select=select, select_params=select_params)
+
 def extract_user_field(model):
     for field in model._meta.fields + model._meta.many_to_many:
         if field.rel and field.rel.to == User:
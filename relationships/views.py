@@ -10,10 +10,10 @@ from django.utils.http import urlquote
 from django.views.generic import ListView
 from django.contrib.contenttypes.models import ContentType
 
-from .decorators import require_user
-from .models import RelationshipStatus
-from actstream import actions
-from actstream.models import Action
+from . import typeahead
+from .coalesce import submit_relationship_change
+from .decorators import cache_follow_list, require_user
+from .models import GenericRelationship, RelationshipStatus
 from allauth.account.decorators import verified_email_required
 
 
@@ -36,8 +36,12 @@ def _relationship_list(request, queryset, template_name=None, *args, **kwargs):
 
 
 def get_relationship_status_or_404(status_slug):
+    return resolve_status_slug_or_404(status_slug)[0]
+
+
+def resolve_status_slug_or_404(status_slug):
     try:
-        return RelationshipStatus.objects.by_slug(status_slug)
+        return RelationshipStatus.objects.resolve_slug(status_slug)
     except RelationshipStatus.DoesNotExist:
         raise Http404
 
@@ -47,10 +51,10 @@ def relationship_list(request, user, status_slug=None,
                       template_name='relationships/relationship_list.html'):
     if not status_slug:
         status = RelationshipStatus.objects.following()
-        status_slug = status.from_slug
+        status_slug, direction = status.from_slug, 'from'
     else:
         # get the relationship status object we're talking about
-        status = get_relationship_status_or_404(status_slug)
+        status, direction = resolve_status_slug_or_404(status_slug)
 
     # do some basic authentication
     if status.login_required and not request.user.is_authenticated():
@@ -62,9 +66,9 @@ def relationship_list(request, user, status_slug=None,
         raise Http404
 
     # get a queryset of users described by this relationship
-    if status.from_slug == status_slug:
+    if direction == 'from':
         qs = user.relationships.get_relationships(status=status)
-    elif status.to_slug == status_slug:
+    elif direction == 'to':
         qs = user.relationships.get_related_to(status=status)
     else:
         qs = user.relationships.get_relationships(status=status, symmetrical=True)
@@ -84,19 +88,11 @@ def relationship_handler(request, user, status_slug, add=True,
                          template_name='relationships/confirm.html',
                          success_template_name='relationships/success.html'):
 
-    status = get_relationship_status_or_404(status_slug)
-    is_symm = status_slug == status.symmetrical_slug
+    status, direction = resolve_status_slug_or_404(status_slug)
+    is_symm = direction == 'symmetrical'
 
     if request.method == 'POST':
-        if add:
-            request.user.relationships.add(user, status, is_symm)
-            actions.follow(request.user, user, actor_only=False)
-        else:
-            request.user.relationships.remove(user, status, is_symm)
-            actions.unfollow(request.user, user)
-            ctype = ContentType.objects.get_for_model(request.user)
-            target_content_type = ContentType.objects.get_for_model(user)
-            Action.objects.all().filter(actor_content_type=ctype, actor_object_id=request.user.id, verb=u'started following', target_content_type=target_content_type, target_object_id = user.id ).delete()
+        submit_relationship_change(request.user, user, status, add, is_symm)
 
         if request.is_ajax():
             return HttpResponse(json.dumps(dict(success=True)))
@@ -117,54 +113,99 @@ def relationship_handler(request, user, status_slug, add=True,
         {'to_user': user, 'status': status, 'add': add},
         context_instance=RequestContext(request))
 
-def get_followers(request, content_type_id, object_id):
+def _get_target_or_404(content_type_id, object_id):
     ctype = get_object_or_404(ContentType, pk=content_type_id)
-    user = get_object_or_404(ctype.model_class(), pk=object_id)
+    model = ctype.model_class()
+    if model is None:
+        raise Http404
+    return get_object_or_404(model, pk=object_id)
+
+
+def _followers_of(obj, **loading):
+    # users are followed through Relationship, anything else through
+    # GenericRelationship
+    if isinstance(obj, User):
+        return obj.relationships.followers(**loading)
+    return GenericRelationship.objects.followers_of(obj, **loading)
+
+
+# the follower and following views take the select_related,
+# prefetch_related and only arguments of load_related() as extra url
+# arguments, defaulting to the RELATIONSHIPS_LIST_* settings
+
+@cache_follow_list
+def get_followers(request, content_type_id, object_id, **loading):
+    obj = _get_target_or_404(content_type_id, object_id)
     if request.is_ajax():
         return render_to_response("relationships/friend_list_all.html", {
-            "friends": user.relationships.followers,
+            "friends": _followers_of(obj, **loading),
         }, context_instance=RequestContext(request))
     else:
         return render_to_response("relationships/render_friend_list_all.html", {
-            "friends": user.relationships.followers,
+            "friends": _followers_of(obj, **loading),
         }, context_instance=RequestContext(request))        
 
-def get_follower_subset(request, content_type_id, object_id, sIndex, lIndex):
-    ctype = get_object_or_404(ContentType, pk=content_type_id)
-    user = get_object_or_404(ctype.model_class(), pk=object_id)
+@cache_follow_list
+def get_follower_subset(request, content_type_id, object_id, sIndex, lIndex, **loading):
+    obj = _get_target_or_404(content_type_id, object_id)
     s = (int)(""+sIndex)
     l = (int)(""+lIndex)
     if request.is_ajax():
         return render_to_response("relationships/friend_list_all.html", {
-            "friends": user.relationships.followers()[s:l],
+            "friends": _followers_of(obj, **loading)[s:l],
         }, context_instance=RequestContext(request))
     else:
         return render_to_response("relationships/render_friend_list_all.html", {
-            "friends": user.relationships.followers()[s:l],
+            "friends": _followers_of(obj, **loading)[s:l],
         }, context_instance=RequestContext(request))
 
-def get_following(request, content_type_id, object_id):
+@cache_follow_list
+def get_following(request, content_type_id, object_id, **loading):
     ctype = get_object_or_404(ContentType, pk=content_type_id)
     user = get_object_or_404(ctype.model_class(), pk=object_id)
     if request.is_ajax():
         return render_to_response("relationships/friend_list_all.html", {
-            "friends": user.relationships.following,
+            "friends": user.relationships.following(**loading),
         }, context_instance=RequestContext(request))
     else:
         return render_to_response("relationships/render_friend_list_all.html", {
-            "friends": user.relationships.following,
+            "friends": user.relationships.following(**loading),
         }, context_instance=RequestContext(request))
 
-def get_following_subset(request, content_type_id, object_id, sIndex, lIndex):
+@cache_follow_list
+def get_following_subset(request, content_type_id, object_id, sIndex, lIndex, **loading):
     ctype = get_object_or_404(ContentType, pk=content_type_id)
     user = get_object_or_404(ctype.model_class(), pk=object_id)
     s = (int)(""+sIndex)
     l = (int)(""+lIndex)
     if request.is_ajax():
         return render_to_response("relationships/friend_list_all.html", {
-            "friends": user.relationships.following()[s:l],
+            "friends": user.relationships.following(**loading)[s:l],
         }, context_instance=RequestContext(request))
     else:
         return render_to_response("relationships/render_friend_list_all.html", {
-            "friends": user.relationships.following()[s:l],
-        }, context_instance=RequestContext(request))        
+            "friends": user.relationships.following(**loading)[s:l],
+        }, context_instance=RequestContext(request))
+
+
+@login_required
+def connection_typeahead(request):
+    """
+    JSON list of the request user's connections whose username starts with
+    ``q``.  ``kind`` is "following" (the default) or "friends".
+    """
+    kind = request.GET.get('kind', typeahead.FOLLOWING)
+    if kind not in typeahead.KINDS:
+        raise Http404
+    try:
+        limit = min(max(int(request.GET.get('limit', typeahead.LIMIT)), 1),
+                    typeahead.MAX_LIMIT)
+    except ValueError:
+        limit = typeahead.LIMIT
+
+    prefix = request.GET.get('q', '').strip()
+    results = []
+    if prefix:
+        results = [dict(id=pk, username=username) for pk, username in
+                   typeahead.search(request.user, prefix, kind, limit)]
+    return HttpResponse(json.dumps(dict(results=results)), content_type='application/json')
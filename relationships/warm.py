@@ -0,0 +1,265 @@
+"""
+Filling the cache for the most viewed users, e.g. right after a deploy.
+
+:func:`warm_users` caches what ``user.relationships`` reads for each user --
+the ids and counts of the users they follow, their followers and friends,
+for every status -- along with the status slug registry.  The data of a
+batch of users is read with a few grouped queries and written to the cache
+from a pool of threads.  Keys embed the relationship versions read before
+the data, so a change made meanwhile leaves the warmed entry unused rather
+than stale.
+
+The follower and following list views, as an anonymous visitor gets them,
+and the typeahead indexes are warmed through the code serving them, so they
+are cached under exactly the keys requests look up.
+"""
+import datetime
+import threading
+import time
+from array import array
+from collections import defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import NoReverseMatch
+from django.db import connection
+from django.db.models import Count, Sum
+from django.http import HttpRequest
+from django.utils import timezone, translation
+
+from . import typeahead
+from .cache import CACHE_TIMEOUT, get_relationship_versions
+from .graph import _intersection
+from .models import (CACHE_MAX_IDS, COUNT, FOLLOWERS, FOLLOWING, FRIENDS,
+    Relationship, RelationshipRollup, RelationshipStatus, RelationshipStatusSlug,
+    neighbor_cache_key, unexpired)
+from .privacy import exclude_private, privacy_version
+from .urlbuilder import url_for
+
+
+BY_FOLLOWERS = 'followers'
+BY_RECENT = 'recent'
+
+WarmReport = namedtuple('WarmReport', ['users', 'keys', 'load_time', 'fill_time'])
+
+_local = threading.local()
+
+
+def _thread_cache():
+    # not every cache client may be shared between threads
+    if not hasattr(_local, 'cache'):
+        try:
+            from django.core.cache import caches
+            _local.cache = caches['default']
+        except ImportError:
+            from django.core.cache import get_cache
+            _local.cache = get_cache('default')
+    return _local.cache
+
+
+def _most_followed(limit, status):
+    # relationships gained less those lost over every day of the rollups,
+    # one row per user and active day rather than per relationship
+    qn = connection.ops.quote_name
+    opts = RelationshipRollup._meta
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT %(user)s FROM %(table)s '
+        'WHERE %(status)s = %%s AND %(site)s = %%s AND %(resolution)s = %%s '
+        'GROUP BY %(user)s '
+        'ORDER BY SUM(%(added)s) - SUM(%(removed)s) DESC, %(user)s '
+        'LIMIT %%s' % dict(
+            table=qn(opts.db_table),
+            user=qn(opts.get_field('user').column),
+            status=qn(opts.get_field('status').column),
+            site=qn(opts.get_field('site').column),
+            resolution=qn(opts.get_field('resolution').column),
+            added=qn(opts.get_field('added').column),
+            removed=qn(opts.get_field('removed').column),
+        ),
+        [status.pk, settings.SITE_ID, RelationshipRollup.DAY, limit])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def hot_users(limit, by=BY_FOLLOWERS, status=None, days=7):
+    """
+    Returns the ids of the ``limit`` users with the most relationships of
+    ``status``, "following" by default, to them, or with ``by='recent'`` the
+    most gained over the last ``days`` days.  Both are read from the daily
+    rollups, which must have been backfilled for relationships older than
+    them.
+    """
+    if not status:
+        status = RelationshipStatus.objects.following()
+
+    if by == BY_FOLLOWERS:
+        return _most_followed(limit, status)
+    elif by == BY_RECENT:
+        qs = RelationshipRollup.objects.filter(
+            status=status,
+            site__pk=settings.SITE_ID,
+            resolution=RelationshipRollup.DAY,
+            bucket__gte=timezone.now() - datetime.timedelta(days=days),
+        ).values_list('user').annotate(total=Sum('added')).order_by('-total', 'user')
+    else:
+        raise ValueError('Unknown ranking %r' % (by,))
+    return [user_id for user_id, total in qs[:limit]]
+
+
+def _counts(qs, user_field, other_field):
+    qs = exclude_private(qs, other_field)
+    return dict(qs.values_list(user_field).annotate(Count('pk')).order_by())
+
+
+def _ids(qs, user_ids, user_field, other_field):
+    ids = defaultdict(lambda: array('i'))
+    if user_ids:
+        qs = exclude_private(qs.filter(**{'%s__in' % user_field: user_ids}), other_field)
+        for user_id, other_id in qs.values_list(user_field, other_field).order_by(other_field):
+            ids[user_id].append(other_id)
+    return ids
+
+
+def _load(user_ids, status, versions, privacy):
+    """
+    Returns a dictionary of the cache entries of ``user_ids`` for one
+    status, read with six queries.  Users with temporary relationships are
+    skipped, their entries are cached when read with a timeout that ends at
+    the first expiry.
+    """
+    qs = Relationship.objects.filter(unexpired(), status=status, site__pk=settings.SITE_ID)
+    temporary = qs.filter(expires_at__isnull=False)
+    skipped = set(temporary.filter(from_user__in=user_ids).values_list('from_user', flat=True))
+    skipped.update(temporary.filter(to_user__in=user_ids).values_list('to_user', flat=True))
+    user_ids = [pk for pk in user_ids if pk not in skipped]
+
+    outgoing = qs.filter(from_user__in=user_ids)
+    incoming = qs.filter(to_user__in=user_ids)
+
+    following_counts = _counts(outgoing, 'from_user', 'to_user')
+    follower_counts = _counts(incoming, 'to_user', 'from_user')
+
+    # id sets too long to cache are not read at all
+    following = _ids(qs, [pk for pk in following_counts
+                          if following_counts[pk] <= CACHE_MAX_IDS], 'from_user', 'to_user')
+    followers = _ids(qs, [pk for pk in follower_counts
+                          if follower_counts[pk] <= CACHE_MAX_IDS], 'to_user', 'from_user')
+
+    entries = {}
+    for user_id in user_ids:
+        def key(kind):
+            return neighbor_cache_key(user_id, kind, status.pk, versions[user_id], privacy)
+
+        following_count = following_counts.get(user_id, 0)
+        follower_count = follower_counts.get(user_id, 0)
+        entries[key(FOLLOWING + COUNT)] = following_count
+        entries[key(FOLLOWERS + COUNT)] = follower_count
+        if following_count <= CACHE_MAX_IDS:
+            entries[key(FOLLOWING)] = following[user_id]
+        if follower_count <= CACHE_MAX_IDS:
+            entries[key(FOLLOWERS)] = followers[user_id]
+        if following_count <= CACHE_MAX_IDS and follower_count <= CACHE_MAX_IDS:
+            friends = _intersection(following[user_id], followers[user_id])
+            entries[key(FRIENDS)] = friends
+            entries[key(FRIENDS + COUNT)] = len(friends)
+    return entries
+
+
+def _fill(entries):
+    _thread_cache().set_many(entries, CACHE_TIMEOUT)
+    return len(entries)
+
+
+def _request(path, ajax):
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = path
+    request.META['SERVER_NAME'] = 'localhost'
+    request.META['SERVER_PORT'] = '80'
+    if ajax:
+        request.META['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+    request.user = AnonymousUser()
+    return request
+
+
+def _warm_views(users):
+    """
+    Render the follower and following lists of ``users``, plain and for
+    ajax, through their cached views.  Returns the number of responses
+    cached, none when the views are not routed.
+    """
+    from . import views
+
+    content_type_id = ContentType.objects.get_for_model(User).pk
+    cached = 0
+    # requests are served in the default language, which is part of the key
+    with translation.override(settings.LANGUAGE_CODE):
+        for user in users:
+            for name in ('get_followers', 'get_following'):
+                kwargs = dict(content_type_id=str(content_type_id), object_id=str(user.pk))
+                try:
+                    path = url_for(name, **kwargs)
+                except NoReverseMatch:
+                    return cached
+                for ajax in (False, True):
+                    response = getattr(views, name)(_request(path, ajax), **kwargs)
+                    cached += response.status_code == 200
+    return cached
+
+
+def _warm_typeahead(users):
+    for user in users:
+        for kind in typeahead.KINDS:
+            typeahead.build_index(user, kind)
+    return len(users) * len(typeahead.KINDS)
+
+
+def warm_users(user_ids, statuses=None, batch_size=500, threads=8, chunk_size=1000,
+               views=True):
+    """
+    Cache the neighbor ids and counts of ``user_ids`` for ``statuses``, all
+    of them by default, ``batch_size`` users at a time, writing
+    ``chunk_size`` keys per cache call from ``threads`` threads, then their
+    typeahead indexes and, unless ``views`` is false, list views.  Returns a
+    ``WarmReport``.
+    """
+    user_ids = list(user_ids)
+    load_time = fill_time = 0.0
+    keys = 0
+
+    start = time.time()
+    RelationshipStatusSlug.objects.registry()
+    if statuses is None:
+        statuses = list(RelationshipStatus.objects.all())
+    privacy = privacy_version()
+    load_time += time.time() - start
+
+    pool = ThreadPool(threads)
+    try:
+        for i in range(0, len(user_ids), batch_size):
+            batch = user_ids[i:i + batch_size]
+
+            start = time.time()
+            versions = get_relationship_versions(batch)
+            entries = {}
+            for status in statuses:
+                entries.update(_load(batch, status, versions, privacy))
+            load_time += time.time() - start
+
+            start = time.time()
+            items = list(entries.items())
+            chunks = [dict(items[j:j + chunk_size]) for j in range(0, len(items), chunk_size)]
+            keys += sum(pool.map(_fill, chunks))
+
+            users = list(User.objects.filter(pk__in=batch))
+            keys += _warm_typeahead(users)
+            if views:
+                keys += _warm_views(users)
+            fill_time += time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+
+    return WarmReport(len(user_ids), keys, load_time, fill_time)
@@ -0,0 +1,153 @@
+"""
+Maintenance of :attr:`Relationship.weight`, the strength of the tie between
+two users.  Interactions push weights up in batched UPDATEs and a periodic
+decay pulls every weight down so that old interactions fade.
+"""
+import multiprocessing
+import operator
+from collections import defaultdict
+from functools import reduce
+
+from django.conf import settings
+from django.db import connection
+from django.db.transaction import TransactionManagementError
+from django.db.models import F, Max, Min, Q
+
+from .models import Relationship, RelationshipStatus
+
+
+BATCH_SIZE = getattr(settings, 'RELATIONSHIPS_WEIGHT_BATCH_SIZE', 500)
+
+
+def _pk(obj):
+    return getattr(obj, 'pk', obj)
+
+
+def record_interactions(interactions, status=None, batch_size=BATCH_SIZE):
+    """
+    Add to the weight of existing relationships.  ``interactions`` is an
+    iterable of ``(from_user, to_user, amount)`` tuples, where users may be
+    instances or primary keys and ``status`` defaults to "following".
+
+    Amounts for the same pair are summed first, then every batch of pairs
+    sharing the same amount is updated with a single UPDATE.  Returns the
+    number of relationships updated.
+    """
+    if not status:
+        status = RelationshipStatus.objects.following()
+
+    totals = defaultdict(float)
+    for from_user, to_user, amount in interactions:
+        totals[(_pk(from_user), _pk(to_user))] += amount
+
+    by_amount = defaultdict(list)
+    for pair, amount in totals.items():
+        if amount:
+            by_amount[amount].append(pair)
+
+    updated = 0
+    for amount, pairs in by_amount.items():
+        pairs.sort()
+        for i in range(0, len(pairs), batch_size):
+            to_users = defaultdict(list)
+            for from_id, to_id in pairs[i:i + batch_size]:
+                to_users[from_id].append(to_id)
+
+            query = reduce(operator.or_, [
+                Q(from_user=from_id, to_user__in=to_ids)
+                for from_id, to_ids in to_users.items()
+            ])
+            updated += Relationship.objects.filter(
+                query,
+                status=status,
+                site__pk=settings.SITE_ID,
+            ).update(weight=F('weight') + amount)
+
+    return updated
+
+
+class InteractionBuffer(object):
+    """
+    Collects interactions and writes them with :func:`record_interactions`
+    once ``batch_size`` have been seen, or when used as a context manager, on
+    exit::
+
+        with InteractionBuffer() as buf:
+            for comment in comments:
+                buf.add(comment.user, comment.post.author)
+    """
+    def __init__(self, status=None, batch_size=BATCH_SIZE):
+        self.status = status
+        self.batch_size = batch_size
+        self.pending = []
+
+    def add(self, from_user, to_user, amount=1.0):
+        self.pending.append((_pk(from_user), _pk(to_user), amount))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+        return record_interactions(pending, self.status, self.batch_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+def _decay_range(args):
+    start, stop, factor, status_id = args
+    qs = Relationship.objects.filter(pk__gte=start, pk__lt=stop, weight__isnull=False)
+    if status_id:
+        qs = qs.filter(status__pk=status_id)
+    return qs.update(weight=F('weight') * factor)
+
+
+def _in_memory():
+    return (connection.vendor == 'sqlite' and
+            connection.settings_dict['NAME'] in ('', ':memory:'))
+
+
+def decay_weights(factor, status=None, chunk_size=10000, processes=1):
+    """
+    Multiply every relationship weight by ``factor``.  The table is walked in
+    primary key ranges of ``chunk_size`` rows, each decayed by its own short
+    UPDATE, and the ranges are spread over a pool of ``processes`` workers.
+    Returns the number of relationships updated.
+
+    The workers commit their ranges on connections of their own, so more
+    than one process cannot run inside a transaction, nor against an
+    in-memory SQLite database which they could not reach; the latter is
+    decayed in this process instead.
+    """
+    if processes > 1 and connection.in_atomic_block:
+        raise TransactionManagementError(
+            'decay_weights() cannot use several processes inside a transaction')
+
+    bounds = Relationship.objects.aggregate(start=Min('pk'), stop=Max('pk'))
+    if bounds['start'] is None:
+        return 0
+
+    status_id = status and _pk(status)
+    chunks = [
+        (start, start + chunk_size, factor, status_id)
+        for start in range(bounds['start'], bounds['stop'] + 1, chunk_size)
+    ]
+
+    if processes <= 1 or _in_memory():
+        return sum(map(_decay_range, chunks))
+
+    # the workers are forked from this process and must not share its
+    # database connection, each will open its own
+    connection.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+        return sum(pool.imap_unordered(_decay_range, chunks))
+    finally:
+        pool.close()
+        pool.join()
@@ -21,6 +21,7 @@ setup(
             'fixtures/*.json',
             'templates/*.html',
             'templates/*/*.html',
+            'templates/*/*/*.html',
             'locale/*/LC_MESSAGES/*',
             'relationships_tests/fixtures/*.json',
         ],